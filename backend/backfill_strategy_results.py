@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Backfill strategy_results from the per-user ledger copies of uploaded results.
+
+Settlement used to record sheet rows only as PROFIT/LOSS transactions, one copy
+per subscriber. The copies of a row share strategy, settlement time and trade
+details, so they are grouped back into one strategy_results document each.
+For a strategy that already has strategy_results documents, only rows settled
+before its earliest one are backfilled, so rerunning writes nothing new.
+
+Usage:
+    python backfill_strategy_results.py [--dry-run]
+"""
+import argparse
+import asyncio
+import sys
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from server import db, ensure_strategy_results_collection
+
+async def backfill(dry_run: bool):
+    await ensure_strategy_results_collection()
+    first = {
+        row["_id"]: row["created_at"]
+        for row in await db.strategy_results.aggregate([
+            {"$group": {"_id": "$strategy_id", "created_at": {"$min": "$created_at"}}}
+        ]).to_list(None)
+    }
+
+    rows = await db.transactions.aggregate([
+        {"$match": {"strategy_id": {"$ne": None}, "trade_details.profit_loss_percentage": {"$exists": True}}},
+        {"$group": {
+            "_id": {
+                "strategy_id": "$strategy_id",
+                "created_at": "$created_at",
+                "date": "$trade_details.date",
+                "transaction_type": "$trade_details.transaction_type",
+                "trade_details": "$trade_details.trade_details",
+            },
+            "profit_loss_percentage": {"$first": "$trade_details.profit_loss_percentage"},
+            "subscribers": {"$sum": 1},
+        }},
+    ], allowDiskUse=True).to_list(None)
+
+    documents = []
+    for row in rows:
+        key = row["_id"]
+        created_at = key["created_at"]
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        covered_from = first.get(key["strategy_id"])
+        if covered_from is not None and created_at >= covered_from.replace(tzinfo=timezone.utc):
+            continue
+        date = pd.to_datetime(key.get("date"), errors="coerce", utc=True)
+        documents.append({
+            "date": created_at if pd.isna(date) else date.to_pydatetime(),
+            "strategy_id": key["strategy_id"],
+            "upload_id": f"backfill:{created_at.isoformat()}",
+            "transaction_type": key.get("transaction_type"),
+            "trade_details": key.get("trade_details"),
+            "profit_loss_percentage": float(row["profit_loss_percentage"]),
+            "subscribers": row["subscribers"],
+            "created_at": created_at,
+        })
+
+    if documents and not dry_run:
+        await db.strategy_results.insert_many(documents, ordered=False)
+        await db.catalog_versions.update_one({"_id": "results"}, {"$inc": {"version": 1}}, upsert=True)
+    return len(rows), len(documents), len(rows) - len(documents)
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill strategy_results from ledger copies")
+    parser.add_argument("--dry-run", action="store_true", help="count rows without writing")
+    args = parser.parse_args()
+
+    started = datetime.now(timezone.utc)
+    grouped, written, covered = asyncio.run(backfill(args.dry_run))
+    elapsed = (datetime.now(timezone.utc) - started).total_seconds()
+    verb = "Would write" if args.dry_run else "Wrote"
+    print(
+        f"{verb} {written} strategy results from {grouped} grouped ledger rows in {elapsed:.1f}s "
+        f"({covered} already in strategy_results)"
+    )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
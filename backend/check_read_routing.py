@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Show which replica set member serves each read class.
+
+Run against a local multi-node replica set, e.g. MONGO_URL=
+"mongodb://localhost:27017,localhost:27018,localhost:27019/?replicaSet=rs0",
+optionally with READ_ROUTING set to the configuration under test.
+"""
+import asyncio
+
+from pymongo import monitoring
+
+class CommandAddresses(monitoring.CommandListener):
+    def __init__(self):
+        self.addresses = {}
+
+    def started(self, event):
+        self.addresses[event.request_id] = event.connection_id
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+listener = CommandAddresses()
+# Must be registered before server.py creates its client
+monitoring.register(listener)
+
+from server import READ_ROUTING, client, db, reader  # noqa: E402
+
+PROBES = {
+    "catalog": "strategies",
+    "history": "transactions",
+    "admin": "users",
+    "primary": "users",
+}
+
+async def main():
+    await db.command("ping")
+    # Topology properties; the ping above has already discovered the members
+    primary = client.primary
+    secondaries = client.secondaries
+    print(f"primary:     {primary}")
+    print(f"secondaries: {sorted(secondaries)}\n")
+
+    for read_class, collection in PROBES.items():
+        handle = db if read_class == "primary" else reader(read_class)
+        listener.addresses.clear()
+        await handle[collection].find_one({})
+        address = next(iter(listener.addresses.values()))
+        role = "primary" if address == primary else "secondary" if address in secondaries else "unknown"
+        mode = READ_ROUTING.get(read_class, "primary")
+        print(f"{read_class:8} {mode:20} -> {address[0]}:{address[1]} ({role})")
+
+if __name__ == "__main__":
+    asyncio.run(main())
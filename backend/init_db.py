@@ -184,6 +184,7 @@ async def init_database():
     existing_strategies = await db.strategies.count_documents({})
     if existing_strategies == 0:
         await db.strategies.insert_many(strategies)
+        await db.catalog_versions.update_one({"_id": "strategies"}, {"$inc": {"version": 1}}, upsert=True)
         print(f"✓ Created {len(strategies)} sample strategies")
     else:
         print("✓ Strategies already exist")
@@ -246,6 +247,7 @@ async def init_database():
     existing_coupons = await db.coupons.count_documents({})
     if existing_coupons == 0:
         await db.coupons.insert_many(coupons)
+        await db.catalog_versions.update_one({"_id": "coupons"}, {"$inc": {"version": 1}}, upsert=True)
         print(f"✓ Created {len(coupons)} sample coupons")
     else:
         print("✓ Coupons already exist")
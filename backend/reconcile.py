@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Reconcile stored user balances against the ledger.
+
+Users are split into id ranges; for each range the ledger deltas are summed with
+a $group pipeline and added to the opening balance snapshot, then compared with
+the balances stored on the user documents. Ranges are processed concurrently
+with a bounded number of in-flight partitions. A user whose ledger has a seq
+gap is skipped as in flight while its last balance change is recent or its
+accrual run is unfinished; older gaps are reported as missing ledger rows.
+
+Usage:
+    python reconcile.py [--partitions 256] [--concurrency 8] [--report drift.json] [--repair]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from server import BALANCE_FIELDS, LEDGER_MAX_LAG_SECONDS, db
+
+TOLERANCE = 1e-6
+
+PARTITION_ID_WIDTH = 4
+MAX_PARTITIONS = 16 ** PARTITION_ID_WIDTH
+
+def partition_bounds(partitions: int):
+    """Split the lowercase-hex id space (uuid4 ids) into contiguous ranges.
+
+    The first and last ranges are open-ended so ids outside the hex alphabet
+    are still covered. partitions must be between 1 and MAX_PARTITIONS.
+    """
+    width = PARTITION_ID_WIDTH
+    span = 16 ** width // partitions
+    bounds = []
+    for i in range(partitions):
+        lo = None if i == 0 else f"{i * span:0{width}x}"
+        hi = None if i == partitions - 1 else f"{(i + 1) * span:0{width}x}"
+        bounds.append((lo, hi))
+    return bounds
+
+def id_range(lo, hi):
+    condition = {}
+    if lo is not None:
+        condition["$gte"] = lo
+    if hi is not None:
+        condition["$lt"] = hi
+    return condition or {"$exists": True}
+
+def aware(moment):
+    return moment.replace(tzinfo=timezone.utc) if moment is not None and moment.tzinfo is None else moment
+
+async def reconcile_partition(lo, hi, repair: bool, unfinished_accruals: set):
+    user_range = id_range(lo, hi)
+
+    ledger_totals = await db.transactions.aggregate([
+        {"$match": {"user_id": user_range, "seq": {"$exists": True}}},
+        {"$group": {
+            "_id": "$user_id",
+            "seq": {"$max": "$seq"},
+            "entries": {"$sum": 1},
+            **{field: {"$sum": f"$deltas.{field}"} for field in BALANCE_FIELDS}
+        }}
+    ], allowDiskUse=True).to_list(None)
+    ledger = {row["_id"]: row for row in ledger_totals}
+
+    openings = await db.balance_snapshots.find(
+        {"user_id": user_range, "seq": 0},
+        {"_id": 0, "user_id": 1, "balances": 1}
+    ).to_list(None)
+    opening = {row["user_id"]: row["balances"] for row in openings}
+
+    users = await db.users.find(
+        {"id": user_range, "ledger_seq": {"$gte": 1}},
+        {"_id": 0, "id": 1, "ledger_seq": 1, "ledger_updated_at": 1, "last_accrual.date": 1, **{field: 1 for field in BALANCE_FIELDS}}
+    ).to_list(None)
+
+    settled_before = datetime.now(timezone.utc) - timedelta(seconds=LEDGER_MAX_LAG_SECONDS)
+    stats = {"users": len(users), "matched": 0, "drifted": 0, "in_flight": 0, "missing": 0, "repaired": 0}
+    drifts = []
+    for user in users:
+        user_id = user["id"]
+        totals = ledger.get(user_id)
+        if user_id not in opening or totals is None:
+            stats["drifted"] += 1
+            drifts.append({"user_id": user_id, "seq": user["ledger_seq"], "error": "missing ledger history"})
+            continue
+        # Totals start from the seq 0 opening snapshot, so every seq up to ledger_seq must be present
+        missing_entries = user["ledger_seq"] - totals["entries"]
+        if missing_entries:
+            updated_at = aware(user.get("ledger_updated_at"))
+            if (updated_at is not None and updated_at > settled_before) or \
+                    (user.get("last_accrual") or {}).get("date") in unfinished_accruals:
+                # A ledger row for this user has not landed yet; check it next run
+                stats["in_flight"] += 1
+                continue
+            # Older gaps are rows that were never written; their deltas show up as drift
+            stats["missing"] += 1
+
+        drift = {}
+        for field in BALANCE_FIELDS:
+            expected = opening[user_id].get(field, 0.0) + totals[field]
+            difference = expected - user.get(field, 0.0)
+            if abs(difference) > TOLERANCE:
+                drift[field] = difference
+        if not drift:
+            if missing_entries:
+                drifts.append({"user_id": user_id, "seq": user["ledger_seq"], "error": "missing ledger rows",
+                               "missing_entries": missing_entries, "drift": drift, "repaired": False})
+            else:
+                stats["matched"] += 1
+            continue
+
+        stats["drifted"] += 1
+        entry = {"user_id": user_id, "seq": user["ledger_seq"], "drift": drift, "repaired": False}
+        if missing_entries:
+            entry.update({"error": "missing ledger rows", "missing_entries": missing_entries})
+        if repair:
+            result = await db.users.update_one(
+                {"id": user_id, "ledger_seq": user["ledger_seq"]},
+                {"$inc": drift}
+            )
+            entry["repaired"] = result.modified_count == 1
+            stats["repaired"] += result.modified_count
+        drifts.append(entry)
+
+    return stats, drifts
+
+async def reconcile(partitions: int, concurrency: int, repair: bool):
+    semaphore = asyncio.Semaphore(concurrency)
+    done = 0
+    # Users of an unfinished accrual run get their ledger rows when it resumes
+    unfinished_accruals = set(await db.accrual_runs.distinct("_id", {"status": {"$ne": "completed"}}))
+
+    async def run(lo, hi):
+        nonlocal done
+        async with semaphore:
+            result = await reconcile_partition(lo, hi, repair, unfinished_accruals)
+        done += 1
+        if done % max(1, partitions // 20) == 0:
+            print(f"  {done}/{partitions} partitions", file=sys.stderr)
+        return result
+
+    results = await asyncio.gather(*(run(lo, hi) for lo, hi in partition_bounds(partitions)))
+
+    totals = {"users": 0, "matched": 0, "drifted": 0, "in_flight": 0, "missing": 0, "repaired": 0}
+    drifts = []
+    for stats, partition_drifts in results:
+        for key, value in stats.items():
+            totals[key] += value
+        drifts.extend(partition_drifts)
+    return totals, drifts
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile user balances against the ledger")
+    parser.add_argument("--partitions", type=int, default=256, help="number of user id ranges")
+    parser.add_argument("--concurrency", type=int, default=8, help="partitions processed at once")
+    parser.add_argument("--report", default=None, help="path of the JSON drift report")
+    parser.add_argument("--repair", action="store_true", help="correct drifted balances in place")
+    args = parser.parse_args()
+    if not 1 <= args.partitions <= MAX_PARTITIONS:
+        parser.error(f"--partitions must be between 1 and {MAX_PARTITIONS}")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+
+    started = time.monotonic()
+    totals, drifts = asyncio.run(reconcile(args.partitions, args.concurrency, args.repair))
+    elapsed = time.monotonic() - started
+
+    report = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "elapsed_seconds": round(elapsed, 2),
+        "repair": args.repair,
+        **totals,
+        "drifts": drifts,
+    }
+    report_path = args.report or f"reconciliation_{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.json"
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(
+        f"Reconciled {totals['users']} users in {elapsed:.1f}s: {totals['matched']} matched, "
+        f"{totals['drifted']} drifted, {totals['in_flight']} in flight, {totals['missing']} missing ledger rows, "
+        f"{totals['repaired']} repaired"
+    )
+    print(f"Report written to {report_path}")
+    return 1 if totals["drifted"] > totals["repaired"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Replay traffic captured with TRAFFIC_CAPTURE_FILE against a local instance.
+
+Captured records carry route templates and body shapes only, so requests are
+rebuilt from local data: path parameters and id fields are filled with ids of
+the local user, strategies and coupons, credentials with the accounts given on
+the command line, and remaining fields with placeholders of the recorded type.
+Requests are sent on the recorded schedule scaled by --speed (open loop), or as
+fast as --concurrency allows with --speed max. Latency percentiles per route are
+printed next to the latencies recorded in production.
+
+Usage:
+    python replay_traffic.py capture.jsonl.gz --email user@example.com --password secret
+        [--admin-email admin@example.com --admin-password secret]
+        [--base-url http://localhost:8001] [--speed 1|10|max] [--concurrency 256]
+        [--report replay.json]
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import random
+import re
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+import httpx
+
+PATH_PARAM = re.compile(r"\{([^}]+)\}")
+
+def load_capture(path: str):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    # Unmatched paths (404s) cannot be rebuilt from a template
+    records = [record for record in records if record.get("r")]
+    records.sort(key=lambda record: record["t"])
+    return records
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda q: round(values[min(len(values) - 1, int(len(values) * q))], 2)
+    return {"count": len(values), "p50": pick(0.50), "p90": pick(0.90), "p99": pick(0.99), "max": round(values[-1], 2)}
+
+class LocalFixtures:
+    """Ids and tokens of the local instance used to fill captured requests"""
+
+    def __init__(self, args):
+        self.args = args
+        self.user_token = None
+        self.admin_token = None
+        self.user_id = None
+        self.strategy_ids = []
+        self.strategy_names = []
+        self.coupon_ids = []
+
+    async def load(self, client: httpx.AsyncClient):
+        self.user_token, user = await self.login(client, self.args.email, self.args.password)
+        self.user_id = user["id"]
+        if self.args.admin_email:
+            self.admin_token, _ = await self.login(client, self.args.admin_email, self.args.admin_password)
+
+        headers = {"Authorization": f"Bearer {self.user_token}"}
+        strategies = (await client.get("/api/strategies", headers=headers)).json()
+        coupons = (await client.get("/api/coupons", headers=headers)).json()
+        self.strategy_ids = [strategy["id"] for strategy in strategies] or ["replay"]
+        self.strategy_names = [strategy["name"] for strategy in strategies] or ["replay"]
+        self.coupon_ids = [coupon["id"] for coupon in coupons] or ["replay"]
+
+    async def login(self, client: httpx.AsyncClient, email: str, password: str):
+        response = await client.post("/api/auth/login", json={"email": email, "password": password})
+        response.raise_for_status()
+        data = response.json()
+        return data["access_token"], data["user"]
+
+    def field(self, name: str, kind):
+        """Placeholder value for a captured field of the given shape"""
+        if isinstance(kind, dict):
+            return {key: self.field(key, value) for key, value in kind.items()}
+        if isinstance(kind, list):
+            return [self.field(name, kind[0])] if kind else []
+        if kind == "num":
+            return 1
+        if kind == "bool":
+            return False
+        if kind == "null":
+            return None
+        if name in ("email", "user_email"):
+            return self.args.email
+        if name in ("password", "new_password"):
+            return self.args.password
+        if name == "user_id":
+            return self.user_id
+        if name == "strategy_id":
+            return random.choice(self.strategy_ids)
+        if name == "coupon_id":
+            return random.choice(self.coupon_ids)
+        if name == "transaction_id":
+            return str(uuid.uuid4())
+        if name == "amount":
+            return "10"  # form fields are captured as strings
+        if name == "otp":
+            return "000000"
+        if name == "phone_number":
+            return "0000000000"
+        return "replay"
+
+    def path(self, route: str) -> str:
+        def fill(match):
+            name = match.group(1)
+            if name == "user_id":
+                return self.user_id
+            if name == "strategy_id":
+                return random.choice(self.strategy_ids)
+            return "replay"
+        return PATH_PARAM.sub(fill, route)
+
+    def trading_results_csv(self, size: int) -> bytes:
+        header = "Date,TransactionType,StrategyName,TradeDetails,ProfitLossPercentage\n"
+        rows = [header]
+        length = len(header)
+        while length < max(size, 200):
+            row = f"{datetime.now(timezone.utc):%Y-%m-%d},BUY,{random.choice(self.strategy_names)},replay,0.1\n"
+            rows.append(row)
+            length += len(row)
+        return "".join(rows).encode()
+
+    def request(self, record):
+        """Keyword arguments for httpx.AsyncClient.request rebuilt from a record"""
+        route, shape = record["r"], record.get("b")
+        request = {"method": record["m"], "url": self.path(route), "headers": {}}
+        if record.get("a"):
+            admin_route = route.startswith("/api/admin/") or (record["m"] == "POST" and route == "/api/strategies")
+            token = self.admin_token if admin_route and self.admin_token else self.user_token
+            request["headers"]["Authorization"] = f"Bearer {token}"
+        if record.get("k"):
+            request["headers"]["Idempotency-Key"] = str(uuid.uuid4())
+        if record.get("q"):
+            request["params"] = {name: "1" for name in record["q"]}
+
+        content_type = record.get("c", "")
+        if not isinstance(shape, dict):
+            return request
+        if content_type == "application/json":
+            request["json"] = self.field("", shape)
+        elif content_type in ("multipart/form-data", "application/x-www-form-urlencoded"):
+            request["data"] = {name: str(self.field(name, kind)) for name, kind in shape.items() if kind != "file"}
+            files = [name for name, kind in shape.items() if kind == "file"]
+            if files:
+                request["files"] = {name: ("replay.csv", self.trading_results_csv(record.get("n", 0)), "text/csv") for name in files}
+        return request
+
+async def replay(args):
+    records = load_capture(args.capture)
+    if not records:
+        print("No replayable records in capture", file=sys.stderr)
+        return None
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        fixtures = LocalFixtures(args)
+        await fixtures.load(client)
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        results = []
+
+        async def send(record, slot: bool):
+            started = time.perf_counter()
+            try:
+                response = await client.request(**fixtures.request(record))
+                status_code = response.status_code
+            except httpx.HTTPError as e:
+                status_code = type(e).__name__
+            finally:
+                if slot:
+                    semaphore.release()
+            results.append((record, status_code, (time.perf_counter() - started) * 1000))
+
+        speed = None if args.speed == "max" else float(args.speed)
+        first = records[0]["t"]
+        started = time.monotonic()
+        tasks = []
+        for record in records:
+            if speed is not None:
+                delay = (record["t"] - first) / 1000 / speed - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                # Closed loop: hold a slot per request in flight; send releases it
+                await semaphore.acquire()
+            tasks.append(asyncio.create_task(send(record, speed is None)))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - started
+
+    by_route = {}
+    for record, status_code, latency in results:
+        entry = by_route.setdefault(f"{record['m']} {record['r']}", {"replayed": [], "recorded": [], "status": {}})
+        entry["replayed"].append(latency)
+        if record.get("d") is not None:
+            entry["recorded"].append(record["d"])
+        entry["status"][str(status_code)] = entry["status"].get(str(status_code), 0) + 1
+
+    return {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "capture": args.capture,
+        "base_url": args.base_url,
+        "speed": args.speed,
+        "requests": len(results),
+        "elapsed_seconds": round(elapsed, 2),
+        "throughput_rps": round(len(results) / elapsed, 1) if elapsed else None,
+        "latency_ms": percentiles([latency for _, _, latency in results]),
+        "routes": {
+            route: {
+                "replayed_ms": percentiles(entry["replayed"]),
+                "recorded_ms": percentiles(entry["recorded"]),
+                "status": entry["status"],
+            }
+            for route, entry in sorted(by_route.items())
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic against a local instance")
+    parser.add_argument("capture", help="file written by TRAFFIC_CAPTURE_FILE")
+    parser.add_argument("--base-url", default="http://localhost:8001")
+    parser.add_argument("--speed", default="1", help="schedule multiplier (1, 10, ...) or max")
+    parser.add_argument("--concurrency", type=int, default=256, help="requests in flight at most")
+    parser.add_argument("--timeout", type=float, default=30.0, help="per-request timeout in seconds")
+    parser.add_argument("--email", required=True, help="local account used for authenticated requests")
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--admin-email", default=None, help="local admin account for admin routes")
+    parser.add_argument("--admin-password", default=None)
+    parser.add_argument("--report", default=None, help="path of the JSON latency report")
+    args = parser.parse_args()
+
+    report = asyncio.run(replay(args))
+    if report is None:
+        return 1
+
+    report_path = args.report or f"replay_{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.json"
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    overall = report["latency_ms"]
+    print(
+        f"Replayed {report['requests']} requests in {report['elapsed_seconds']}s "
+        f"({report['throughput_rps']} req/s): p50 {overall['p50']} ms, p90 {overall['p90']} ms, "
+        f"p99 {overall['p99']} ms, max {overall['max']} ms"
+    )
+    print(f"{'route':48} {'count':>6} {'p50':>8} {'p99':>8} {'rec p50':>8} {'rec p99':>8}  status")
+    for route, entry in report["routes"].items():
+        replayed, recorded = entry["replayed_ms"], entry["recorded_ms"]
+        print(
+            f"{route:48} {replayed['count']:>6} {replayed['p50']:>8} {replayed['p99']:>8} "
+            f"{recorded.get('p50', '-'):>8} {recorded.get('p99', '-'):>8}  {entry['status']}"
+        )
+    print(f"Report written to {report_path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
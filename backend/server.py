@@ -1,19 +1,41 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, Request, Response, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, Query, Request, Response, WebSocket, WebSocketDisconnect, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, DeleteOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.read_preferences import read_pref_mode_from_name, make_read_preference
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
-from datetime import datetime, timezone, timedelta
+from typing import List, Optional, Dict, Any, Callable, Awaitable
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import Context, ContextVar
+from datetime import date, datetime, timezone, timedelta
 from passlib.context import CryptContext
 import jwt
 import uuid
+import asyncio
+import time
+import math
+import threading
+import multiprocessing
+import sys
 import os
 import logging
 from pathlib import Path
+from urllib.parse import parse_qs
 from enum import Enum
 import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 import io
+import base64
+import json
+import re
+import gzip
+import hashlib
 import requests
 from dotenv import load_dotenv
 import pyotp
@@ -22,6 +44,12 @@ import random
 import string
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
+from simulation import SIMULATION_PERCENTILES, simulate_paths
+
+try:
+    import brotli
+except ImportError:  # optional: responses fall back to gzip
+    brotli = None
 
 # Load environment variables
 ROOT_DIR = Path(__file__).parent
@@ -39,11 +67,465 @@ FROM_EMAIL = os.getenv('FROM_EMAIL', 'noreply@tradeict.com')
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Tracing
+# OpenTelemetry-compatible spans: one SERVER span per request (continuing an
+# valid incoming W3C traceparent) with child spans for Mongo commands, bcrypt, outbound
+# HTTP and pandas parsing. Finished spans are batched and exported as OTLP/JSON,
+# either appended to TRACE_FILE (one export request per line, readable by the
+# collector's otlpjsonfile receiver) or POSTed to OTLP_ENDPOINT/v1/traces.
+# TRACE_EXPORTER unset disables tracing; no spans are created then.
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', '')  # "", "file" or "otlp"
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+OTLP_ENDPOINT = os.getenv('OTLP_ENDPOINT', 'http://localhost:4318')
+TRACE_SAMPLE_RATIO = float(os.getenv('TRACE_SAMPLE_RATIO', '1.0'))
+TRACE_EXPORT_INTERVAL_SECONDS = 2
+TRACE_MAX_PENDING = 50_000
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'tradeict-backend')
+
+# version-traceid-parentid-flags; later versions may append fields
+TRACEPARENT_PATTERN = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$")
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+current_span: ContextVar = ContextVar("current_span", default=None)
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], name: str, kind: int, attributes: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": otlp_value(value)} for key, value in self.attributes.items()],
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error:
+            span["status"] = {"code": 2, "message": self.error}
+        return span
+
+def otlp_value(value) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def parse_traceparent(value: str) -> Optional[tuple]:
+    """(trace_id, parent_id, flags) of a valid W3C traceparent, else None"""
+    match = TRACEPARENT_PATTERN.match(value.strip())
+    if match is None:
+        return None
+    version, trace_id, parent_id, flags, extra = match.groups()
+    if version == "ff" or (version == "00" and extra is not None):
+        return None
+    if trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, int(flags, 16)
+
+class Tracer:
+    def __init__(self, exporter: str, sample_ratio: float):
+        self.exporter = exporter
+        self.enabled = exporter in ("file", "otlp")
+        self.sample_ratio = sample_ratio
+        self.pending: deque = deque(maxlen=TRACE_MAX_PENDING)
+        self.exported = 0
+        self.failed = 0
+
+    def start_request(self, scope) -> Optional[Span]:
+        """Root span of a request, or None when the trace is not sampled"""
+        traceparent = parse_traceparent(dict(scope["headers"]).get(b"traceparent", b"").decode("latin-1"))
+        if traceparent is not None:
+            trace_id, parent_id, flags = traceparent
+            if not flags & 1:
+                return None
+        else:
+            if random.random() >= self.sample_ratio:
+                return None
+            trace_id, parent_id = f"{random.getrandbits(128):032x}", None
+        return Span(trace_id, parent_id, f"{scope['method']} {scope['path']}", SPAN_KIND_SERVER, {
+            "http.method": scope["method"],
+            "http.target": scope["path"],
+        })
+
+    def record(self, span: Span):
+        # Called from executor threads as well; deque appends are thread-safe
+        self.pending.append(span)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL_SECONDS)
+            await self.flush()
+
+    async def flush(self):
+        spans = []
+        while self.pending:
+            spans.append(self.pending.popleft())
+        if not spans:
+            return
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "server"}, "spans": [span.to_otlp() for span in spans]}]
+        }]}
+        try:
+            await asyncio.to_thread(self.export, payload)
+            self.exported += len(spans)
+        except Exception as e:
+            self.failed += len(spans)
+            logger.error(f"Failed to export {len(spans)} spans: {e}")
+
+    def export(self, payload: Dict[str, Any]):
+        if self.exporter == "file":
+            with open(TRACE_FILE, "a") as f:
+                f.write(json.dumps(payload) + "\n")
+        else:
+            requests.post(f"{OTLP_ENDPOINT}/v1/traces", json=payload, timeout=10).raise_for_status()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "exporter": self.exporter or None,
+            "sample_ratio": self.sample_ratio,
+            "pending": len(self.pending),
+            "exported": self.exported,
+            "failed": self.failed,
+        }
+
+tracer = Tracer(TRACE_EXPORTER, TRACE_SAMPLE_RATIO)
+
+@contextmanager
+def trace_span(name: str, kind: int = SPAN_KIND_INTERNAL, **attributes):
+    """Child span of the current request span; a no-op outside traced requests"""
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = Span(parent.trace_id, parent.span_id, name, kind, attributes)
+    token = current_span.set(span)
+    error = None
+    try:
+        yield span
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        current_span.reset(token)
+        span.finish(error)
+        tracer.record(span)
+
+class TraceCommandListener(monitoring.CommandListener):
+    """A CLIENT span per Mongo command, parented to the span that issued it"""
+
+    def __init__(self):
+        self.open: Dict[tuple, Span] = {}
+
+    def started(self, event):
+        parent = current_span.get()
+        if parent is None:
+            return
+        collection = event.command.get(event.command_name)
+        self.open[(event.connection_id, event.request_id)] = Span(
+            parent.trace_id, parent.span_id, f"mongo.{event.command_name}", SPAN_KIND_CLIENT, {
+                "db.system": "mongodb",
+                "db.name": event.database_name,
+                "db.operation": event.command_name,
+                "db.mongodb.collection": collection if isinstance(collection, str) else "",
+            }
+        )
+
+    def succeeded(self, event):
+        span = self.open.pop((event.connection_id, event.request_id), None)
+        if span is not None:
+            span.finish()
+            tracer.record(span)
+
+    def failed(self, event):
+        span = self.open.pop((event.connection_id, event.request_id), None)
+        if span is not None:
+            span.finish(RuntimeError(event.failure.get("errmsg", "command failed")))
+            tracer.record(span)
+
+class TracingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not tracer.enabled:
+            return await self.app(scope, receive, send)
+        span = tracer.start_request(scope)
+        if span is None:
+            return await self.app(scope, receive, send)
+
+        async def send_traced(message):
+            if message["type"] == "http.response.start":
+                span.attributes["http.status_code"] = message["status"]
+                if message["status"] >= 500:
+                    span.error = f"HTTP {message['status']}"
+            await send(message)
+
+        token = current_span.set(span)
+        error = None
+        try:
+            await self.app(scope, receive, send_traced)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            current_span.reset(token)
+            route = scope.get("route")
+            if route is not None:
+                span.name = f"{scope['method']} {route.path}"
+                span.attributes["http.route"] = route.path
+            span.finish(error)
+            tracer.record(span)
+
 # MongoDB connection
+# Pool settings come from the environment so they can be sized per uvicorn worker
+# count; unset variables keep the driver defaults.
+MONGO_POOL_ENV = {
+    "maxPoolSize": ("MONGO_MAX_POOL_SIZE", int),
+    "minPoolSize": ("MONGO_MIN_POOL_SIZE", int),
+    "maxIdleTimeMS": ("MONGO_MAX_IDLE_TIME_MS", int),
+    "waitQueueTimeoutMS": ("MONGO_WAIT_QUEUE_TIMEOUT_MS", int),
+    "maxConnecting": ("MONGO_MAX_CONNECTING", int),
+    "compressors": ("MONGO_COMPRESSORS", str),  # e.g. "zstd,zlib"
+}
+
+def mongo_pool_options() -> Dict[str, Any]:
+    options = {}
+    for option, (variable, parse) in MONGO_POOL_ENV.items():
+        value = os.getenv(variable)
+        if value:
+            options[option] = parse(value)
+    return options
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Connection pool counters per server, fed by driver events from executor threads."""
+
+    def __init__(self, sample_size: int = 1000):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.servers: Dict[str, Dict[str, Any]] = {}
+        self.waits: Dict[str, deque] = {}
+        self.sample_size = sample_size
+
+    def server(self, address) -> Dict[str, Any]:
+        key = f"{address[0]}:{address[1]}"
+        if key not in self.servers:
+            self.servers[key] = {"open": 0, "in_use": 0, "checkouts": 0, "checkout_failures": 0, "pool_clears": 0}
+            self.waits[key] = deque(maxlen=self.sample_size)
+        return self.servers[key]
+
+    def connection_created(self, event):
+        with self.lock:
+            self.server(event.address)["open"] += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.server(event.address)["open"] -= 1
+
+    def connection_check_out_started(self, event):
+        # Check-out runs synchronously on the calling thread
+        self.local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        waited = time.perf_counter() - getattr(self.local, "started", time.perf_counter())
+        with self.lock:
+            stats = self.server(event.address)
+            stats["in_use"] += 1
+            stats["checkouts"] += 1
+            self.waits[f"{event.address[0]}:{event.address[1]}"].append(waited)
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.server(event.address)["checkout_failures"] += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.server(event.address)["in_use"] -= 1
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.server(event.address)["pool_clears"] += 1
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+
+    def snapshot(self, max_pool_size: int) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            result = {}
+            for key, stats in self.servers.items():
+                waits = sorted(self.waits[key])
+                result[key] = {
+                    **stats,
+                    "available": max(max_pool_size - stats["in_use"], 0),
+                    "checkout_wait_ms": {
+                        "avg": round(sum(waits) / len(waits) * 1000, 3) if waits else 0.0,
+                        "p95": round(waits[int(len(waits) * 0.95)] * 1000, 3) if waits else 0.0,
+                        "max": round(waits[-1] * 1000, 3) if waits else 0.0,
+                    }
+                }
+            return result
+
+pool_monitor = PoolMonitor()
+
+# Set only while a request is being profiled (see Profiling)
+active_profile: ContextVar = ContextVar("active_profile", default=None)
+
+class ProfileCommandListener(monitoring.CommandListener):
+    """Adds command time to the profile of the request that issued it.
+
+    Motor runs commands on executor threads with a copy of the caller's context,
+    so active_profile resolves to the issuing request.
+    """
+
+    def started(self, event): pass
+
+    def succeeded(self, event):
+        profile = active_profile.get()
+        if profile is not None:
+            profile.add_mongo(event.command_name, event.duration_micros)
+
+    def failed(self, event):
+        self.succeeded(event)
+
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+command_listeners = [ProfileCommandListener()] + ([TraceCommandListener()] if tracer.enabled else [])
+client = AsyncIOMotorClient(mongo_url, event_listeners=[pool_monitor, *command_listeners], **mongo_pool_options())
 db = client[os.environ['DB_NAME']]
 
+# Read routing
+# Reads that tolerate bounded staleness are sent according to their read class;
+# everything else, including every read on a money-moving path, uses `db` (primary).
+# READ_ROUTING overrides the defaults, e.g. "catalog=secondary,history=primary".
+READ_ROUTING_DEFAULTS = {
+    "catalog": "secondaryPreferred",   # strategies, coupons
+    "history": "secondaryPreferred",   # transaction history
+    "admin": "secondaryPreferred",     # admin listings
+}
+READ_MAX_STALENESS_SECONDS = int(os.getenv('READ_MAX_STALENESS_SECONDS', '90'))  # MongoDB minimum is 90
+
+def parse_read_routing(value: str) -> Dict[str, str]:
+    routing = dict(READ_ROUTING_DEFAULTS)
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        read_class, _, mode = item.partition('=')
+        routing[read_class.strip()] = mode.strip()
+    return routing
+
+READ_ROUTING = parse_read_routing(os.getenv('READ_ROUTING', ''))
+
+def routed_database(mode_name: str):
+    mode = read_pref_mode_from_name(mode_name)
+    max_staleness = READ_MAX_STALENESS_SECONDS if mode_name != "primary" else -1
+    return client.get_database(
+        os.environ['DB_NAME'],
+        read_preference=make_read_preference(mode, tag_sets=None, max_staleness=max_staleness)
+    )
+
+read_databases = {read_class: routed_database(mode) for read_class, mode in READ_ROUTING.items()}
+
+def reader(read_class: str):
+    """Database handle for a read class; unknown classes read from the primary."""
+    return read_databases.get(read_class, db)
+
+# Request coalescing
+# Concurrent identical reads share one query: the first caller for a key starts
+# it and later callers await the same task until it completes. Only in-flight
+# work is shared, nothing is cached afterwards. Shared results must be treated
+# as read-only by callers.
+class SingleFlight:
+    def __init__(self):
+        self.in_flight: Dict[Any, asyncio.Future] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn: Callable[[], Awaitable[Any]]):
+        task = self.in_flight.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.ensure_future(fn())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda done: self.finished(key, done))
+        else:
+            self.coalesced += 1
+        # A cancelled caller must not cancel the query the others are waiting on
+        return await asyncio.shield(task)
+
+    def finished(self, key, task: asyncio.Future):
+        self.in_flight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every caller went away
+
+    def metrics(self) -> Dict[str, int]:
+        return {"in_flight": len(self.in_flight), "started": self.started, "coalesced": self.coalesced}
+
+singleflight = SingleFlight()
+
+class TTLCache:
+    """Per-worker LRU of values that expire after ttl_seconds"""
+
+    def __init__(self, size: int, ttl_seconds: float):
+        self.size = size
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[Any, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def metrics(self) -> Dict[str, int]:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+def active_catalog(name: str, projection: Optional[Dict[str, int]] = None, limit: int = 1000):
+    """Active strategies or coupons, coalesced across concurrent requests"""
+    projection = projection or {"_id": 0}
+    return singleflight.do(
+        ("catalog", name, tuple(projection.items()), limit),
+        lambda: reader("catalog")[name].find({"is_active": True}, projection).to_list(limit)
+    )
+
 # Create the main app
 app = FastAPI(title="Tradeict Trading Simulation API")
 api_router = APIRouter(prefix="/api")
@@ -95,6 +577,10 @@ class User(BaseModel):
     last_daily_login: Optional[datetime] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     last_login: Optional[datetime] = None
+    ledger_seq: int = 0               # Seq of the user's latest ledger entry
+
+    def balances(self) -> Dict[str, float]:
+        return {field: getattr(self, field) for field in BALANCE_FIELDS}
 
 class UserCreate(BaseModel):
     email: EmailStr
@@ -146,6 +632,10 @@ class StrategyCreate(BaseModel):
     capital_required: float
     logic_description: str
 
+class SimulationRequest(BaseModel):
+    amount: float = Field(gt=0)
+    horizon_days: int = Field(30, ge=1, le=365)
+
 class UserStrategy(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
@@ -166,6 +656,23 @@ class Transaction(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     trade_details: Optional[Dict[str, Any]] = None
 
+def ledger_document(user_id: str, transaction_type: TransactionType, amount: float, description: str,
+                    virtual_money_type: VirtualMoneyType = VirtualMoneyType.INITIAL,
+                    strategy_id: Optional[str] = None, trade_details: Optional[Dict[str, Any]] = None,
+                    created_at: Optional[datetime] = None, id: Optional[str] = None) -> Dict[str, Any]:
+    """Build a BSON-ready transaction document with the same shape as ``Transaction.dict()``."""
+    return {
+        "id": id or str(uuid.uuid4()),
+        "user_id": user_id,
+        "strategy_id": strategy_id,
+        "transaction_type": transaction_type.value,
+        "amount": amount,
+        "description": description,
+        "virtual_money_type": virtual_money_type.value,
+        "created_at": created_at or datetime.now(timezone.utc),
+        "trade_details": trade_details,
+    }
+
 class Coupon(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     title: str
@@ -229,10 +736,12 @@ otp_storage = {}
 
 # Helper Functions
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    with trace_span("bcrypt.verify"):
+        return pwd_context.verify(plain_password, hashed_password)
 
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    with trace_span("bcrypt.hash"):
+        return pwd_context.hash(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -270,8 +779,11 @@ async def send_otp_email(email: str, otp: str, purpose: str) -> bool:
             ''')
 
         if SENDGRID_API_KEY != 'your-sendgrid-key':
-            sg = SendGridAPIClient(SENDGRID_API_KEY)
-            response = sg.send(message)
+            with trace_span("POST sendgrid /v3/mail/send", SPAN_KIND_CLIENT, **{"http.method": "POST", "peer.service": "sendgrid"}) as span:
+                sg = SendGridAPIClient(SENDGRID_API_KEY)
+                response = sg.send(message)
+                if span:
+                    span.attributes["http.status_code"] = response.status_code
             return response.status_code == 202
         else:
             # For development, just log the OTP
@@ -281,23 +793,971 @@ async def send_otp_email(email: str, otp: str, purpose: str) -> bool:
         print(f"Failed to send email: {e}")
         return False
 
+# Ledger
+# Every balance change bumps users.ledger_seq and appends a transaction carrying
+# that seq and the per-field deltas. Every LEDGER_SNAPSHOT_INTERVAL entries the
+# resulting balances are stored in balance_snapshots, so any historical balance
+# is the nearest snapshot plus a short tail of deltas.
+BALANCE_FIELDS = ("virtual_balance", "earnings_balance", "task_balance", "total_investment")
+LEDGER_SNAPSHOT_INTERVAL = int(os.getenv('LEDGER_SNAPSHOT_INTERVAL', '100'))
+
+# Ledger rows are inserted in groups: concurrent requests share one insert_many
+# instead of paying a round trip each. A flush starts as soon as the flusher is
+# idle, lingering up to LEDGER_FLUSH_INTERVAL_MS for more rows, and is capped at
+# LEDGER_FLUSH_MAX_DOCS rows. Writers block once LEDGER_BUFFER_CAPACITY rows are
+# pending (backpressure). Rows of a failed insert are requeued at the front and
+# retried with backoff (rows that did land come back as duplicate keys and count
+# as written); only after LEDGER_FLUSH_MAX_ATTEMPTS does a row's future fail.
+LEDGER_FLUSH_INTERVAL_MS = int(os.getenv('LEDGER_FLUSH_INTERVAL_MS', '5'))
+LEDGER_FLUSH_MAX_DOCS = int(os.getenv('LEDGER_FLUSH_MAX_DOCS', '500'))
+LEDGER_BUFFER_CAPACITY = int(os.getenv('LEDGER_BUFFER_CAPACITY', '20000'))
+LEDGER_FLUSH_MAX_ATTEMPTS = 8
+LEDGER_FLUSH_MAX_BACKOFF_SECONDS = 5.0
+# Upper bound on how long a row can stay buffered, retries included. A seq gap
+# older than this (by users.ledger_updated_at) is a lost row, not a pending one.
+LEDGER_MAX_LAG_SECONDS = int(os.getenv('LEDGER_MAX_LAG_SECONDS', '300'))
+
+class LedgerFlushError(Exception):
+    pass
+
+class LedgerWriteBuffer:
+    def __init__(self, collection_name: str, interval_ms: int, max_docs: int, capacity: int):
+        self.collection_name = collection_name
+        self.interval = interval_ms / 1000
+        self.max_docs = max_docs
+        self.capacity = capacity
+        self.pending: List[tuple] = []
+        self.wakeup = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        self.flusher: Optional[asyncio.Task] = None
+        self.writing: set = set()
+        self.stats = {"flushes": 0, "documents": 0, "largest_batch": 0, "failures": 0, "abandoned": 0, "stalls": 0, "last_flush_ms": 0.0}
+
+    async def add(self, document: Dict[str, Any]) -> asyncio.Future:
+        """Queue a document; the returned future resolves once it is written."""
+        while len(self.pending) >= self.capacity:
+            self.stats["stalls"] += 1
+            self.space.clear()
+            await self.space.wait()
+        if self.flusher is None or self.flusher.done():
+            # Started from an empty context so the flusher does not inherit the
+            # trace or profile of the request that happened to start it
+            self.flusher = Context().run(asyncio.create_task, self.run())
+        written = asyncio.get_running_loop().create_future()
+        self.pending.append((document, written, 0))
+        self.wakeup.set()
+        return written
+
+    async def run(self):
+        failures = 0
+        while True:
+            await self.wakeup.wait()
+            if self.interval and len(self.pending) < self.max_docs:
+                await asyncio.sleep(self.interval)
+            self.wakeup.clear()
+            try:
+                await self.flush()
+                failures = 0
+            except LedgerFlushError:
+                # Requeued rows are retried after a backoff
+                failures += 1
+                await asyncio.sleep(min(LEDGER_FLUSH_MAX_BACKOFF_SECONDS, 0.05 * 2 ** failures))
+                self.wakeup.set()
+
+    async def flush(self):
+        """Write all pending rows; raises LedgerFlushError once a batch fails (its rows are requeued)."""
+        while self.pending:
+            batch, self.pending = self.pending[:self.max_docs], self.pending[self.max_docs:]
+            self.space.set()
+            futures = [written for _, written, _ in batch]
+            self.writing.update(futures)
+            started = time.perf_counter()
+            error, failed = None, batch
+            try:
+                await db[self.collection_name].insert_many([document for document, _, _ in batch], ordered=False)
+                failed = []
+            except BulkWriteError as e:
+                # Rows already written by an earlier attempt come back as duplicate keys
+                if e.details.get("writeConcernErrors"):
+                    error = e
+                else:
+                    failed_indexes = {
+                        write_error["index"] for write_error in e.details.get("writeErrors", [])
+                        if write_error.get("code") != 11000
+                    }
+                    failed = [entry for i, entry in enumerate(batch) if i in failed_indexes]
+                    error = e if failed else None
+            except Exception as e:
+                error = e
+            self.stats["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            self.writing.difference_update(futures)
+            
+            failed_futures = {id(written) for _, written, _ in failed}
+            written_count = 0
+            for _, written, _ in batch:
+                if id(written) not in failed_futures and not written.done():
+                    written.set_result(None)
+                    written_count += 1
+            if written_count:
+                self.stats["flushes"] += 1
+                self.stats["documents"] += written_count
+                self.stats["largest_batch"] = max(self.stats["largest_batch"], written_count)
+            if error is None:
+                continue
+            
+            self.stats["failures"] += 1
+            retry, abandoned = [], []
+            for document, written, attempts in failed:
+                (retry if attempts + 1 < LEDGER_FLUSH_MAX_ATTEMPTS else abandoned).append((document, written, attempts + 1))
+            self.pending = retry + self.pending
+            logger.error(f"Ledger flush of {len(batch)} rows failed, {len(retry)} requeued: {error}")
+            if abandoned:
+                self.stats["abandoned"] += len(abandoned)
+                logger.critical(
+                    f"Ledger rows not written after {LEDGER_FLUSH_MAX_ATTEMPTS} attempts: "
+                    f"{json.dumps([document for document, _, _ in abandoned], default=str)}"
+                )
+                for _, written, _ in abandoned:
+                    if not written.done():
+                        written.set_exception(LedgerFlushError(str(error)))
+                        # Retrieved here so unawaited futures do not log "exception was never retrieved"
+                        written.exception()
+            raise LedgerFlushError(str(error))
+
+    async def drain(self):
+        """Write everything queued so far, including batches another flush has in flight.
+
+        Raises LedgerFlushError if any of those rows could not be written.
+        """
+        futures = [written for _, written, _ in self.pending] + list(self.writing)
+        failures = 0
+        while not all(written.done() for written in futures):
+            try:
+                await self.flush()
+            except LedgerFlushError:
+                failures += 1
+                await asyncio.sleep(min(LEDGER_FLUSH_MAX_BACKOFF_SECONDS, 0.05 * 2 ** failures))
+                continue
+            if self.writing:
+                await asyncio.wait(list(self.writing))
+        await asyncio.gather(*futures)
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True)
+            self.flusher = None
+        try:
+            await self.drain()
+        except LedgerFlushError as e:
+            logger.critical(f"Ledger buffer closed with unwritten rows: {e}")
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"pending": len(self.pending), "capacity": self.capacity, **self.stats}
+
+ledger_buffer = LedgerWriteBuffer("transactions", LEDGER_FLUSH_INTERVAL_MS, LEDGER_FLUSH_MAX_DOCS, LEDGER_BUFFER_CAPACITY)
+
+async def write_balance_snapshot(user_id: str, seq: int, balances: Dict[str, float], taken_at: datetime):
+    await db.balance_snapshots.update_one(
+        {"user_id": user_id, "seq": seq},
+        {"$setOnInsert": {"balances": balances, "created_at": taken_at}},
+        upsert=True
+    )
+
+async def post_ledger_entry(user_id: str, deltas: Dict[str, float], transaction_type: TransactionType,
+                            amount: float, description: str,
+                            virtual_money_type: VirtualMoneyType = VirtualMoneyType.INITIAL,
+                            strategy_id: Optional[str] = None, trade_details: Optional[Dict[str, Any]] = None,
+                            created_at: Optional[datetime] = None,
+                            set_fields: Optional[Dict[str, Any]] = None,
+                            durable: bool = True) -> Optional[Dict[str, Any]]:
+    """Apply balance deltas to a user and append the matching ledger row.
+
+    The row goes through the ledger write buffer. With durable=False the call
+    returns before the row is flushed; the result then carries the row's
+    "written" future, which the caller must await (after draining the buffer).
+
+    Returns the ledger seq and balances after the change, or None if the user does not exist.
+    """
+    created_at = created_at or datetime.now(timezone.utc)
+    begin_side_effects()
+    update = {
+        "$inc": {**deltas, "ledger_seq": 1},
+        "$set": {**(set_fields or {}), "ledger_updated_at": datetime.now(timezone.utc)}
+    }
+    before = await db.users.find_one_and_update(
+        {"id": user_id},
+        update,
+        projection={"_id": 0, "ledger_seq": 1, **{field: 1 for field in BALANCE_FIELDS}},
+        return_document=ReturnDocument.BEFORE
+    )
+    if before is None:
+        return None
+
+    seq = before.get("ledger_seq", 0) + 1
+    balances = {field: before.get(field, 0.0) for field in BALANCE_FIELDS}
+    if seq == 1:
+        # Opening balances of the account (including pre-ledger history)
+        await write_balance_snapshot(user_id, 0, dict(balances), created_at)
+    for field, delta in deltas.items():
+        balances[field] += delta
+
+    transaction = ledger_document(
+        user_id, transaction_type, amount, description, virtual_money_type,
+        strategy_id, trade_details, created_at
+    )
+    transaction["seq"] = seq
+    transaction["deltas"] = deltas
+    transaction["balances"] = balances
+    written = await ledger_buffer.add(transaction)
+    summaries = [
+        update_portfolio_summary(user_id, transaction_type, amount, strategy_id, created_at, seq),
+        record_equity_point(user_id, seq, balances, created_at)
+    ]
+    stats = admin_stats_increments(transaction_type, amount, strategy_id)
+    if stats:
+        summaries.append(increment_admin_stats(stats))
+    if durable:
+        await asyncio.gather(written, *summaries)
+    else:
+        await asyncio.gather(*summaries)
+    wallet_broker.publish_transaction(transaction)
+
+    if seq % LEDGER_SNAPSHOT_INTERVAL == 0:
+        await write_balance_snapshot(user_id, seq, balances, created_at)
+
+    result = {"seq": seq, "transaction_id": transaction["id"], **balances}
+    if not durable:
+        result["written"] = written
+    return result
+
+async def ledger_balances_at(user_id: str, seq: Optional[int] = None, at: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+    """Reconstruct a user's balances from the latest snapshot at or before seq/at plus the tail."""
+    snapshot_filter: Dict[str, Any] = {"user_id": user_id}
+    tail_filter: Dict[str, Any] = {"user_id": user_id}
+    if seq is not None:
+        snapshot_filter["seq"] = {"$lte": seq}
+        tail_filter["seq"] = {"$lte": seq}
+    if at is not None:
+        snapshot_filter["created_at"] = {"$lte": at}
+        tail_filter["created_at"] = {"$lte": at}
+
+    snapshot = await db.balance_snapshots.find_one(snapshot_filter, {"_id": 0}, sort=[("seq", -1)])
+    if not snapshot:
+        return None
+
+    tail_filter["seq"] = {**tail_filter.get("seq", {}), "$gt": snapshot["seq"]}
+    tail = await db.transactions.aggregate([
+        {"$match": tail_filter},
+        {"$group": {
+            "_id": None,
+            "seq": {"$max": "$seq"},
+            "entries": {"$sum": 1},
+            **{field: {"$sum": f"$deltas.{field}"} for field in BALANCE_FIELDS}
+        }}
+    ]).to_list(1)
+
+    balances = {field: snapshot["balances"].get(field, 0.0) for field in BALANCE_FIELDS}
+    result = {"seq": snapshot["seq"], "snapshot_seq": snapshot["seq"], "tail_entries": 0}
+    if tail:
+        for field in BALANCE_FIELDS:
+            balances[field] += tail[0][field]
+        result["seq"] = tail[0]["seq"]
+        result["tail_entries"] = tail[0]["entries"]
+    return {**result, **balances}
+
+# Wallet push
+# Ledger rows are published to the subscribers of the user on this worker. With
+# WALLET_CHANGE_STREAM enabled every worker also tails inserts into transactions,
+# so a settlement running on one worker reaches clients connected to the others.
+# Events carry the balances after the entry; consumers keep only the highest seq.
+WALLET_CHANGE_STREAM = os.getenv('WALLET_CHANGE_STREAM', 'false').lower() == 'true'
+WALLET_STREAM_QUEUE_SIZE = 100
+WALLET_STREAM_KEEPALIVE_SECONDS = 30
+
+def ledger_event(transaction: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "type": "ledger",
+        "seq": transaction["seq"],
+        "transaction_id": transaction["id"],
+        "transaction_type": transaction["transaction_type"],
+        "amount": transaction["amount"],
+        "description": transaction["description"],
+        "wallet": wallet_view(transaction["balances"])
+    }
+
+class WalletBroker:
+    """In-process pub/sub of ledger events keyed by user id."""
+
+    def __init__(self, queue_size: int = WALLET_STREAM_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers: Dict[str, set] = {}
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[user_id]
+
+    def publish_transaction(self, transaction: Dict[str, Any]):
+        queues = self.subscribers.get(transaction["user_id"])
+        if not queues or "balances" not in transaction:
+            return
+        event = ledger_event(transaction)
+        for queue in queues:
+            if queue.full():
+                # A slow consumer only needs the latest balances
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(event)
+            self.published += 1
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "users": len(self.subscribers),
+            "connections": sum(len(queues) for queues in self.subscribers.values()),
+            "published": self.published,
+            "dropped": self.dropped
+        }
+
+wallet_broker = WalletBroker()
+
+async def wallet_change_stream_bridge():
+    pipeline = [{"$match": {"operationType": "insert", "fullDocument.seq": {"$exists": True}}}]
+    resume_token = None
+    while True:
+        try:
+            async with db.transactions.watch(pipeline, resume_after=resume_token) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    wallet_broker.publish_transaction(change["fullDocument"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Wallet change stream interrupted: {e}")
+            await asyncio.sleep(5)
+
+# Portfolio summaries
+# One document per user, maintained incrementally from every ledger entry so the
+# wallet and home screens can read totals without scanning transactions. History
+# from before the incremental upkeep is folded in once, on first read, by
+# recounting the ledger up to the summary's ledger_seq; backfilled_through then
+# marks the first seq that is not part of the recount, and later entries below it
+# are skipped so nothing is counted twice.
+PORTFOLIO_BACKFILL_ATTEMPTS = 3
+REWARD_TRANSACTION_TYPES = (TransactionType.REGISTRATION, TransactionType.DAILY_LOGIN, TransactionType.VIDEO_AD)
+
+def portfolio_increments(transaction_type: TransactionType, amount: float, strategy_id: Optional[str], count: int = 1) -> Dict[str, float]:
+    increments = {f"transaction_counts.{transaction_type.value}": count}
+    if transaction_type == TransactionType.BUY:
+        increments["total_invested"] = amount
+        if strategy_id:
+            increments[f"strategies.{strategy_id}.invested"] = amount
+    elif transaction_type in (TransactionType.PROFIT, TransactionType.LOSS):
+        increments["total_profit_loss"] = amount
+        if strategy_id:
+            increments[f"strategies.{strategy_id}.profit_loss"] = amount
+    elif transaction_type == TransactionType.COUPON_REDEMPTION:
+        increments["total_redeemed"] = -amount
+    elif transaction_type in REWARD_TRANSACTION_TYPES:
+        increments["total_rewards"] = amount
+    return increments
+
+async def update_portfolio_summary(user_id: str, transaction_type: TransactionType, amount: float,
+                                   strategy_id: Optional[str], created_at: datetime, seq: int):
+    update = {
+        "$inc": portfolio_increments(transaction_type, amount, strategy_id),
+        "$max": {"last_activity_at": created_at, "ledger_seq": seq}
+    }
+    for _ in range(2):
+        try:
+            await db.portfolio_summaries.update_one(
+                {"user_id": user_id, "$or": [{"backfilled_through": {"$exists": False}}, {"backfilled_through": {"$lte": seq}}]},
+                update,
+                upsert=True
+            )
+            return
+        except DuplicateKeyError:
+            # Another entry created the document first (retry), or the backfill already counted this seq
+            continue
+
+# Equity history
+# One document per user and month ({user_id}:{YYYY-MM}) holding the closing equity
+# of each day with activity under days.{DD}. Points carry the ledger seq so a late
+# write of an older entry never replaces a newer point of the same day.
+def equity_value(balances: Dict[str, float]) -> float:
+    return sum(balances.get(field, 0.0) for field in BALANCE_FIELDS)
+
+async def record_equity_point(user_id: str, seq: int, balances: Dict[str, float], at: datetime):
+    day = f"days.{at:%d}"
+    point = {"equity": equity_value(balances), "seq": seq}
+    await db.equity_history.update_one(
+        {"_id": f"{user_id}:{at:%Y-%m}"},
+        [{"$set": {
+            "user_id": user_id,
+            "month": f"{at:%Y-%m}",
+            day: {"$cond": [{"$gt": [seq, {"$ifNull": [f"${day}.seq", -1]}]}, {"$literal": point}, f"${day}"]}
+        }}],
+        upsert=True
+    )
+
+async def backfill_portfolio_summary(user_id: str) -> Optional[Dict[str, Any]]:
+    """Recount the summary from the ledger up to its ledger_seq, once per user.
+
+    Returns None while part of that history is still being written.
+    """
+    for _ in range(PORTFOLIO_BACKFILL_ATTEMPTS):
+        current = await db.portfolio_summaries.find_one({"user_id": user_id}, {"_id": 0})
+        if current is not None and "backfilled_through" in current:
+            return current
+        if current is None:
+            user = await db.users.find_one({"id": user_id}, {"_id": 0, "ledger_seq": 1})
+            through = (user or {}).get("ledger_seq", 0)
+        else:
+            through = current.get("ledger_seq", 0)
+        
+        # Rows written before the ledger existed carry no seq and are always part of the recount
+        groups = await db.transactions.aggregate([
+            {"$match": {"user_id": user_id, "$or": [{"seq": {"$exists": False}}, {"seq": {"$lte": through}}]}},
+            {"$group": {
+                "_id": {"type": "$transaction_type", "strategy_id": "$strategy_id"},
+                "amount": {"$sum": "$amount"},
+                "count": {"$sum": 1},
+                "entries": {"$sum": {"$cond": [{"$gt": [{"$ifNull": ["$seq", 0]}, 0]}, 1, 0]}},
+                "last_activity_at": {"$max": "$created_at"}
+            }}
+        ]).to_list(None)
+        if sum(group["entries"] for group in groups) != through:
+            return None
+        
+        summary: Dict[str, Any] = {"user_id": user_id, "last_activity_at": None}
+        for group in groups:
+            try:
+                transaction_type = TransactionType(group["_id"]["type"])
+            except ValueError:
+                continue
+            for path, value in portfolio_increments(
+                transaction_type, group["amount"], group["_id"].get("strategy_id"), group["count"]
+            ).items():
+                target = summary
+                *parents, leaf = path.split(".")
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+                target[leaf] = target.get(leaf, 0) + value
+            if group["last_activity_at"] and (
+                summary["last_activity_at"] is None or group["last_activity_at"] > summary["last_activity_at"]
+            ):
+                summary["last_activity_at"] = group["last_activity_at"]
+        summary["ledger_seq"] = through
+        summary["backfilled_through"] = through + 1
+        
+        if current is None:
+            try:
+                await db.portfolio_summaries.insert_one(dict(summary))
+                return summary
+            except DuplicateKeyError:
+                continue  # an entry created the document meanwhile
+        
+        if current.get("accrued_through") is not None:
+            summary["accrued_through"] = current["accrued_through"]
+        # Entries above `through` landing meanwhile move ledger_seq; recount then.
+        # Entries below it are in the recount and are skipped once it is stored.
+        result = await db.portfolio_summaries.replace_one(
+            {
+                "user_id": user_id,
+                "backfilled_through": {"$exists": False},
+                "ledger_seq": current.get("ledger_seq"),
+                "accrued_through": current.get("accrued_through")
+            },
+            summary
+        )
+        if result.modified_count:
+            return summary
+    return None
+
+# Daily accrual
+# Active positions in guaranteed strategies earn monthly_returns compounded daily.
+# A run for accrual date D is a sequence of server-side pipelines, each ending in
+# $merge so no position or user passes through Python:
+#   stage      accruals: one row per position and date (per strategy)
+#   positions  user_strategies.total_profit_loss (per strategy)
+#   credits    accrual_credits: positions summed per user and strategy
+#   users      earnings_balance and ledger_seq, after-image kept in last_accrual
+#   ledger     one transaction per user and strategy, seqs and balances from last_accrual
+#   snapshots  balance snapshots due at the new seqs, and opening snapshots
+#   summaries  portfolio_summaries
+#   equity     equity_history point of the posting day
+# Every stage is idempotent for D: staged rows are keyed by date and merged with
+# keepExisting, and documents that receive money carry accrued_through, so a
+# rerun skips anything already applied. accrual_runs records completed stages; an
+# interrupted run resumes from its first incomplete stage. accrued_through and
+# last_accrual hold one date per user, so dates must be applied one at a time and
+# in order: a single lease in accrual_lease covers every date, and a date is
+# refused while a later date has started or an earlier one is unfinished. Ledger
+# rows inserted by $merge reach clients through WALLET_CHANGE_STREAM when it is
+# enabled.
+ACCRUAL_SCHEDULER = os.getenv('ACCRUAL_SCHEDULER', '1').lower() in ('1', 'true', 'yes')
+ACCRUAL_CHECK_INTERVAL_SECONDS = 600
+ACCRUAL_LEASE_SECONDS = 30 * 60
+ACCRUAL_MAX_CATCHUP_DAYS = 7
+ACCRUAL_RETENTION_DAYS = 30  # staged accruals and credits, for audit
+ACCRUAL_STAGES = ("stage", "positions", "credits", "users", "ledger", "snapshots", "summaries", "equity")
+
+def daily_rate(monthly_returns: float) -> float:
+    """Daily rate equivalent to a monthly return in percent"""
+    return (1 + monthly_returns / 100) ** (12 / 365) - 1
+
+class AccrualOrderError(Exception):
+    pass
+
+class AccrualLeaseLost(Exception):
+    pass
+
+def accrue_unless_applied(date: str) -> Dict[str, Any]:
+    return {"$lt": [{"$ifNull": ["$accrued_through", ""]}, date]}
+
+def accrual_entries(last_accrual: str) -> Dict[str, Any]:
+    """Ledger entries of a user's accrual, one per strategy, with seqs ending at last_accrual.seq"""
+    strategies = f"${last_accrual}.strategies"
+    count = {"$size": strategies}
+    return {"$map": {
+        "input": {"$range": [0, count]},
+        "as": "i",
+        "in": {
+            "strategy_id": {"$arrayElemAt": [f"{strategies}.strategy_id", "$$i"]},
+            "amount": {"$arrayElemAt": [f"{strategies}.amount", "$$i"]},
+            "seq": {"$add": [{"$subtract": [f"${last_accrual}.seq", count]}, "$$i", 1]},
+            # Balances after this entry: the final balances less the entries after it
+            "balances": {
+                **{field: f"${last_accrual}.balances.{field}" for field in BALANCE_FIELDS},
+                "earnings_balance": {"$subtract": [
+                    f"${last_accrual}.balances.earnings_balance",
+                    {"$sum": {"$slice": [f"{strategies}.amount", {"$add": ["$$i", 1]}, count]}}
+                ]}
+            }
+        }
+    }}
+
+async def acquire_accrual_lease(holder: str) -> bool:
+    """Take or extend the lease shared by every accrual date"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.accrual_lease.find_one_and_update(
+            {"_id": "accrual", "$or": [{"lease_until": {"$lt": now}}, {"holder": holder}]},
+            {"$set": {"holder": holder, "lease_until": now + timedelta(seconds=ACCRUAL_LEASE_SECONDS), "worker": os.getpid()}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def renew_accrual_lease(holder: str):
+    renewed = await db.accrual_lease.update_one(
+        {"_id": "accrual", "holder": holder},
+        {"$set": {"lease_until": datetime.now(timezone.utc) + timedelta(seconds=ACCRUAL_LEASE_SECONDS)}}
+    )
+    if not renewed.matched_count:
+        raise AccrualLeaseLost("The accrual lease expired and was taken by another worker")
+
+async def release_accrual_lease(holder: str):
+    await db.accrual_lease.delete_one({"_id": "accrual", "holder": holder})
+
+async def claim_accrual_run(date: str, now: datetime, holder: str) -> Optional[Dict[str, Any]]:
+    """Start or resume a date's run under the accrual lease; None if it is completed"""
+    strategies = await db.strategies.find(
+        {"strategy_type": StrategyType.GUARANTEED.value, "is_active": True},
+        {"_id": 0, "id": 1, "monthly_returns": 1}
+    ).to_list(None)
+    try:
+        return await db.accrual_runs.find_one_and_update(
+            {"_id": date, "status": {"$ne": "completed"}},
+            {
+                "$set": {"status": "running", "holder": holder, "worker": os.getpid()},
+                # Rates and the posting time are fixed by the first attempt so a resumed run matches it
+                "$setOnInsert": {
+                    "created_at": now,
+                    "stages": [],
+                    "rates": {strategy["id"]: daily_rate(strategy["monthly_returns"]) for strategy in strategies}
+                }
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        return None
+
+async def accrual_stage(date: str, stage: str, run: Dict[str, Any]):
+    posted_at = run["created_at"]
+    day_end = datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=1)
+
+    if stage == "stage":
+        for strategy_id, rate in run["rates"].items():
+            await db.user_strategies.aggregate([
+                {"$match": {"strategy_id": strategy_id, "is_active": True, "start_date": {"$lt": day_end}}},
+                {"$project": {
+                    "_id": {"$concat": [date, ":", "$id"]},
+                    "date": date,
+                    "user_strategy_id": "$id",
+                    "user_id": 1,
+                    "strategy_id": 1,
+                    "amount": {"$multiply": ["$invested_amount", rate]},
+                    "created_at": posted_at
+                }},
+                {"$merge": {"into": "accruals", "on": "_id", "whenMatched": "keepExisting", "whenNotMatched": "insert"}}
+            ]).to_list(None)
+            await renew_accrual_lease(run["holder"])
+
+    elif stage == "positions":
+        for strategy_id in run["rates"]:
+            await db.accruals.aggregate([
+                {"$match": {"date": date, "strategy_id": strategy_id}},
+                {"$project": {"_id": 0, "id": "$user_strategy_id", "amount": 1}},
+                {"$merge": {
+                    "into": "user_strategies",
+                    "on": "id",
+                    "whenMatched": [{"$set": {
+                        "total_profit_loss": {"$cond": [
+                            accrue_unless_applied(date),
+                            {"$add": ["$total_profit_loss", "$$new.amount"]},
+                            "$total_profit_loss"
+                        ]},
+                        "accrued_through": {"$cond": [accrue_unless_applied(date), date, "$accrued_through"]}
+                    }}],
+                    "whenNotMatched": "discard"
+                }}
+            ]).to_list(None)
+            await renew_accrual_lease(run["holder"])
+
+    elif stage == "credits":
+        await db.accruals.aggregate([
+            {"$match": {"date": date}},
+            {"$group": {"_id": {"user_id": "$user_id", "strategy_id": "$strategy_id"}, "amount": {"$sum": "$amount"}}},
+            {"$sort": {"_id.user_id": 1, "_id.strategy_id": 1}},
+            {"$group": {
+                "_id": "$_id.user_id",
+                "amount": {"$sum": "$amount"},
+                "strategies": {"$push": {"strategy_id": "$_id.strategy_id", "amount": "$amount"}}
+            }},
+            {"$project": {
+                "_id": {"$concat": [date, ":", "$_id"]},
+                "date": date,
+                "user_id": "$_id",
+                "amount": 1,
+                "strategies": 1,
+                "created_at": posted_at
+            }},
+            {"$merge": {"into": "accrual_credits", "on": "_id", "whenMatched": "keepExisting", "whenNotMatched": "insert"}}
+        ], allowDiskUse=True).to_list(None)
+
+    elif stage == "users":
+        await db.accrual_credits.aggregate([
+            {"$match": {"date": date}},
+            {"$project": {"_id": 0, "id": "$user_id", "amount": 1, "strategies": 1}},
+            {"$merge": {
+                "into": "users",
+                "on": "id",
+                "whenMatched": [
+                    {"$set": {"_accrue": accrue_unless_applied(date)}},
+                    {"$set": {
+                        "earnings_balance": {"$cond": ["$_accrue", {"$add": ["$earnings_balance", "$$new.amount"]}, "$earnings_balance"]},
+                        "ledger_seq": {"$cond": [
+                            "$_accrue",
+                            {"$add": [{"$ifNull": ["$ledger_seq", 0]}, {"$size": "$$new.strategies"}]},
+                            "$ledger_seq"
+                        ]},
+                        "ledger_updated_at": {"$cond": ["$_accrue", "$$NOW", "$ledger_updated_at"]},
+                        "accrued_through": {"$cond": ["$_accrue", date, "$accrued_through"]}
+                    }},
+                    {"$set": {"last_accrual": {"$cond": ["$_accrue", {
+                        "date": date,
+                        "seq": "$ledger_seq",
+                        "amount": "$$new.amount",
+                        "strategies": "$$new.strategies",
+                        "balances": {field: f"${field}" for field in BALANCE_FIELDS}
+                    }, "$last_accrual"]}}},
+                    {"$unset": "_accrue"}
+                ],
+                "whenNotMatched": "discard"
+            }}
+        ]).to_list(None)
+
+    elif stage == "ledger":
+        transaction_id = {"$concat": ["accrual:", date, ":", "$id", ":", "$entry.strategy_id"]}
+        await db.users.aggregate([
+            {"$match": {"last_accrual.date": date}},
+            {"$project": {"_id": 0, "id": 1, "entry": accrual_entries("last_accrual")}},
+            {"$unwind": "$entry"},
+            {"$project": {
+                "_id": transaction_id,
+                "id": transaction_id,
+                "user_id": "$id",
+                "strategy_id": "$entry.strategy_id",
+                "transaction_type": {"$cond": [
+                    {"$gte": ["$entry.amount", 0]}, TransactionType.PROFIT.value, TransactionType.LOSS.value
+                ]},
+                "amount": "$entry.amount",
+                "description": f"Daily accrual for {date}",
+                "virtual_money_type": VirtualMoneyType.EARNED_TRADING.value,
+                "created_at": posted_at,
+                "trade_details": {"accrual_date": date},
+                "seq": "$entry.seq",
+                "deltas": {"earnings_balance": "$entry.amount"},
+                "balances": "$entry.balances"
+            }},
+            {"$merge": {"into": "transactions", "on": "_id", "whenMatched": "keepExisting", "whenNotMatched": "insert"}}
+        ]).to_list(None)
+
+    elif stage == "snapshots":
+        accrued = {"$match": {"last_accrual.date": date}}
+        snapshot_merge = {"$merge": {
+            "into": "balance_snapshots", "on": ["user_id", "seq"],
+            "whenMatched": "keepExisting", "whenNotMatched": "insert"
+        }}
+        await db.users.aggregate([
+            accrued,
+            {"$project": {"_id": 0, "id": 1, "entry": accrual_entries("last_accrual")}},
+            {"$unwind": "$entry"},
+            {"$match": {"$expr": {"$eq": [{"$mod": ["$entry.seq", LEDGER_SNAPSHOT_INTERVAL]}, 0]}}},
+            {"$project": {"user_id": "$id", "seq": "$entry.seq", "balances": "$entry.balances", "created_at": posted_at}},
+            snapshot_merge
+        ]).to_list(None)
+        # First ledger entries of the account: record the balances before them
+        await db.users.aggregate([
+            accrued,
+            {"$match": {"$expr": {"$eq": ["$last_accrual.seq", {"$size": "$last_accrual.strategies"}]}}},
+            {"$project": {
+                "_id": 0,
+                "user_id": "$id",
+                "seq": {"$literal": 0},
+                "balances": {
+                    **{field: f"$last_accrual.balances.{field}" for field in BALANCE_FIELDS},
+                    "earnings_balance": {"$subtract": ["$last_accrual.balances.earnings_balance", "$last_accrual.amount"]}
+                },
+                "created_at": posted_at
+            }},
+            snapshot_merge
+        ]).to_list(None)
+
+    elif stage == "summaries":
+        seq = "$$new.ledger_seq"
+        # Per-strategy totals of the document, with this accrual added to the strategies it credits
+        accrued_strategies = {"$mergeObjects": [
+            {"$ifNull": ["$strategies", {}]},
+            {"$arrayToObject": {"$map": {
+                "input": {"$objectToArray": "$$new.strategies"},
+                "as": "credit",
+                "in": {"k": "$$credit.k", "v": {"$let": {
+                    "vars": {"existing": {"$ifNull": [{"$arrayElemAt": [{"$map": {
+                        "input": {"$filter": {
+                            "input": {"$objectToArray": {"$ifNull": ["$strategies", {}]}},
+                            "cond": {"$eq": ["$$this.k", "$$credit.k"]}
+                        }},
+                        "in": "$$this.v"
+                    }}, 0]}, {}]}},
+                    "in": {"$mergeObjects": ["$$existing", {"profit_loss": {"$add": [
+                        {"$ifNull": ["$$existing.profit_loss", 0]}, "$$credit.v.profit_loss"
+                    ]}}]}
+                }}}
+            }}}
+        ]}
+        await db.accruals.aggregate([
+            {"$match": {"date": date}},
+            {"$group": {"_id": {"user_id": "$user_id", "strategy_id": "$strategy_id"}, "amount": {"$sum": "$amount"}}},
+            {"$group": {
+                "_id": "$_id.user_id",
+                "amount": {"$sum": "$amount"},
+                "strategies": {"$push": {"k": "$_id.strategy_id", "v": {"profit_loss": "$amount"}}},
+                "profits": {"$sum": {"$cond": [{"$gte": ["$amount", 0]}, 1, 0]}},
+                "entries": {"$sum": 1}
+            }},
+            {"$lookup": {"from": "users", "localField": "_id", "foreignField": "id", "as": "user"}},
+            {"$unwind": "$user"},
+            {"$match": {"user.last_accrual.date": date}},
+            {"$project": {
+                "_id": 0,
+                "user_id": "$_id",
+                "total_profit_loss": "$amount",
+                "strategies": {"$arrayToObject": "$strategies"},
+                "transaction_counts": {
+                    TransactionType.PROFIT.value: "$profits",
+                    TransactionType.LOSS.value: {"$subtract": ["$entries", "$profits"]}
+                },
+                "last_activity_at": posted_at,
+                "ledger_seq": "$user.last_accrual.seq",
+                "accrued_through": date
+            }},
+            {"$merge": {
+                "into": "portfolio_summaries",
+                "on": "user_id",
+                "whenMatched": [
+                    # Seqs below backfilled_through are already in the backfilled totals
+                    {"$set": {"_accrue": {"$and": [
+                        accrue_unless_applied(date),
+                        {"$lte": [{"$ifNull": ["$backfilled_through", 0]}, seq]}
+                    ]}}},
+                    {"$set": {
+                        "total_profit_loss": {"$cond": ["$_accrue", {"$add": [{"$ifNull": ["$total_profit_loss", 0]}, "$$new.total_profit_loss"]}, "$total_profit_loss"]},
+                        "strategies": {"$cond": ["$_accrue", accrued_strategies, "$strategies"]},
+                        **{
+                            f"transaction_counts.{key}": {"$cond": [
+                                "$_accrue",
+                                {"$add": [{"$ifNull": [f"$transaction_counts.{key}", 0]}, f"$$new.transaction_counts.{key}"]},
+                                f"$transaction_counts.{key}"
+                            ]}
+                            for key in (TransactionType.PROFIT.value, TransactionType.LOSS.value)
+                        },
+                        "last_activity_at": {"$cond": ["$_accrue", {"$max": ["$last_activity_at", "$$new.last_activity_at"]}, "$last_activity_at"]},
+                        "ledger_seq": {"$cond": ["$_accrue", {"$max": ["$ledger_seq", seq]}, "$ledger_seq"]},
+                        "accrued_through": {"$cond": ["$_accrue", date, "$accrued_through"]}
+                    }},
+                    {"$unset": "_accrue"}
+                ],
+                "whenNotMatched": "insert"
+            }}
+        ], allowDiskUse=True).to_list(None)
+
+    elif stage == "equity":
+        day = f"days.{posted_at:%d}"
+        month = f"{posted_at:%Y-%m}"
+        await db.users.aggregate([
+            {"$match": {"last_accrual.date": date}},
+            {"$project": {
+                "_id": {"$concat": ["$id", ":", month]},
+                "user_id": "$id",
+                "month": month,
+                day: {
+                    "equity": {"$add": [f"$last_accrual.balances.{field}" for field in BALANCE_FIELDS]},
+                    "seq": "$last_accrual.seq"
+                }
+            }},
+            {"$merge": {
+                "into": "equity_history",
+                "on": "_id",
+                "whenMatched": [{"$set": {day: {"$cond": [
+                    {"$gt": [f"$$new.{day}.seq", {"$ifNull": [f"${day}.seq", -1]}]},
+                    f"$$new.{day}",
+                    f"${day}"
+                ]}}}],
+                "whenNotMatched": "insert"
+            }}
+        ]).to_list(None)
+
+async def run_accrual(date: str) -> Optional[Dict[str, Any]]:
+    """Run or resume the accrual for a date (YYYY-MM-DD); None if another worker holds the lease or it is done"""
+    holder = str(uuid.uuid4())
+    if not await acquire_accrual_lease(holder):
+        return None
+    try:
+        blocking = await db.accrual_runs.find_one(
+            {
+                "_id": {"$ne": date},
+                "stages.0": {"$exists": True},
+                "$or": [{"_id": {"$gt": date}}, {"status": {"$ne": "completed"}}]
+            },
+            {"_id": 1, "status": 1},
+            sort=[("_id", 1)]
+        )
+        if blocking is not None:
+            raise AccrualOrderError(f"Accrual for {date} cannot run while {blocking['_id']} is {blocking['status']}")
+        
+        run = await claim_accrual_run(date, datetime.now(timezone.utc), holder)
+        if run is None:
+            return None
+        
+        started = time.monotonic()
+        try:
+            for stage in ACCRUAL_STAGES:
+                if stage in run["stages"]:
+                    continue
+                stage_started = time.monotonic()
+                await accrual_stage(date, stage, run)
+                await db.accrual_runs.update_one(
+                    {"_id": date},
+                    {"$push": {"stages": stage}, "$set": {f"stage_seconds.{stage}": round(time.monotonic() - stage_started, 3)}}
+                )
+                await renew_accrual_lease(holder)
+        except Exception as e:
+            await db.accrual_runs.update_one({"_id": date}, {"$set": {"status": "failed", "error": str(e)}})
+            raise
+        
+        positions, users = await asyncio.gather(
+            db.accruals.count_documents({"date": date}),
+            db.accrual_credits.count_documents({"date": date})
+        )
+        completed = await db.accrual_runs.find_one_and_update(
+            {"_id": date},
+            {"$set": {
+                "status": "completed",
+                "finished_at": datetime.now(timezone.utc),
+                "positions": positions,
+                "users": users,
+                "last_attempt_seconds": round(time.monotonic() - started, 3)
+            }},
+            return_document=ReturnDocument.AFTER
+        )
+        # Positions were credited by pipelines; fold them into the leaderboard now
+        try:
+            await leaderboard.rebuild()
+        except Exception as e:
+            logger.error(f"Leaderboard rebuild after accrual {date} failed: {e}")
+        return completed
+    finally:
+        await release_accrual_lease(holder)
+
+async def run_due_accruals():
+    """Accrue every completed day since the last completed run, oldest first"""
+    yesterday = datetime.now(timezone.utc).date() - timedelta(days=1)
+    last = await db.accrual_runs.find_one({"status": "completed"}, {"_id": 1}, sort=[("_id", -1)])
+    start = yesterday if last is None else datetime.strptime(last["_id"], "%Y-%m-%d").date() + timedelta(days=1)
+    start = max(start, yesterday - timedelta(days=ACCRUAL_MAX_CATCHUP_DAYS - 1))
+    day = start
+    while day <= yesterday:
+        if await run_accrual(day.isoformat()) is None:
+            break  # held by another worker; it continues from here
+        day += timedelta(days=1)
+
+async def accrual_scheduler():
+    while True:
+        try:
+            await run_due_accruals()
+        except Exception as e:
+            logger.error(f"Daily accrual failed: {e}")
+        await asyncio.sleep(ACCRUAL_CHECK_INTERVAL_SECONDS)
+
 async def get_current_user(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    # First try to get session_token from cookies
-    session_token = request.cookies.get("session_token")
-    token = None
-    
+    return await resolve_user(
+        request.cookies.get("session_token"),
+        credentials.credentials if credentials else None
+    )
+
+def load_user(user_id: str):
+    # Not coalesced: a shared read may have started before this request's last
+    # balance change, and money paths check balances against the loaded user
+    return db.users.find_one({"id": user_id})
+
+async def resolve_user(session_token: Optional[str], token: Optional[str]) -> User:
+    # First try the session_token cookie
     if session_token:
         # Check session in database
-        session = await db.sessions.find_one({"session_token": session_token})
+        session = await singleflight.do(
+            ("session", session_token),
+            lambda: db.sessions.find_one({"session_token": session_token})
+        )
         if session and session["expires_at"] > datetime.now(timezone.utc):
-            user = await db.users.find_one({"id": session["user_id"]})
+            user = await load_user(session["user_id"])
             if user:
                 return User(**user)
     
     # Fallback to JWT token from Authorization header
-    if credentials:
-        token = credentials.credentials
-    
     if not token:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -313,45 +1773,890 @@ async def get_current_user(request: Request, credentials: HTTPAuthorizationCrede
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Could not validate credentials")
     
-    user = await db.users.find_one({"id": user_id})
+    user = await load_user(user_id)
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
     
     return User(**user)
 
-# Auth Routes
-@api_router.post("/auth/send-otp")
-async def send_registration_otp(otp_request: OTPRequest):
-    """Send OTP for registration verification"""
-    # Check if user already exists
-    existing_user = await db.users.find_one({"email": otp_request.email})
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    
-    otp = generate_otp()
-    expires_at = datetime.now(timezone.utc) + timedelta(minutes=10)
-    
-    # Store OTP session
-    otp_session = OTPSession(
-        email=otp_request.email,
-        otp=otp,
-        purpose="registration",
-        expires_at=expires_at
+# Idempotency
+# Money-moving endpoints accept an Idempotency-Key header. The first successful
+# response is stored in idempotency_keys (TTL-indexed) and in a per-worker LRU,
+# and replayed to retries. Concurrent duplicates wait for the in-flight request:
+# on this worker through a shared future, across workers by polling the pending
+# record. The holder renews a lease on its pending record while the handler
+# runs; a duplicate only takes the key over once that lease has expired. Handlers
+# call begin_side_effects() before their first write: a request that fails
+# before that releases the key so the client can retry, one that fails after it
+# is stored with its error and replayed like a success, since money may already
+# have moved. Each record carries a hash of the request, and reusing a key for a
+# different request is rejected.
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', str(24 * 60 * 60)))
+IDEMPOTENCY_WAIT_SECONDS = 30
+IDEMPOTENCY_LEASE_SECONDS = 15
+IDEMPOTENCY_POLL_SECONDS = 0.1
+IDEMPOTENCY_CACHE_SIZE = 10000
+
+idempotent_request: ContextVar = ContextVar("idempotent_request", default=None)
+
+def begin_side_effects():
+    """Mark the current idempotent request as having started to write"""
+    state = idempotent_request.get()
+    if state is not None:
+        state["side_effects"] = True
+
+def error_outcome(error: BaseException) -> Dict[str, Any]:
+    if isinstance(error, HTTPException):
+        return {"status_code": error.status_code, "detail": error.detail}
+    return {"status_code": 500, "detail": "Request failed after it had started applying changes"}
+
+async def request_fingerprint(request: Request) -> str:
+    """Hash the path, query and body of a request; form bodies are hashed field by field."""
+    digest = hashlib.sha256()
+    digest.update(request.url.path.encode())
+    digest.update(b"\0" + request.url.query.encode())
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith(("multipart/form-data", "application/x-www-form-urlencoded")):
+        # FastAPI has already consumed the stream into the cached form
+        form = await request.form()
+        for name, value in sorted(form.multi_items(), key=lambda item: item[0]):
+            digest.update(b"\0" + name.encode() + b"=")
+            if hasattr(value, "read"):
+                content = await value.read()
+                await value.seek(0)
+                digest.update((value.filename or "").encode() + b"\0" + content)
+            else:
+                digest.update(str(value).encode())
+    else:
+        digest.update(b"\0" + await request.body())
+    return digest.hexdigest()
+
+class IdempotencyStore:
+    def __init__(self, ttl_seconds: int = IDEMPOTENCY_TTL_SECONDS, cache_size: int = IDEMPOTENCY_CACHE_SIZE):
+        self.cache = TTLCache(cache_size, ttl_seconds)
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        self.replayed = 0
+        self.taken_over = 0
+
+    @staticmethod
+    def check_reuse(record: Dict[str, Any], path: str, fingerprint: str):
+        if record["path"] != path or record.get("fingerprint", fingerprint) != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+
+    async def claim(self, key: str, path: str, fingerprint: str, holder: str) -> Optional[Dict[str, Any]]:
+        """Reserve the key in Mongo, or return the record of whoever holds it."""
+        now = datetime.now(timezone.utc)
+        lease_until = now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+        try:
+            await db.idempotency_keys.insert_one({
+                "_id": key, "path": path, "fingerprint": fingerprint, "status": "pending",
+                "holder": holder, "lease_until": lease_until, "created_at": now
+            })
+            return None
+        except DuplicateKeyError:
+            pass
+        
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+        while True:
+            record = await db.idempotency_keys.find_one({"_id": key})
+            if record is None:
+                # The holder failed and released the key
+                return await self.claim(key, path, fingerprint, holder)
+            self.check_reuse(record, path, fingerprint)
+            if record["status"] == "completed":
+                return record
+            now = datetime.now(timezone.utc)
+            expires_at = record.get("lease_until") or record["created_at"] + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+            if expires_at.replace(tzinfo=timezone.utc) < now:
+                # The holder stopped renewing its lease; take the key over
+                taken = await db.idempotency_keys.update_one(
+                    {"_id": key, "status": "pending", "holder": record.get("holder"), "lease_until": record.get("lease_until")},
+                    {"$set": {"holder": holder, "lease_until": now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)}}
+                )
+                if taken.modified_count:
+                    self.taken_over += 1
+                    return None
+            if time.monotonic() > deadline:
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+            await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+    async def renew(self, key: str, holder: str):
+        """Keep extending the lease on a pending key while its handler runs."""
+        while True:
+            await asyncio.sleep(IDEMPOTENCY_LEASE_SECONDS / 3)
+            try:
+                renewed = await db.idempotency_keys.update_one(
+                    {"_id": key, "status": "pending", "holder": holder},
+                    {"$set": {"lease_until": datetime.now(timezone.utc) + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)}}
+                )
+            except Exception as e:
+                logger.warning(f"Failed to renew idempotency lease on {key}: {e}")
+                continue
+            if not renewed.matched_count:
+                logger.warning(f"Lost the idempotency lease on {key}")
+                return
+
+    async def run(self, request: Request, response: Response, scope: str, handler: Callable[[], Awaitable[Any]]) -> Any:
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if not idempotency_key:
+            return await handler()
+        
+        key = f"{scope}:{idempotency_key}"
+        path = request.url.path
+        fingerprint = await request_fingerprint(request)
+        while True:
+            record = self.cache.get(key)
+            if record is None and key in self.in_flight:
+                await asyncio.shield(self.in_flight[key])
+                continue
+            if record is not None:
+                break
+            
+            future = asyncio.get_running_loop().create_future()
+            self.in_flight[key] = future
+            try:
+                holder = str(uuid.uuid4())
+                record = await self.claim(key, path, fingerprint, holder)
+                if record is None:
+                    renewer = asyncio.create_task(self.renew(key, holder))
+                    state = {"side_effects": False}
+                    token = idempotent_request.set(state)
+                    try:
+                        result = jsonable_encoder(await handler())
+                    except BaseException as e:
+                        if not state["side_effects"]:
+                            await db.idempotency_keys.delete_one({"_id": key, "status": "pending", "holder": holder})
+                            raise
+                        record = {"path": path, "fingerprint": fingerprint, "status": "completed", "error": error_outcome(e)}
+                        await asyncio.shield(db.idempotency_keys.update_one(
+                            {"_id": key}, {"$set": record, "$unset": {"holder": "", "lease_until": ""}}
+                        ))
+                        self.cache.put(key, record)
+                        raise
+                    finally:
+                        idempotent_request.reset(token)
+                        renewer.cancel()
+                    record = {"path": path, "fingerprint": fingerprint, "status": "completed", "response": result}
+                    await db.idempotency_keys.update_one({"_id": key}, {"$set": record, "$unset": {"holder": "", "lease_until": ""}})
+                    self.cache.put(key, record)
+                    return result
+                self.cache.put(key, record)
+            finally:
+                del self.in_flight[key]
+                future.set_result(None)
+            break
+        
+        self.check_reuse(record, path, fingerprint)
+        self.replayed += 1
+        if record.get("error"):
+            raise HTTPException(headers={"Idempotent-Replayed": "true"}, **record["error"])
+        response.headers["Idempotent-Replayed"] = "true"
+        return record["response"]
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "cached": len(self.cache.entries), "in_flight": len(self.in_flight),
+            "replayed": self.replayed, "taken_over": self.taken_over
+        }
+
+idempotency = IdempotencyStore()
+
+# Conditional GET
+# Catalog lists are versioned in catalog_versions ({_id: "strategies", version}),
+# bumped by every write to the catalog; a user's transaction list is versioned by
+# its ledger_seq. A matching If-None-Match is answered with 304 before
+# the list itself is queried. The ETags are weak since bodies may be compressed.
+# If-None-Match is checked against the version on the primary. A list served from
+# a secondary is tagged with the version read just before it in the same causally
+# consistent session, so the list is never older than its tag. Per-user ETags
+# include a hash of the user id and vary on the credentials.
+async def catalog_version(name: str) -> int:
+    document = await singleflight.do(
+        ("catalog_version", name),
+        lambda: db.catalog_versions.find_one({"_id": name})
     )
+    return document["version"] if document else 0
+
+def catalog_snapshot(name: str, projection: Optional[Dict[str, int]] = None, limit: int = 1000):
+    """(version, active documents) of a catalog, the list at least as new as the version"""
+    projection = projection or {"_id": 0}
     
-    await db.otp_sessions.insert_one(otp_session.dict())
-    
-    # Send OTP email
-    success = await send_otp_email(otp_request.email, otp, "registration")
-    
-    if not success:
-        raise HTTPException(status_code=500, detail="Failed to send OTP")
+    async def read():
+        catalog = reader("catalog")
+        async with await client.start_session(causal_consistency=True) as session:
+            document = await catalog.catalog_versions.find_one({"_id": name}, session=session)
+            items = await catalog[name].find({"is_active": True}, projection, session=session).to_list(limit)
+        return (document["version"] if document else 0), items
     
-    return {"message": "OTP sent successfully", "expires_in": 600}
+    return singleflight.do(("catalog_snapshot", name, tuple(projection.items()), limit), read)
 
-@api_router.post("/auth/forgot-password")
-async def forgot_password(otp_request: OTPRequest):
-    """Send OTP for password reset"""
+def user_etag(kind: str, user_id: str, version: Any) -> str:
+    return f'W/"{kind}-{hashlib.sha256(user_id.encode()).hexdigest()[:16]}-{version}"'
+
+async def bump_catalog_version(name: str):
+    await db.catalog_versions.update_one({"_id": name}, {"$inc": {"version": 1}}, upsert=True)
+
+def not_modified(request: Request, response: Response, etag: str, vary: Optional[str] = None) -> Optional[Response]:
+    """Return a 304 if the client already holds `etag`, else tag `response` with it"""
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if vary:
+        headers["Vary"] = vary
+    candidates = [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]
+    if "*" in candidates or etag in candidates or etag[2:] in candidates:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+# Compression
+# Responses of at least COMPRESSION_MIN_BYTES are compressed with brotli when the
+# client accepts it and the module is installed, otherwise with gzip. Streamed
+# bodies (more_body) and websockets pass through untouched. Every response carries
+# Vary: Accept-Encoding, compressed or not.
+COMPRESSION_MIN_BYTES = int(os.getenv('COMPRESSION_MIN_BYTES', '1024'))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+def vary_on_encoding(headers: List[tuple]) -> List[tuple]:
+    """Add Accept-Encoding to the Vary header, so caches keep encoded and plain bodies apart"""
+    for index, (name, value) in enumerate(headers):
+        if name.lower() == b"vary":
+            if b"accept-encoding" in value.lower() or value.strip() == b"*":
+                return headers
+            return headers[:index] + [(name, value + b", Accept-Encoding")] + headers[index + 1:]
+    return headers + [(b"vary", b"Accept-Encoding")]
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        encoding = negotiate_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            async def send_plain(message):
+                if message["type"] == "http.response.start":
+                    message = {**message, "headers": vary_on_encoding(list(message["headers"]))}
+                await send(message)
+            return await self.app(scope, receive, send_plain)
+
+        start = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                return await send(message)
+
+            body = message.get("body", b"")
+            response_headers = [(k, v) for k, v in start["headers"]]
+            names = {k.lower() for k, _ in response_headers}
+            if message.get("more_body") or len(body) < self.minimum_size or b"content-encoding" in names:
+                passthrough = True
+                await send({**start, "headers": vary_on_encoding(response_headers)})
+                return await send(message)
+
+            if encoding == "br":
+                body = brotli.compress(body, quality=BROTLI_QUALITY)
+            else:
+                body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+            response_headers = [(k, v) for k, v in response_headers if k.lower() != b"content-length"]
+            response_headers += [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(body)).encode()),
+            ]
+            await send({**start, "headers": vary_on_encoding(response_headers)})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_compressed)
+
+# Load shedding
+# Requests are grouped into route classes, each with its own concurrency limit and
+# queue-time budget, so a burst in one class cannot starve the others. A request
+# that cannot start within the budget of its class, or that finds the queue
+# already LOAD_QUEUE_DEPTH_FACTOR times the limit deep, is shed with a 503 whose
+# Retry-After is estimated from the recent service time of the class.
+# LOAD_LIMITS overrides the defaults, e.g. "auth=16:0.5,admin=2:10"
+# (concurrency:queue seconds). Health checks and websockets are not limited.
+LOAD_LIMIT_DEFAULTS = {
+    "auth": (32, 1.0),
+    "money": (32, 2.0),
+    "reads": (128, 0.5),
+    "admin": (4, 10.0),
+}
+LOAD_QUEUE_DEPTH_FACTOR = 4
+LOAD_EXEMPT_PREFIXES = ("/api/health",)
+MONEY_ROUTES = (
+    ("POST", "/api/rewards/"),
+    ("POST", "/api/user-strategies"),
+    ("POST", "/api/coupons/"),
+)
+
+def parse_load_limits(value: str) -> Dict[str, tuple]:
+    limits = dict(LOAD_LIMIT_DEFAULTS)
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        route_class, _, limit = item.partition('=')
+        concurrency, _, queue_seconds = limit.partition(':')
+        default_queue_seconds = limits.get(route_class.strip(), (0, 1.0))[1]
+        limits[route_class.strip()] = (int(concurrency), float(queue_seconds or default_queue_seconds))
+    return limits
+
+LOAD_LIMITS = parse_load_limits(os.getenv('LOAD_LIMITS', ''))
+
+def route_class(method: str, path: str) -> Optional[str]:
+    if path.startswith(LOAD_EXEMPT_PREFIXES):
+        return None
+    if path.startswith("/api/auth/"):
+        return "auth"
+    if path.startswith("/api/admin/") or (method == "POST" and path == "/api/strategies"):
+        return "admin"
+    for route_method, prefix in MONEY_ROUTES:
+        if method == route_method and path.startswith(prefix):
+            return "money"
+    return "reads"
+
+class RouteLimiter:
+    def __init__(self, concurrency: int, queue_seconds: float):
+        self.concurrency = concurrency
+        self.queue_seconds = queue_seconds
+        self.slots = asyncio.Semaphore(concurrency)
+        self.running = 0
+        self.queued = 0
+        self.served = 0
+        self.shed = 0
+        self.service_seconds = 0.05  # moving average
+
+    async def acquire(self) -> bool:
+        if not self.slots.locked():
+            await self.slots.acquire()
+        else:
+            if self.queued >= self.concurrency * LOAD_QUEUE_DEPTH_FACTOR:
+                return False
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self.slots.acquire(), self.queue_seconds)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self.queued -= 1
+        self.running += 1
+        return True
+
+    def release(self, elapsed: float):
+        self.running -= 1
+        self.served += 1
+        self.service_seconds += 0.1 * (elapsed - self.service_seconds)
+        self.slots.release()
+
+    def retry_after(self) -> int:
+        backlog = self.running + self.queued
+        return max(1, math.ceil(backlog * self.service_seconds / max(1, self.concurrency)))
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "queue_seconds": self.queue_seconds,
+            "running": self.running,
+            "queued": self.queued,
+            "served": self.served,
+            "shed": self.shed,
+            "service_ms": round(self.service_seconds * 1000, 1),
+        }
+
+route_limiters = {name: RouteLimiter(*limit) for name, limit in LOAD_LIMITS.items()}
+
+class LoadSheddingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        limiter = route_limiters.get(route_class(scope["method"], scope["path"]))
+        if limiter is None:
+            return await self.app(scope, receive, send)
+
+        if not await limiter.acquire():
+            limiter.shed += 1
+            response = JSONResponse(
+                {"detail": "Server is busy, please retry shortly"},
+                status_code=503,
+                headers={"Retry-After": str(limiter.retry_after())}
+            )
+            return await response(scope, receive, send)
+
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release(time.monotonic() - started)
+
+# Rate limiting
+# Token buckets keyed by rule and subject (client IP, email or user id). Each rule
+# holds `capacity` tokens refilled evenly over `window` seconds, and a request
+# costs one token. RATE_LIMIT_BACKEND=memory keeps buckets per worker;
+# RATE_LIMIT_BACKEND=mongo shares them through the rate_limits collection, which
+# any local mongod can serve. RATE_LIMITS overrides rules, e.g. "otp-email=5:600"
+# (capacity:window seconds).
+RATE_LIMIT_DEFAULTS = {
+    "otp-ip": (10, 600),
+    "otp-email": (3, 600),
+    "reward-ip": (30, 60),
+    "reward-user": (5, 60),
+}
+RATE_LIMIT_BUCKETS = 100_000  # per-worker buckets kept by the memory backend
+TRUST_FORWARDED_FOR = os.getenv('TRUST_FORWARDED_FOR', '').lower() in ('1', 'true', 'yes')
+
+def parse_rate_limits(value: str) -> Dict[str, tuple]:
+    rules = dict(RATE_LIMIT_DEFAULTS)
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, rule = item.partition('=')
+        capacity, _, window = rule.partition(':')
+        rules[name.strip()] = (int(capacity), float(window))
+    return rules
+
+RATE_LIMITS = parse_rate_limits(os.getenv('RATE_LIMITS', ''))
+
+class MemoryRateLimitBackend:
+    def __init__(self, max_buckets: int = RATE_LIMIT_BUCKETS):
+        self.max_buckets = max_buckets
+        self.buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    async def take(self, key: str, capacity: int, window: float) -> float:
+        """Take one token; returns 0 if allowed, else seconds until one is available"""
+        now = time.monotonic()
+        rate = capacity / window
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [float(capacity), now]
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / rate
+
+class MongoRateLimitBackend:
+    async def take(self, key: str, capacity: int, window: float) -> float:
+        """Refill and take atomically in one pipeline update, so workers share buckets"""
+        now = time.time()
+        rate = capacity / window
+        elapsed = {"$max": [0, {"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}]}
+        refilled = {"$min": [capacity, {"$add": [{"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed, rate]}]}]}
+        bucket = await db.rate_limits.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {
+                    "tokens": refilled,
+                    "updated_at": now,
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=window)
+                }},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]}
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if bucket["allowed"]:
+            return 0.0
+        return (1 - bucket["tokens"]) / rate
+
+class RateLimiter:
+    def __init__(self, backend, rules: Dict[str, tuple] = RATE_LIMITS):
+        self.backend = backend
+        self.rules = rules
+        self.allowed: Dict[str, int] = {name: 0 for name in rules}
+        self.limited: Dict[str, int] = {name: 0 for name in rules}
+
+    async def check(self, *limits: tuple):
+        """Take a token for each (rule, subject) pair, raising 429 on the first empty bucket"""
+        for rule, subject in limits:
+            if not subject:
+                continue
+            capacity, window = self.rules[rule]
+            wait = await self.backend.take(f"{rule}:{subject}", capacity, window)
+            if wait > 0:
+                self.limited[rule] += 1
+                raise HTTPException(
+                    status_code=429,
+                    detail="Too many requests, please try again later",
+                    headers={"Retry-After": str(math.ceil(wait))}
+                )
+            self.allowed[rule] += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "backend": type(self.backend).__name__,
+            "rules": {
+                name: {"capacity": capacity, "window_seconds": window, "allowed": self.allowed[name], "limited": self.limited[name]}
+                for name, (capacity, window) in self.rules.items()
+            }
+        }
+
+def client_ip(request: Request) -> Optional[str]:
+    if TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get("x-forwarded-for", "").split(",")[0].strip()
+        if forwarded:
+            return forwarded
+    return request.client.host if request.client else None
+
+rate_limiter = RateLimiter(
+    MongoRateLimitBackend() if os.getenv('RATE_LIMIT_BACKEND', 'memory') == 'mongo' else MemoryRateLimitBackend()
+)
+
+# Profiling
+# An admin can profile a single request with an X-Profile: 1 header or a
+# profile=1 query parameter. A thread samples the event loop every
+# PROFILE_SAMPLE_INTERVAL_MS: while the request's task is running it records the
+# Python stack, while the task is suspended it records the await chain. Samples
+# are stored as folded stacks (flamegraph.pl / speedscope input) in
+# request_profiles along with a time breakdown, and the response carries the
+# profile id in X-Profile-Id. Requests without the flag are not touched.
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', '1')) / 1000
+PROFILE_TTL_SECONDS = 7 * 24 * 60 * 60
+PROFILE_MAX_DEPTH = 128
+# Checked from the innermost frame outwards; the first match names the sample
+PROFILE_CATEGORIES = (
+    ("bcrypt", ("bcrypt", "passlib")),
+    ("pandas", ("pandas", "numpy")),
+    ("serialization", ("/json/", "encoders.py", "pydantic", "responses.py")),
+)
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def running_stack(frame) -> List[Any]:
+    frames = []
+    while frame is not None and len(frames) < PROFILE_MAX_DEPTH:
+        frames.append(frame)
+        frame = frame.f_back
+    return frames[::-1]
+
+def awaiting_stack(coro) -> List[Any]:
+    frames = []
+    while coro is not None and len(frames) < PROFILE_MAX_DEPTH:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    return frames
+
+def sample_category(frames: List[Any]) -> str:
+    for frame in reversed(frames):
+        filename = frame.f_code.co_filename
+        for category, markers in PROFILE_CATEGORIES:
+            if any(marker in filename for marker in markers):
+                return category
+    return "python"
+
+class RequestProfile:
+    def __init__(self, method: str, path: str):
+        self.id = str(uuid.uuid4())
+        self.method = method
+        self.path = path
+        self.status = None
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.thread_id = threading.get_ident()
+        self.stacks: Dict[str, int] = {}
+        self.samples = {"python": 0, "awaiting": 0, **{category: 0 for category, _ in PROFILE_CATEGORIES}}
+        self.mongo = {"commands": 0, "ms": 0.0, "by_command": {}}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.run, name=f"profile-{self.id}", daemon=True)
+        self.started = self.wall = 0.0
+
+    def add_mongo(self, command_name: str, duration_micros: int):
+        with self.lock:
+            self.mongo["commands"] += 1
+            self.mongo["ms"] += duration_micros / 1000
+            self.mongo["by_command"][command_name] = self.mongo["by_command"].get(command_name, 0) + 1
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.sampler.start()
+
+    def stop(self):
+        self.wall = time.perf_counter() - self.started
+        self.stopped.set()
+        self.sampler.join()
+
+    def run(self):
+        current_tasks = getattr(asyncio.tasks, "_current_tasks", {})  # loop -> running task
+        while not self.stopped.wait(PROFILE_SAMPLE_INTERVAL):
+            if current_tasks.get(self.loop) is self.task:
+                frames = running_stack(sys._current_frames().get(self.thread_id))
+                category = sample_category(frames)
+                labels = [frame_label(frame) for frame in frames]
+            else:
+                labels = [frame_label(frame) for frame in awaiting_stack(self.task.get_coro())] + ["[awaiting]"]
+                category = "awaiting"
+            key = ";".join(labels)
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples[category] += 1
+
+    def to_document(self) -> Dict[str, Any]:
+        total = sum(self.samples.values())
+        wall_ms = self.wall * 1000
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "wall_ms": round(wall_ms, 3),
+            "samples": total,
+            "sample_interval_ms": PROFILE_SAMPLE_INTERVAL * 1000,
+            # Sampled time is scaled to wall time, since samples stall while the GIL is held
+            "breakdown_ms": {
+                category: round(count / total * wall_ms, 3) if total else 0.0
+                for category, count in self.samples.items()
+            },
+            "mongo": {**self.mongo, "ms": round(self.mongo["ms"], 3)},
+            "folded": "\n".join(f"{stack} {count}" for stack, count in self.stacks.items()),
+            "created_at": datetime.now(timezone.utc)
+        }
+
+def profile_requested(scope) -> bool:
+    if b"profile=1" in scope.get("query_string", b""):
+        return True
+    return any(name == b"x-profile" and value == b"1" for name, value in scope["headers"])
+
+async def is_admin_request(scope) -> bool:
+    request = Request(scope)
+    authorization = request.headers.get("authorization", "")
+    token = authorization[7:] if authorization.lower().startswith("bearer ") else None
+    try:
+        user = await resolve_user(request.cookies.get("session_token"), token)
+    except HTTPException:
+        return False
+    return user.role == UserRole.ADMIN
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not profile_requested(scope) or not await is_admin_request(scope):
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(scope["method"], scope["path"])
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message = {**message, "headers": [*message["headers"], (b"x-profile-id", profile.id.encode())]}
+            await send(message)
+
+        context_token = active_profile.set(profile)
+        profile.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profile.stop()
+            active_profile.reset(context_token)
+            try:
+                await db.request_profiles.insert_one(profile.to_document())
+            except Exception as e:
+                logger.error(f"Failed to store request profile {profile.id}: {e}")
+
+# Traffic capture
+# With TRAFFIC_CAPTURE_FILE set, a sample of requests is appended to a gzipped
+# JSON-lines file for replay_traffic.py. Records are sanitized: the route
+# template instead of the path, query parameter names, and the shape of the body
+# (field names and value types) instead of its content. Keys:
+#   t  start, ms since epoch      m  method        r  route template
+#   q  query parameter names      s  status        d  duration ms
+#   a  authenticated              k  Idempotency-Key sent
+#   c  content type               n  body bytes    b  body shape
+TRAFFIC_CAPTURE_FILE = os.getenv('TRAFFIC_CAPTURE_FILE', '')
+TRAFFIC_CAPTURE_SAMPLE = float(os.getenv('TRAFFIC_CAPTURE_SAMPLE', '1.0'))
+TRAFFIC_CAPTURE_BODY_BYTES = 64 * 1024  # only this much of a body is inspected for its shape
+TRAFFIC_FLUSH_INTERVAL_SECONDS = 2
+MULTIPART_FIELD = re.compile(rb'name="([^"]+)"(; filename=")?')
+
+def value_shape(value, depth: int = 0):
+    if isinstance(value, dict):
+        return {key: value_shape(item, depth + 1) for key, item in value.items()} if depth < 4 else "obj"
+    if isinstance(value, list):
+        return [value_shape(value[0], depth + 1)] if value else []
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "num"
+    if value is None:
+        return "null"
+    return "str"
+
+def body_shape(content_type: str, body: bytes):
+    if not body:
+        return None
+    if content_type.startswith("application/json"):
+        try:
+            return value_shape(json.loads(body))
+        except ValueError:
+            return "invalid"
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return {name: "str" for name in parse_qs(body.decode("latin-1"), keep_blank_values=True)}
+    if content_type.startswith("multipart/form-data"):
+        return {
+            match.group(1).decode("latin-1"): "file" if match.group(2) else "str"
+            for match in MULTIPART_FIELD.finditer(body)
+        }
+    return "bytes"
+
+class TrafficRecorder:
+    def __init__(self, path: str):
+        self.path = path
+        self.pending: deque = deque(maxlen=100_000)
+        self.recorded = 0
+
+    def record(self, entry: Dict[str, Any]):
+        self.pending.append(entry)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(TRAFFIC_FLUSH_INTERVAL_SECONDS)
+            await self.flush()
+
+    async def flush(self):
+        entries = []
+        while self.pending:
+            entries.append(self.pending.popleft())
+        if not entries:
+            return
+        try:
+            await asyncio.to_thread(self.write, entries)
+            self.recorded += len(entries)
+        except Exception as e:
+            logger.error(f"Failed to write {len(entries)} captured requests: {e}")
+
+    def write(self, entries: List[Dict[str, Any]]):
+        # Every flush appends a gzip member; gzip readers see one continuous stream
+        with gzip.open(self.path, "at") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"file": self.path, "sample": TRAFFIC_CAPTURE_SAMPLE, "pending": len(self.pending), "recorded": self.recorded}
+
+traffic_recorder = TrafficRecorder(TRAFFIC_CAPTURE_FILE) if TRAFFIC_CAPTURE_FILE else None
+
+class TrafficCaptureMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or traffic_recorder is None or random.random() >= TRAFFIC_CAPTURE_SAMPLE:
+            return await self.app(scope, receive, send)
+
+        started = time.time()
+        body = bytearray()
+        size = 0
+        status_code = None
+
+        async def receive_captured():
+            nonlocal size
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                size += len(chunk)
+                if len(body) < TRAFFIC_CAPTURE_BODY_BYTES:
+                    body.extend(chunk[:TRAFFIC_CAPTURE_BODY_BYTES - len(body)])
+            return message
+
+        async def send_captured(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive_captured, send_captured)
+        finally:
+            headers = dict(scope["headers"])
+            content_type = headers.get(b"content-type", b"").decode("latin-1").split(";")[0]
+            route = scope.get("route")
+            traffic_recorder.record({
+                "t": int(started * 1000),
+                "m": scope["method"],
+                "r": route.path if route is not None else None,
+                "q": sorted(parse_qs(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True)),
+                "s": status_code,
+                "d": round((time.time() - started) * 1000, 2),
+                "a": b"authorization" in headers or b"session_token" in headers.get(b"cookie", b""),
+                "k": b"idempotency-key" in headers,
+                "c": content_type,
+                "n": size,
+                "b": body_shape(headers.get(b"content-type", b"").decode("latin-1"), bytes(body)),
+            })
+
+# Auth Routes
+@api_router.post("/auth/send-otp")
+async def send_registration_otp(otp_request: OTPRequest, request: Request):
+    """Send OTP for registration verification"""
+    await rate_limiter.check(("otp-ip", client_ip(request)), ("otp-email", otp_request.email.lower()))
+    
+    # Check if user already exists
+    existing_user = await db.users.find_one({"email": otp_request.email})
+    if existing_user:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    
+    otp = generate_otp()
+    expires_at = datetime.now(timezone.utc) + timedelta(minutes=10)
+    
+    # Store OTP session
+    otp_session = OTPSession(
+        email=otp_request.email,
+        otp=otp,
+        purpose="registration",
+        expires_at=expires_at
+    )
+    
+    await db.otp_sessions.insert_one(otp_session.dict())
+    
+    # Send OTP email
+    success = await send_otp_email(otp_request.email, otp, "registration")
+    
+    if not success:
+        raise HTTPException(status_code=500, detail="Failed to send OTP")
+    
+    return {"message": "OTP sent successfully", "expires_in": 600}
+
+@api_router.post("/auth/forgot-password")
+async def forgot_password(otp_request: OTPRequest, request: Request):
+    """Send OTP for password reset"""
+    await rate_limiter.check(("otp-ip", client_ip(request)), ("otp-email", otp_request.email.lower()))
+    
     # Check if user exists
     user = await db.users.find_one({"email": otp_request.email})
     if not user:
@@ -468,22 +2773,23 @@ async def register(user_data: UserCreate, verification_token: str = Form(...)):
         name=user_data.name,
         phone_number=user_data.phone_number,
         password_hash=hashed_password,
-        email_verified=True,
-        task_balance=10000.0  # $10,000 registration bonus
+        email_verified=True
     )
     
     await db.users.insert_one(user.dict())
+    await record_signup(user)
     
-    # Create registration transaction
-    transaction = Transaction(
-        user_id=user.id,
+    # Credit the $10,000 registration bonus through the ledger
+    balances = await post_ledger_entry(
+        user.id,
+        {"task_balance": 10000.0},
         transaction_type=TransactionType.REGISTRATION,
         amount=10000.0,
         description="Registration bonus",
         virtual_money_type=VirtualMoneyType.TASK_REWARD
     )
-    
-    await db.transactions.insert_one(transaction.dict())
+    user.task_balance = balances["task_balance"]
+    user.ledger_seq = balances["seq"]
     
     # Clean up OTP session
     await db.otp_sessions.delete_one({"id": verification_token})
@@ -523,24 +2829,15 @@ async def login(user_data: UserLogin):
     if last_login_date != today:
         # Award daily login bonus
         daily_bonus = 100.0
-        await db.users.update_one(
-            {"id": user["id"]},
-            {
-                "$set": {"last_daily_login": datetime.now(timezone.utc)},
-                "$inc": {"task_balance": daily_bonus}
-            }
-        )
-        
-        # Create daily login transaction
-        transaction = Transaction(
-            user_id=user["id"],
+        await post_ledger_entry(
+            user["id"],
+            {"task_balance": daily_bonus},
             transaction_type=TransactionType.DAILY_LOGIN,
             amount=daily_bonus,
             description="Daily login bonus",
-            virtual_money_type=VirtualMoneyType.TASK_REWARD
+            virtual_money_type=VirtualMoneyType.TASK_REWARD,
+            set_fields={"last_daily_login": datetime.now(timezone.utc)}
         )
-        
-        await db.transactions.insert_one(transaction.dict())
     
     # Update last login
     await db.users.update_one(
@@ -577,10 +2874,14 @@ async def get_session_data(request: Request):
     
     # Call Emergent auth service
     try:
-        response = requests.get(
-            "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-            headers={"X-Session-ID": session_id}
-        )
+        session_data_url = "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data"
+        with trace_span("GET session-data", SPAN_KIND_CLIENT, **{"http.method": "GET", "http.url": session_data_url}) as span:
+            headers = {"X-Session-ID": session_id}
+            if span:
+                headers["traceparent"] = span.traceparent()
+            response = requests.get(session_data_url, headers=headers)
+            if span:
+                span.attributes["http.status_code"] = response.status_code
         
         if response.status_code != 200:
             raise HTTPException(status_code=401, detail="Invalid session")
@@ -601,21 +2902,22 @@ async def get_session_data(request: Request):
                 google_id=user_data["id"],
                 profile_picture=user_data.get("picture"),
                 password_hash=None,
-                email_verified=True,
-                task_balance=10000.0  # Registration bonus for Google users
+                email_verified=True
             )
             await db.users.insert_one(user.dict())
+            await record_signup(user)
             
-            # Create registration transaction
-            transaction = Transaction(
-                user_id=user.id,
+            # Registration bonus for Google users
+            balances = await post_ledger_entry(
+                user.id,
+                {"task_balance": 10000.0},
                 transaction_type=TransactionType.REGISTRATION,
                 amount=10000.0,
                 description="Registration bonus (Google OAuth)",
                 virtual_money_type=VirtualMoneyType.TASK_REWARD
             )
-            
-            await db.transactions.insert_one(transaction.dict())
+            user.task_balance = balances["task_balance"]
+            user.ledger_seq = balances["seq"]
         
         # Create session in our database
         session_token = user_data["session_token"]
@@ -667,7 +2969,14 @@ async def logout(request: Request, response: Response, current_user: User = Depe
 
 # Video Ad Reward Routes
 @api_router.post("/rewards/video-ad")
-async def claim_video_ad_reward(reward_request: VideoAdRewardRequest):
+async def claim_video_ad_reward(reward_request: VideoAdRewardRequest, request: Request, response: Response):
+    await rate_limiter.check(("reward-ip", client_ip(request)), ("reward-user", reward_request.user_id))
+    return await idempotency.run(
+        request, response, f"video-ad:{reward_request.user_id}",
+        lambda: process_video_ad_reward(reward_request)
+    )
+
+async def process_video_ad_reward(reward_request: VideoAdRewardRequest):
     """Claim reward for watching video ad"""
     user = await db.users.find_one({"id": reward_request.user_id})
     if not user:
@@ -685,14 +2994,9 @@ async def claim_video_ad_reward(reward_request: VideoAdRewardRequest):
     # Award video ad reward
     reward_amount = 1000.0  # $1000 for video ad
     
-    await db.users.update_one(
-        {"id": reward_request.user_id},
-        {"$inc": {"task_balance": reward_amount}}
-    )
-    
-    # Create transaction
-    transaction = Transaction(
-        user_id=reward_request.user_id,
+    await post_ledger_entry(
+        reward_request.user_id,
+        {"task_balance": reward_amount},
         transaction_type=TransactionType.VIDEO_AD,
         amount=reward_amount,
         description="Video ad reward",
@@ -700,8 +3004,6 @@ async def claim_video_ad_reward(reward_request: VideoAdRewardRequest):
         trade_details={"transaction_id": reward_request.transaction_id, "ad_unit_id": reward_request.ad_unit_id}
     )
     
-    await db.transactions.insert_one(transaction.dict())
-    
     return {
         "message": "Video ad reward claimed successfully",
         "reward_amount": reward_amount
@@ -709,8 +3011,12 @@ async def claim_video_ad_reward(reward_request: VideoAdRewardRequest):
 
 # Strategy Routes (keeping existing ones)
 @api_router.get("/strategies", response_model=List[Strategy])
-async def get_strategies(current_user: User = Depends(get_current_user)):
-    strategies = await db.strategies.find({"is_active": True}, {"_id": 0}).to_list(1000)
+async def get_strategies(request: Request, response: Response, current_user: User = Depends(get_current_user)):
+    cached = not_modified(request, response, f'W/"strategies-{await catalog_version("strategies")}"')
+    if cached:
+        return cached
+    version, strategies = await catalog_snapshot("strategies")
+    response.headers["ETag"] = f'W/"strategies-{version}"'
     return [Strategy(**strategy) for strategy in strategies]
 
 @api_router.post("/strategies", response_model=Strategy)
@@ -720,18 +3026,28 @@ async def create_strategy(strategy_data: StrategyCreate, current_user: User = De
     
     strategy = Strategy(**strategy_data.dict())
     await db.strategies.insert_one(strategy.dict())
+    await bump_catalog_version("strategies")
     return strategy
 
 @api_router.get("/strategies/{strategy_id}", response_model=Strategy)
 async def get_strategy(strategy_id: str, current_user: User = Depends(get_current_user)):
-    strategy = await db.strategies.find_one({"id": strategy_id, "is_active": True}, {"_id": 0})
+    strategy = await singleflight.do(
+        ("strategy", strategy_id),
+        lambda: reader("catalog").strategies.find_one({"id": strategy_id, "is_active": True}, {"_id": 0})
+    )
     if not strategy:
         raise HTTPException(status_code=404, detail="Strategy not found")
     return Strategy(**strategy)
 
 # User Strategy Routes
 @api_router.post("/user-strategies")
-async def invest_in_strategy(strategy_id: str = Form(...), amount: float = Form(...), current_user: User = Depends(get_current_user)):
+async def invest_in_strategy(request: Request, response: Response, strategy_id: str = Form(...), amount: float = Form(...), current_user: User = Depends(get_current_user)):
+    return await idempotency.run(
+        request, response, f"invest:{current_user.id}",
+        lambda: process_investment(strategy_id, amount, current_user)
+    )
+
+async def process_investment(strategy_id: str, amount: float, current_user: User):
     strategy = await db.strategies.find_one({"id": strategy_id, "is_active": True}, {"_id": 0})
     if not strategy:
         raise HTTPException(status_code=404, detail="Strategy not found")
@@ -751,26 +3067,20 @@ async def invest_in_strategy(strategy_id: str = Form(...), amount: float = Form(
         invested_amount=amount
     )
     
+    begin_side_effects()
     await db.user_strategies.insert_one(user_strategy.dict())
     
     # Deduct from balances (earnings first, then virtual)
     earnings_used = min(current_user.earnings_balance, amount)
     virtual_used = amount - earnings_used
     
-    await db.users.update_one(
-        {"id": current_user.id},
+    await post_ledger_entry(
+        current_user.id,
         {
-            "$inc": {
-                "earnings_balance": -earnings_used,
-                "virtual_balance": -virtual_used,
-                "total_investment": amount
-            }
-        }
-    )
-    
-    # Create transaction record
-    transaction = Transaction(
-        user_id=current_user.id,
+            "earnings_balance": -earnings_used,
+            "virtual_balance": -virtual_used,
+            "total_investment": amount
+        },
         strategy_id=strategy_id,
         transaction_type=TransactionType.BUY,
         amount=amount,
@@ -778,24 +3088,25 @@ async def invest_in_strategy(strategy_id: str = Form(...), amount: float = Form(
         virtual_money_type=VirtualMoneyType.EARNED_TRADING if earnings_used > 0 else VirtualMoneyType.INITIAL
     )
     
-    await db.transactions.insert_one(transaction.dict())
-    
     return {"message": "Investment successful", "user_strategy_id": user_strategy.id}
 
-@api_router.get("/user-strategies")
-async def get_user_strategies(current_user: User = Depends(get_current_user)):
+async def load_user_strategies(user_id: str, limit: int = 1000) -> List[Dict[str, Any]]:
     user_strategies = await db.user_strategies.find(
-        {"user_id": current_user.id, "is_active": True},
+        {"user_id": user_id, "is_active": True},
         {"_id": 0}
-    ).to_list(1000)
+    ).to_list(limit)
+    
+    # Populate strategy details with one lookup for all positions
+    strategy_ids = list({us["strategy_id"] for us in user_strategies})
+    strategies = await reader("catalog").strategies.find(
+        {"id": {"$in": strategy_ids}},
+        {"_id": 0, "id": 1, "name": 1, "strategy_type": 1, "monthly_returns": 1}
+    ).to_list(None) if strategy_ids else []
+    strategies_by_id = {strategy["id"]: strategy for strategy in strategies}
     
-    # Populate strategy details
     result = []
     for us in user_strategies:
-        strategy = await db.strategies.find_one(
-            {"id": us["strategy_id"]},
-            {"_id": 0}
-        )
+        strategy = strategies_by_id.get(us["strategy_id"])
         if strategy:
             result.append({
                 **us,
@@ -806,22 +3117,1031 @@ async def get_user_strategies(current_user: User = Depends(get_current_user)):
     
     return result
 
+@api_router.get("/user-strategies")
+async def get_user_strategies(current_user: User = Depends(get_current_user)):
+    return await load_user_strategies(current_user.id)
+
 # Wallet Routes
+def wallet_view(balances: Dict[str, float]) -> Dict[str, float]:
+    return {
+        "virtual_balance": balances["virtual_balance"],
+        "earnings_balance": balances["earnings_balance"],
+        "task_balance": balances["task_balance"],
+        "total_investment": balances["total_investment"],
+        "available_for_investment": balances["virtual_balance"] + balances["earnings_balance"],
+        "available_for_coupons": balances["earnings_balance"],
+        "total_balance": balances["virtual_balance"] + balances["earnings_balance"] + balances["task_balance"]
+    }
+
 @api_router.get("/wallet")
 async def get_wallet(current_user: User = Depends(get_current_user)):
+    return wallet_view(current_user.balances())
+
+@api_router.websocket("/stream")
+async def stream_wallet(websocket: WebSocket, token: Optional[str] = None):
+    """Push wallet updates as ledger entries land for the connected user"""
+    # Browsers cannot set headers on WebSocket handshakes, so accept ?token= as well
+    if token is None:
+        authorization = websocket.headers.get("authorization", "")
+        if authorization.lower().startswith("bearer "):
+            token = authorization[7:]
+    try:
+        user = await resolve_user(websocket.cookies.get("session_token"), token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    await websocket.accept()
+    queue = wallet_broker.subscribe(user.id)
+    last_seq = user.ledger_seq
+    try:
+        await websocket.send_json({"type": "wallet", "seq": last_seq, "wallet": wallet_view(user.balances())})
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=WALLET_STREAM_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                # Also detects clients that went away without a close frame
+                await websocket.send_json({"type": "keepalive"})
+                continue
+            if event["seq"] <= last_seq:
+                continue
+            last_seq = event["seq"]
+            await websocket.send_json(event)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        wallet_broker.unsubscribe(user.id, queue)
+
+@api_router.get("/portfolio")
+async def get_portfolio(current_user: User = Depends(get_current_user)):
+    """Balances plus the incrementally maintained portfolio totals"""
+    summary = await db.portfolio_summaries.find_one({"user_id": current_user.id}, {"_id": 0})
+    if summary is None or "backfilled_through" not in summary:
+        # Until the history is recounted, serve the incrementally kept totals
+        summary = await backfill_portfolio_summary(current_user.id) or summary or {}
+    
+    return {
+        "wallet": wallet_view(current_user.balances()),
+        "total_invested": summary.get("total_invested", 0.0),
+        "total_profit_loss": summary.get("total_profit_loss", 0.0),
+        "total_redeemed": summary.get("total_redeemed", 0.0),
+        "total_rewards": summary.get("total_rewards", 0.0),
+        "strategies": summary.get("strategies", {}),
+        "transaction_counts": summary.get("transaction_counts", {}),
+        "last_activity_at": summary.get("last_activity_at")
+    }
+
+HISTORY_RANGE = re.compile(r"^(\d+)([dwmy])$")
+HISTORY_RANGE_DAYS = {"d": 1, "w": 7, "m": 30, "y": 365}
+HISTORY_MAX_DAYS = 10 * 365
+HISTORY_MAX_POINTS = 1000
+
+def downsample(series: List[tuple], threshold: int) -> List[tuple]:
+    """Largest-Triangle-Three-Buckets: `threshold` points of (x, y, ...) that keep the shape of the series"""
+    if threshold >= len(series) or threshold < 3:
+        return series
+    sampled = [series[0]]
+    every = (len(series) - 2) / (threshold - 2)
+    selected = 0
+    for i in range(threshold - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(series))
+        next_bucket = series[end:next_end] or series[-1:]
+        avg_x = sum(point[0] for point in next_bucket) / len(next_bucket)
+        avg_y = sum(point[1] for point in next_bucket) / len(next_bucket)
+        ax, ay = series[selected][0], series[selected][1]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (series[j][1] - ay) - (ax - series[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(series[best])
+        selected = best
+    sampled.append(series[-1])
+    return sampled
+
+@api_router.get("/portfolio/history")
+async def get_portfolio_history(history_range: str = Query("1y", alias="range"), points: int = 100, current_user: User = Depends(get_current_user)):
+    """Daily closing equity over a range (e.g. 7d, 3m, 1y, all), downsampled to at most `points`"""
+    if history_range == "all":
+        days = HISTORY_MAX_DAYS
+    else:
+        match = HISTORY_RANGE.match(history_range)
+        if not match:
+            raise HTTPException(status_code=400, detail="range must look like 7d, 4w, 3m, 1y or all")
+        days = min(int(match.group(1)) * HISTORY_RANGE_DAYS[match.group(2)], HISTORY_MAX_DAYS)
+    points = max(2, min(points, HISTORY_MAX_POINTS))
+    
+    today = datetime.now(timezone.utc).date()
+    start = today - timedelta(days=days - 1)
+    prefix = f"{current_user.id}:"
+    buckets, previous = await asyncio.gather(
+        reader("history").equity_history.find(
+            {"_id": {"$gte": f"{prefix}{start:%Y-%m}", "$lte": f"{prefix}{today:%Y-%m}"}}
+        ).sort("_id", 1).to_list(None),
+        # Latest bucket before the range supplies the opening value
+        reader("history").equity_history.find_one(
+            {"_id": {"$gte": prefix, "$lt": f"{prefix}{start:%Y-%m}"}},
+            sort=[("_id", -1)]
+        )
+    )
+    
+    closes: Dict[str, float] = {}
+    opening = None
+    if previous:
+        opening = previous["days"][max(previous["days"])]["equity"]
+    for bucket in buckets:
+        for day, point in sorted(bucket.get("days", {}).items()):
+            date = f"{bucket['month']}-{day}"
+            if date < start.isoformat():
+                opening = point["equity"]
+            else:
+                closes[date] = point["equity"]
+    # Today closes at the current balances
+    closes[today.isoformat()] = equity_value(current_user.balances())
+    
+    # Carry the last close forward over days without activity, from the first known value
+    series = []
+    value = opening
+    for offset in range(days):
+        date = (start + timedelta(days=offset)).isoformat()
+        value = closes.get(date, value)
+        if value is not None:
+            series.append((offset, value, date))
+    
+    return {
+        "range": history_range,
+        "start": series[0][2],
+        "end": today.isoformat(),
+        "points": [{"date": date, "equity": equity} for _, equity, date in downsample(series, points)]
+    }
+
+# Portfolio metrics
+# Computed with NumPy over the user's profit/loss ledger rows and cached per worker
+# under (user, ledger_seq): any new ledger entry, settlement and accrual included,
+# changes the seq and so invalidates the entry. Returns are P&L relative to the
+# capital invested in the strategy (or in total for the overall figures).
+PORTFOLIO_METRICS_CACHE_SIZE = 10_000
+PORTFOLIO_METRICS_TTL_SECONDS = 600
+TRADING_PERIODS_PER_YEAR = 252
+
+portfolio_metrics_cache = TTLCache(PORTFOLIO_METRICS_CACHE_SIZE, PORTFOLIO_METRICS_TTL_SECONDS)
+
+def series_metrics(amounts: np.ndarray, capital: float) -> Dict[str, Any]:
+    trades = len(amounts)
+    metrics = {
+        "trades": trades,
+        "capital": capital,
+        "total_profit_loss": float(amounts.sum()) if trades else 0.0,
+        "win_rate": float((amounts > 0).mean()) if trades else None,
+        "return": None,
+        "volatility": None,
+        "sharpe": None,
+        "max_drawdown": None,
+    }
+    if not trades or capital <= 0:
+        return metrics
+    
+    returns = amounts / capital
+    equity = capital + np.cumsum(amounts)
+    peaks = np.maximum.accumulate(np.maximum(equity, capital))
+    metrics["return"] = float(returns.sum())
+    metrics["max_drawdown"] = float(((equity - peaks) / peaks).min())
+    if trades > 1:
+        deviation = float(returns.std(ddof=1))
+        metrics["volatility"] = deviation * math.sqrt(TRADING_PERIODS_PER_YEAR)
+        if deviation > 0:
+            metrics["sharpe"] = float(returns.mean()) / deviation * math.sqrt(TRADING_PERIODS_PER_YEAR)
+    return metrics
+
+async def compute_portfolio_metrics(user_id: str) -> Dict[str, Any]:
+    # Primary reads. The newest seq is read first: every transaction it covers is
+    # in the list below unless an earlier write is still buffered
+    newest = await db.transactions.find_one(
+        {"user_id": user_id, "seq": {"$exists": True}},
+        {"_id": 0, "seq": 1},
+        sort=[("seq", -1)]
+    )
+    transactions, positions = await asyncio.gather(
+        db.transactions.find(
+            {"user_id": user_id, "transaction_type": {"$in": [TransactionType.PROFIT.value, TransactionType.LOSS.value]}},
+            {"_id": 0, "amount": 1, "strategy_id": 1}
+        ).sort("created_at", 1).to_list(None),
+        db.user_strategies.find({"user_id": user_id}, {"_id": 0, "strategy_id": 1, "invested_amount": 1}).to_list(None)
+    )
+    
+    capital: Dict[str, float] = {}
+    for position in positions:
+        capital[position["strategy_id"]] = capital.get(position["strategy_id"], 0.0) + position["invested_amount"]
+    
+    amounts = np.fromiter((transaction["amount"] for transaction in transactions), dtype=float, count=len(transactions))
+    ids = np.array([transaction.get("strategy_id") for transaction in transactions], dtype=object)
+    strategy_ids = [strategy_id for strategy_id in ids if strategy_id]
+    
+    names = {}
+    if strategy_ids:
+        strategies = await reader("catalog").strategies.find(
+            {"id": {"$in": list(set(strategy_ids))}},
+            {"_id": 0, "id": 1, "name": 1}
+        ).to_list(None)
+        names = {strategy["id"]: strategy["name"] for strategy in strategies}
+    
+    return {
+        "ledger_seq": newest["seq"] if newest else 0,
+        "overall": series_metrics(amounts, sum(capital.values())),
+        "strategies": {
+            strategy_id: {
+                "name": names.get(strategy_id),
+                **series_metrics(amounts[ids == strategy_id], capital.get(strategy_id, 0.0))
+            }
+            for strategy_id in dict.fromkeys(strategy_ids)
+        }
+    }
+
+@api_router.get("/portfolio/metrics")
+async def get_portfolio_metrics(current_user: User = Depends(get_current_user)):
+    """Return, volatility, Sharpe, max drawdown and win rate, per strategy and overall"""
+    key = (current_user.id, current_user.ledger_seq)
+    metrics = portfolio_metrics_cache.get(key)
+    if metrics is None:
+        metrics = await singleflight.do(("portfolio_metrics", key), lambda: compute_portfolio_metrics(current_user.id))
+        # Entries still in the write buffer are missing; don't keep the result under this seq
+        if metrics["ledger_seq"] == current_user.ledger_seq:
+            portfolio_metrics_cache.put(key, metrics)
+    return metrics
+
+# Strategy results
+# One document per uploaded sheet row, independent of how many users hold the
+# strategy, so strategy-level analytics scale with rows instead of rows x
+# subscribers. Stored as a time-series collection (date, strategy_id as meta)
+# where the server supports it.
+async def ensure_strategy_results_collection():
+    if "strategy_results" in await db.list_collection_names():
+        return
+    try:
+        await db.create_collection(
+            "strategy_results",
+            timeseries={"timeField": "date", "metaField": "strategy_id", "granularity": "hours"}
+        )
+    except Exception as e:
+        # Servers before 5.0 have no time-series collections; a regular one is created on first insert
+        logger.warning(f"strategy_results created as a regular collection: {e}")
+
+def strategy_result_document(strategy_id: str, row: Dict[str, Any], date: datetime, upload_id: str, subscribers: int, created_at: datetime) -> Dict[str, Any]:
+    return {
+        "date": date,
+        "strategy_id": strategy_id,
+        "upload_id": upload_id,
+        "transaction_type": row['TransactionType'],
+        "trade_details": row['TradeDetails'],
+        "profit_loss_percentage": float(row['ProfitLossPercentage']),
+        "subscribers": subscribers,
+        "created_at": created_at
+    }
+
+async def strategy_result_series(strategy_id: str, start: Optional[datetime] = None):
+    """Result dates (datetime64) and P&L percentages of a strategy in date order"""
+    query: Dict[str, Any] = {"strategy_id": strategy_id}
+    if start is not None:
+        query["date"] = {"$gte": start}
+    rows = await reader("history").strategy_results.find(
+        query, {"_id": 0, "date": 1, "profit_loss_percentage": 1}
+    ).sort("date", 1).to_list(None)
+    dates = np.array([row["date"] for row in rows], dtype="datetime64[ms]")
+    percentages = np.fromiter((row["profit_loss_percentage"] for row in rows), dtype=float, count=len(rows))
+    return dates, percentages
+
+@api_router.get("/strategies/{strategy_id}/backtest")
+async def backtest_strategy(
+    strategy_id: str,
+    amount: float = Query(..., gt=0),
+    start_date: Optional[date] = None,
+    points: int = 100,
+    current_user: User = Depends(get_current_user)
+):
+    """Replay `amount` invested on `start_date` against the strategy's recorded results"""
+    strategy = await singleflight.do(
+        ("strategy", strategy_id),
+        lambda: reader("catalog").strategies.find_one({"id": strategy_id, "is_active": True}, {"_id": 0})
+    )
+    if not strategy:
+        raise HTTPException(status_code=404, detail="Strategy not found")
+    
+    start = datetime.combine(start_date, datetime.min.time(), tzinfo=timezone.utc) if start_date else None
+    dates, percentages = await strategy_result_series(strategy_id, start)
+    if not len(percentages):
+        raise HTTPException(status_code=404, detail="No trading results for this strategy in range")
+    
+    # Settlement credits each row on the invested amount, without compounding
+    profit_loss = amount * percentages / 100
+    equity = amount + np.cumsum(profit_loss)
+    peaks = np.maximum.accumulate(np.maximum(equity, amount))
+    days = dates.astype("datetime64[D]")
+    closes = np.flatnonzero(np.r_[days[1:] != days[:-1], True])
+    series = [(i, float(equity[index]), str(days[index])) for i, index in enumerate(closes)]
+    
+    return {
+        "strategy_id": strategy_id,
+        "amount": amount,
+        "start_date": str(days[0]),
+        "end_date": str(days[-1]),
+        "trades": len(percentages),
+        "final_value": float(equity[-1]),
+        "total_profit_loss": float(profit_loss.sum()),
+        "return": float(percentages.sum() / 100),
+        "win_rate": float((percentages > 0).mean()),
+        "max_drawdown": float(((equity - peaks) / peaks).min()),
+        "points": [
+            {"date": day, "equity": value}
+            for _, value, day in downsample(series, max(2, min(points, HISTORY_MAX_POINTS)))
+        ]
+    }
+
+# Strategy simulation
+# Bootstrap Monte Carlo over the strategy's historical per-trade P&L percentages.
+# Settlement credits P&L on the invested amount without compounding, so outcomes
+# scale linearly with the amount: paths are simulated once per (strategy, horizon)
+# in percent and scaled per request, which makes every amount bucket share an
+# entry. Entries are keyed by the results version bumped on each upload. Paths
+# run in simulation.py, which the spawned workers import instead of this module.
+SIMULATION_WORKERS = int(os.getenv('SIMULATION_WORKERS', '2'))
+SIMULATION_PATHS = int(os.getenv('SIMULATION_PATHS', '5000'))
+SIMULATION_MAX_TRADES = 1000
+SIMULATION_BAND_POINTS = 30
+simulation_cache = TTLCache(1_000, 3600)
+simulation_pool: Optional[ProcessPoolExecutor] = None
+
+async def strategy_trade_history(strategy_id: str):
+    """Per-trade P&L percentages and the number of trading days they span"""
+    dates, percentages = await strategy_result_series(strategy_id)
+    return percentages, len(np.unique(dates.astype("datetime64[D]")))
+
+async def simulate_strategy(strategy_id: str, horizon_days: int) -> Optional[Dict[str, Any]]:
+    global simulation_pool
+    percentages, days = await strategy_trade_history(strategy_id)
+    if not len(percentages):
+        return None
+    
+    trades_per_day = len(percentages) / max(1, days)
+    trades = int(min(SIMULATION_MAX_TRADES, max(1, round(horizon_days * trades_per_day))))
+    checkpoints = np.unique(np.linspace(1, trades, min(trades, SIMULATION_BAND_POINTS)).round().astype(int))
+    if simulation_pool is None:
+        # Spawned, not forked: a fork would copy the event loop and the Mongo client's threads
+        simulation_pool = ProcessPoolExecutor(max_workers=SIMULATION_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    with trace_span("simulation.run", **{"simulation.trades": trades, "simulation.paths": SIMULATION_PATHS}):
+        bands = await asyncio.get_running_loop().run_in_executor(
+            simulation_pool, simulate_paths, percentages, trades, SIMULATION_PATHS, checkpoints
+        )
+    return {
+        "history_trades": len(percentages),
+        "trades_per_day": trades_per_day,
+        "trades": trades,
+        "paths": SIMULATION_PATHS,
+        "days": (checkpoints / trades_per_day).tolist(),
+        "bands": {f"p{q}": band for q, band in zip(SIMULATION_PERCENTILES, bands.tolist())}
+    }
+
+@api_router.post("/strategies/{strategy_id}/simulate")
+async def simulate_strategy_outcomes(strategy_id: str, request: SimulationRequest, current_user: User = Depends(get_current_user)):
+    """Percentile bands of the value of `amount` invested for `horizon_days`"""
+    strategy = await singleflight.do(
+        ("strategy", strategy_id),
+        lambda: reader("catalog").strategies.find_one({"id": strategy_id, "is_active": True}, {"_id": 0})
+    )
+    if not strategy:
+        raise HTTPException(status_code=404, detail="Strategy not found")
+    
+    key = (strategy_id, request.horizon_days, await catalog_version("results"))
+    simulation = simulation_cache.get(key)
+    if simulation is None:
+        simulation = await singleflight.do(("simulation", key), lambda: simulate_strategy(strategy_id, request.horizon_days))
+        if simulation is None:
+            raise HTTPException(status_code=404, detail="No trading results for this strategy yet")
+        simulation_cache.put(key, simulation)
+    
+    amount = request.amount
+    return {
+        "strategy_id": strategy_id,
+        "amount": amount,
+        "horizon_days": request.horizon_days,
+        "history_trades": simulation["history_trades"],
+        "trades": simulation["trades"],
+        "paths": simulation["paths"],
+        "bands": {
+            percentile: [
+                {"day": day, "value": amount * (1 + change / 100)}
+                for day, change in zip(simulation["days"], band)
+            ]
+            for percentile, band in simulation["bands"].items()
+        },
+        "outcomes": {
+            percentile: amount * (1 + band[-1] / 100)
+            for percentile, band in simulation["bands"].items()
+        }
+    }
+
+# Leaderboard
+# Trading earnings (sum of total_profit_loss over a user's positions) ranked
+# overall and per strategy. Each worker keeps one RankedSet per board, an
+# indexable skip list giving rank and top-N in O(log n). Settlement $incs the
+# persisted scores in leaderboard_scores and applies the same deltas locally;
+# workers pick up each other's writes by syncing scores updated since their last
+# sync. A periodic rebuild recomputes every score from user_strategies and
+# writes only the corrections, which also folds in accrual credits applied by
+# server-side pipelines; it runs under the accrual lease so no accrual is half
+# applied. Settlement $incs user_strategies before it records its deltas, so each
+# upload is registered in leaderboard_uploads with a version from
+# leaderboard_state first and its deltas are tagged with the upload. A rebuild is
+# abandoned if an upload is settling or the version moved while it read, and it
+# only overwrites scores still equal to what it read.
+LEADERBOARD_SYNC_SECONDS = 10
+LEADERBOARD_REBUILD_SECONDS = int(os.getenv('LEADERBOARD_REBUILD_SECONDS', str(24 * 60 * 60)))
+LEADERBOARD_SETTLE_TIMEOUT_SECONDS = 60 * 60  # a settling upload older than this has died
+LEADERBOARD_UPLOAD_RETENTION_DAYS = 7
+LEADERBOARD_MAX_LIMIT = 100
+LEADERBOARD_WRITE_BATCH = 1000
+OVERALL_BOARD = "overall"
+
+class RankedSet:
+    """Members ordered by descending score (ties by member); indexable skip list"""
+    MAX_LEVELS = 24
+    
+    class Node:
+        __slots__ = ("key", "next", "width")
+        
+        def __init__(self, key, levels: int):
+            self.key = key
+            self.next = [None] * levels
+            self.width = [1] * levels
+    
+    def __init__(self):
+        self.tail = self.Node((math.inf, ""), 0)
+        self.head = self.Node(None, self.MAX_LEVELS)
+        self.head.next = [self.tail] * self.MAX_LEVELS
+        self.scores: Dict[str, float] = {}
+    
+    def __len__(self) -> int:
+        return len(self.scores)
+    
+    def _insert(self, key):
+        chain, steps_at_level = [None] * self.MAX_LEVELS, [0] * self.MAX_LEVELS
+        node = self.head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key < key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        levels = 1
+        while levels < self.MAX_LEVELS and random.random() < 0.5:
+            levels += 1
+        new = self.Node(key, levels)
+        steps = 0
+        for level in range(levels):
+            previous = chain[level]
+            new.next[level] = previous.next[level]
+            previous.next[level] = new
+            new.width[level] = previous.width[level] - steps
+            previous.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(levels, self.MAX_LEVELS):
+            chain[level].width[level] += 1
+    
+    def _remove(self, key):
+        chain = [None] * self.MAX_LEVELS
+        node = self.head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        removed = chain[0].next[0]
+        for level in range(len(removed.next)):
+            previous = chain[level]
+            previous.width[level] += removed.width[level] - 1
+            previous.next[level] = removed.next[level]
+        for level in range(len(removed.next), self.MAX_LEVELS):
+            chain[level].width[level] -= 1
+    
+    def set(self, member: str, score: float):
+        current = self.scores.get(member)
+        if current == score:
+            return
+        if current is not None:
+            self._remove((-current, member))
+        self.scores[member] = score
+        self._insert((-score, member))
+    
+    def increment(self, member: str, delta: float):
+        self.set(member, self.scores.get(member, 0.0) + delta)
+    
+    def discard(self, member: str):
+        score = self.scores.pop(member, None)
+        if score is not None:
+            self._remove((-score, member))
+    
+    def rank(self, member: str) -> Optional[int]:
+        """0-based position of member, None if absent"""
+        score = self.scores.get(member)
+        if score is None:
+            return None
+        key, rank, node = (-score, member), 0, self.head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key < key:
+                rank += node.width[level]
+                node = node.next[level]
+        return rank
+    
+    def range(self, start: int, count: int) -> List[tuple]:
+        """(member, score) pairs at positions start .. start+count-1"""
+        if start >= len(self.scores):
+            return []
+        node, remaining = self.head, start + 1
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        items = []
+        while node is not self.tail and len(items) < count:
+            items.append((node.key[1], -node.key[0]))
+            node = node.next[0]
+        return items
+
+class Leaderboard:
+    def __init__(self):
+        self.boards: Dict[str, RankedSet] = {}
+        self.loaded = False
+        self.synced_at: Optional[datetime] = None
+        self.rebuilt_at: Optional[datetime] = None
+        self.rebuild_corrections = 0
+    
+    def board(self, strategy_id: Optional[str] = None) -> RankedSet:
+        return self.boards.get(f"strategy:{strategy_id}" if strategy_id else OVERALL_BOARD) or RankedSet()
+    
+    def apply(self, rows):
+        for row in rows:
+            self.boards.setdefault(row["board"], RankedSet()).set(row["user_id"], row["score"])
+    
+    async def load(self):
+        started = datetime.now(timezone.utc)
+        rows = await db.leaderboard_scores.find({}, {"_id": 0, "board": 1, "user_id": 1, "score": 1}).to_list(None)
+        self.boards = {}
+        self.apply(rows)
+        self.synced_at = started
+        self.loaded = True
+    
+    async def sync(self):
+        # Overlap the previous window so writes committed out of order are not missed
+        started = datetime.now(timezone.utc)
+        rows = await db.leaderboard_scores.find(
+            {"updated_at": {"$gte": self.synced_at - timedelta(seconds=LEADERBOARD_SYNC_SECONDS)}},
+            {"_id": 0, "board": 1, "user_id": 1, "score": 1}
+        ).to_list(None)
+        self.apply(rows)
+        self.synced_at = started
+    
+    async def begin_settlement(self, upload_id: str):
+        """Register an upload before its positions are credited"""
+        state = await db.leaderboard_state.find_one_and_update(
+            {"_id": "version"},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        await db.leaderboard_uploads.insert_one({
+            "_id": upload_id,
+            "version": state["version"],
+            "status": "settling",
+            "started_at": datetime.now(timezone.utc)
+        })
+    
+    async def settle_state(self) -> tuple:
+        """(version, whether an upload is still settling)"""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=LEADERBOARD_SETTLE_TIMEOUT_SECONDS)
+        state, settling = await asyncio.gather(
+            db.leaderboard_state.find_one({"_id": "version"}),
+            db.leaderboard_uploads.find_one({"status": "settling", "started_at": {"$gt": cutoff}}, {"_id": 1})
+        )
+        return (state or {}).get("version", 0), settling is not None
+    
+    async def record(self, deltas: Dict[tuple, float], upload_id: str):
+        """Add an upload's settlement deltas keyed by (user_id, strategy_id)"""
+        scores: Dict[tuple, float] = {}
+        for (user_id, strategy_id), delta in deltas.items():
+            scores[(f"strategy:{strategy_id}", user_id)] = scores.get((f"strategy:{strategy_id}", user_id), 0.0) + delta
+            scores[(OVERALL_BOARD, user_id)] = scores.get((OVERALL_BOARD, user_id), 0.0) + delta
+        
+        now = datetime.now(timezone.utc)
+        operations = [
+            UpdateOne(
+                {"_id": f"{board}:{user_id}"},
+                {"$inc": {"score": delta}, "$set": {"updated_at": now, "upload_id": upload_id}, "$setOnInsert": {"board": board, "user_id": user_id}},
+                upsert=True
+            )
+            for (board, user_id), delta in scores.items()
+        ]
+        for i in range(0, len(operations), LEADERBOARD_WRITE_BATCH):
+            await db.leaderboard_scores.bulk_write(operations[i:i + LEADERBOARD_WRITE_BATCH], ordered=False)
+        await db.leaderboard_uploads.update_one({"_id": upload_id}, {"$set": {"status": "recorded", "recorded_at": now}})
+        if self.loaded:
+            for (board, user_id), delta in scores.items():
+                self.boards.setdefault(board, RankedSet()).increment(user_id, delta)
+    
+    async def rebuild(self) -> bool:
+        """Recompute every score from user_strategies and persist the differences.
+        
+        The caller holds the accrual lease. Returns False if settlement interfered.
+        """
+        version, settling = await self.settle_state()
+        if settling:
+            logger.info("Leaderboard rebuild skipped: an upload is settling")
+            return False
+        current = {
+            (row["board"], row["user_id"]): row["score"]
+            for row in await db.leaderboard_scores.find({}, {"_id": 0, "board": 1, "user_id": 1, "score": 1}).to_list(None)
+        }
+        rows = await db.user_strategies.aggregate([
+            {"$group": {
+                "_id": {"user_id": "$user_id", "strategy_id": "$strategy_id"},
+                "score": {"$sum": {"$ifNull": ["$total_profit_loss", 0]}}
+            }}
+        ], allowDiskUse=True).to_list(None)
+        # An upload that started meanwhile may be in user_strategies but not in the scores read
+        if await self.settle_state() != (version, False):
+            logger.info("Leaderboard rebuild skipped: an upload settled while reading")
+            return False
+        
+        expected: Dict[tuple, float] = {}
+        for row in rows:
+            user_id, strategy_id = row["_id"]["user_id"], row["_id"]["strategy_id"]
+            expected[(f"strategy:{strategy_id}", user_id)] = row["score"]
+            expected[(OVERALL_BOARD, user_id)] = expected.get((OVERALL_BOARD, user_id), 0.0) + row["score"]
+        
+        now = datetime.now(timezone.utc)
+        operations = []
+        for (board, user_id), score in expected.items():
+            existing = current.get((board, user_id))
+            if existing is None:
+                operations.append(UpdateOne(
+                    {"_id": f"{board}:{user_id}"},
+                    {"$setOnInsert": {"board": board, "user_id": user_id, "score": score, "updated_at": now}},
+                    upsert=True
+                ))
+            elif abs(existing - score) > 1e-9:
+                # Left alone if a settlement $inc landed since it was read
+                operations.append(UpdateOne(
+                    {"_id": f"{board}:{user_id}", "score": existing},
+                    {"$set": {"score": score, "updated_at": now}}
+                ))
+        operations += [
+            DeleteOne({"_id": f"{board}:{user_id}", "score": score})
+            for (board, user_id), score in current.items()
+            if (board, user_id) not in expected
+        ]
+        for i in range(0, len(operations), LEADERBOARD_WRITE_BATCH):
+            await db.leaderboard_scores.bulk_write(operations[i:i + LEADERBOARD_WRITE_BATCH], ordered=False)
+        
+        await self.load()
+        self.rebuilt_at = now
+        self.rebuild_corrections = len(operations)
+        if self.rebuild_corrections:
+            logger.info(f"Leaderboard rebuild corrected {self.rebuild_corrections} scores")
+        return True
+    
+    async def rebuild_if_due(self):
+        holder = str(uuid.uuid4())
+        if not await acquire_accrual_lease(holder):
+            return
+        try:
+            now = datetime.now(timezone.utc)
+            try:
+                # One worker per interval: the lease document only matches once it is stale
+                await db.leaderboard_state.find_one_and_update(
+                    {"_id": "rebuild", "rebuilt_at": {"$lt": now - timedelta(seconds=LEADERBOARD_REBUILD_SECONDS)}},
+                    {"$set": {"rebuilt_at": now}},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                return
+            if not await self.rebuild():
+                # Try again on the next loop
+                await db.leaderboard_state.update_one(
+                    {"_id": "rebuild"},
+                    {"$set": {"rebuilt_at": now - timedelta(seconds=LEADERBOARD_REBUILD_SECONDS)}}
+                )
+        finally:
+            await release_accrual_lease(holder)
+    
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "loaded": self.loaded,
+            "boards": len(self.boards),
+            "members": sum(len(ranked) for ranked in self.boards.values()),
+            "synced_at": self.synced_at.isoformat() if self.synced_at else None,
+            "rebuilt_at": self.rebuilt_at.isoformat() if self.rebuilt_at else None,
+            "rebuild_corrections": self.rebuild_corrections
+        }
+
+leaderboard = Leaderboard()
+
+async def leaderboard_loop():
+    while True:
+        try:
+            if leaderboard.loaded:
+                await leaderboard.sync()
+            else:
+                await singleflight.do("leaderboard_load", leaderboard.load)
+            await leaderboard.rebuild_if_due()
+        except Exception as e:
+            logger.error(f"Leaderboard refresh failed: {e}")
+        await asyncio.sleep(LEADERBOARD_SYNC_SECONDS)
+
+@api_router.get("/leaderboard")
+async def get_leaderboard(strategy_id: Optional[str] = None, limit: int = 10, offset: int = 0, current_user: User = Depends(get_current_user)):
+    """Top earners overall, or in one strategy, with the caller's own rank"""
+    if not leaderboard.loaded:
+        await singleflight.do("leaderboard_load", leaderboard.load)
+    ranked = leaderboard.board(strategy_id)
+    limit = max(1, min(limit, LEADERBOARD_MAX_LIMIT))
+    offset = max(0, offset)
+    
+    entries = ranked.range(offset, limit)
+    users = await db.users.find(
+        {"id": {"$in": [user_id for user_id, _ in entries]}},
+        {"_id": 0, "id": 1, "name": 1, "profile_picture": 1}
+    ).to_list(None)
+    profiles = {user["id"]: user for user in users}
+    
+    rank = ranked.rank(current_user.id)
+    return {
+        "strategy_id": strategy_id,
+        "total": len(ranked),
+        "entries": [
+            {
+                "rank": offset + i + 1,
+                "user_id": user_id,
+                "name": profiles.get(user_id, {}).get("name"),
+                "profile_picture": profiles.get(user_id, {}).get("profile_picture"),
+                "earnings": score
+            }
+            for i, (user_id, score) in enumerate(entries)
+        ],
+        "me": {
+            "rank": rank + 1 if rank is not None else None,
+            "earnings": ranked.scores.get(current_user.id, 0.0)
+        }
+    }
+
+# Admin statistics
+# Dashboard totals kept as rollups in admin_stats and updated by the write paths,
+# so the dashboard reads a fixed number of documents however large the
+# collections grow. Totals are $inc-ed into one of ADMIN_STATS_SHARDS documents
+# picked at random to spread write contention and summed on read; signups are
+# counted per day. A nightly recompute from the source collections adds the
+# difference to shard 0, correcting drift without overwriting concurrent writes.
+# The rollups are snapshotted before the sources are read and compared with a
+# second snapshot taken after, each ADMIN_STATS_SETTLE_SECONDS apart; a counter
+# that moved in between may or may not be in the recount, so it is left for the
+# next recompute instead of being corrected against the first snapshot.
+ADMIN_STATS_SHARDS = 16
+ADMIN_STATS_RECOMPUTE_SECONDS = 24 * 60 * 60
+ADMIN_STATS_CHECK_SECONDS = 60 * 60
+ADMIN_STATS_MAX_DAYS = 365
+ADMIN_STATS_SETTLE_SECONDS = 30  # longer than a write takes to reach both its source and the rollup
+
+def admin_stats_shards() -> List[str]:
+    return [f"totals:{shard}" for shard in range(ADMIN_STATS_SHARDS)]
+
+async def increment_admin_stats(increments: Dict[str, float]):
+    await db.admin_stats.update_one(
+        {"_id": f"totals:{random.randrange(ADMIN_STATS_SHARDS)}"},
+        {"$inc": increments},
+        upsert=True
+    )
+
+def admin_stats_increments(transaction_type: TransactionType, amount: float, strategy_id: Optional[str]) -> Dict[str, float]:
+    """Rollup increments of a ledger entry; redemptions are counted with their coupon instead"""
+    if transaction_type == TransactionType.BUY and strategy_id:
+        return {"aum": amount, f"strategies.{strategy_id}.aum": amount, f"strategies.{strategy_id}.positions": 1}
+    if transaction_type in REWARD_TRANSACTION_TYPES:
+        return {"reward_volume": amount, f"rewards.{transaction_type.value}": amount}
+    return {}
+
+async def record_signup(user: User):
+    await asyncio.gather(
+        increment_admin_stats({"users": 1, f"users_by_role.{user.role.value}": 1}),
+        db.admin_stats.update_one(
+            {"_id": f"signups:{user.created_at:%Y-%m-%d}"},
+            {"$inc": {"count": 1}},
+            upsert=True
+        )
+    )
+
+def merge_counts(target: Dict[str, Any], source: Dict[str, Any]):
+    for key, value in source.items():
+        if isinstance(value, dict):
+            merge_counts(target.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)):
+            target[key] = target.get(key, 0) + value
+
+def count_differences(expected: Dict[str, Any], current: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    """Dotted $inc that turns `current` into `expected`, for every counter in either"""
+    differences = {}
+    for key in expected.keys() | current.keys():
+        want, have = expected.get(key, 0), current.get(key, 0)
+        if isinstance(want, dict) or isinstance(have, dict):
+            differences.update(count_differences(want or {}, have or {}, f"{prefix}{key}."))
+        elif abs(want - have) > 1e-9:
+            differences[f"{prefix}{key}"] = want - have
+    return differences
+
+async def read_admin_totals() -> Dict[str, Any]:
+    totals: Dict[str, Any] = {}
+    for shard in await db.admin_stats.find({"_id": {"$in": admin_stats_shards()}}, {"_id": 0}).to_list(None):
+        merge_counts(totals, shard)
+    return totals
+
+async def read_admin_rollups() -> tuple:
+    """Summed totals and the per-day signup counts keyed by document id"""
+    totals, signups = await asyncio.gather(
+        read_admin_totals(),
+        db.admin_stats.find({"_id": {"$regex": "^signups:"}}).to_list(None)
+    )
+    return totals, {row["_id"]: row.get("count", 0) for row in signups}
+
+async def recompute_admin_stats() -> Dict[str, float]:
+    """Recount every rollup from the source collections; returns the corrections applied"""
+    totals, signup_counts = await read_admin_rollups()
+    await asyncio.sleep(ADMIN_STATS_SETTLE_SECONDS)
+    day_format = {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}
+    users, signups, positions, redemptions, rewards = await asyncio.gather(
+        db.users.aggregate([{"$group": {"_id": "$role", "count": {"$sum": 1}}}]).to_list(None),
+        db.users.aggregate([{"$group": {"_id": day_format, "count": {"$sum": 1}}}], allowDiskUse=True).to_list(None),
+        db.user_strategies.aggregate([
+            {"$match": {"is_active": True}},
+            {"$group": {"_id": "$strategy_id", "aum": {"$sum": "$invested_amount"}, "positions": {"$sum": 1}}}
+        ]).to_list(None),
+        db.coupon_redemptions.aggregate([
+            {"$group": {"_id": "$coupon_id", "redemptions": {"$sum": 1}, "points": {"$sum": "$points_used"}}}
+        ]).to_list(None),
+        db.transactions.aggregate([
+            {"$match": {"transaction_type": {"$in": [kind.value for kind in REWARD_TRANSACTION_TYPES]}}},
+            {"$group": {"_id": "$transaction_type", "amount": {"$sum": "$amount"}}}
+        ], allowDiskUse=True).to_list(None)
+    )
+    expected = {
+        "users": sum(row["count"] for row in users),
+        "users_by_role": {row["_id"]: row["count"] for row in users},
+        "aum": sum(row["aum"] for row in positions),
+        "strategies": {row["_id"]: {"aum": row["aum"], "positions": row["positions"]} for row in positions},
+        "redemptions": sum(row["redemptions"] for row in redemptions),
+        "redemption_points": sum(row["points"] for row in redemptions),
+        "coupons": {row["_id"]: {"redemptions": row["redemptions"], "points": row["points"]} for row in redemptions},
+        "reward_volume": sum(row["amount"] for row in rewards),
+        "rewards": {row["_id"]: row["amount"] for row in rewards}
+    }
+    
+    await asyncio.sleep(ADMIN_STATS_SETTLE_SECONDS)
+    totals_after, signup_counts_after = await read_admin_rollups()
+    moved = set(count_differences(totals_after, totals)) | set(count_differences(signup_counts_after, signup_counts))
+    
+    corrections = {
+        key: difference
+        for key, difference in count_differences(expected, totals).items()
+        if key not in moved
+    }
+    if corrections:
+        await db.admin_stats.update_one({"_id": "totals:0"}, {"$inc": corrections}, upsert=True)
+    expected_signups = {f"signups:{row['_id']}": row["count"] for row in signups}
+    signup_corrections = {
+        key: difference
+        for key, difference in count_differences(expected_signups, signup_counts).items()
+        if key not in moved
+    }
+    for key, difference in signup_corrections.items():
+        await db.admin_stats.update_one({"_id": key}, {"$inc": {"count": difference}}, upsert=True)
+    await db.admin_stats.update_one(
+        {"_id": "recompute"},
+        {"$set": {
+            "finished_at": datetime.now(timezone.utc),
+            "corrections": len(corrections) + len(signup_corrections),
+            "deferred": len(moved)
+        }},
+        upsert=True
+    )
+    if corrections or signup_corrections:
+        logger.info(f"Admin stats recompute corrected {len(corrections) + len(signup_corrections)} counters, deferred {len(moved)}")
+    return {**corrections, **signup_corrections}
+
+async def admin_stats_scheduler():
+    while True:
+        now = datetime.now(timezone.utc)
+        try:
+            # The lease document only matches once the last recompute is a day old
+            await db.admin_stats.find_one_and_update(
+                {"_id": "recompute", "started_at": {"$lt": now - timedelta(seconds=ADMIN_STATS_RECOMPUTE_SECONDS)}},
+                {"$set": {"started_at": now}},
+                upsert=True
+            )
+            await recompute_admin_stats()
+        except DuplicateKeyError:
+            pass
+        except Exception as e:
+            logger.error(f"Admin stats recompute failed: {e}")
+        await asyncio.sleep(ADMIN_STATS_CHECK_SECONDS)
+
+@api_router.get("/admin/stats")
+async def get_admin_stats(days: int = 30, current_user: User = Depends(get_current_user)):
+    """Dashboard totals from the admin_stats rollups, with signups for the last `days` days"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    days = max(1, min(days, ADMIN_STATS_MAX_DAYS))
+    today = datetime.now(timezone.utc).date()
+    dates = [(today - timedelta(days=offset)).isoformat() for offset in reversed(range(days))]
+    totals, signups, recompute = await asyncio.gather(
+        read_admin_totals(),
+        db.admin_stats.find({"_id": {"$gte": f"signups:{dates[0]}", "$lte": f"signups:{dates[-1]}"}}).to_list(None),
+        db.admin_stats.find_one({"_id": "recompute"}, {"_id": 0})
+    )
+    signup_counts = {row["_id"].split(":", 1)[1]: row["count"] for row in signups}
+    
+    strategy_totals, coupon_totals = totals.get("strategies", {}), totals.get("coupons", {})
+    strategies, coupons = await asyncio.gather(
+        reader("catalog").strategies.find({"id": {"$in": list(strategy_totals)}}, {"_id": 0, "id": 1, "name": 1}).to_list(None),
+        reader("catalog").coupons.find({"id": {"$in": list(coupon_totals)}}, {"_id": 0, "id": 1, "title": 1}).to_list(None)
+    )
+    strategy_names = {strategy["id"]: strategy["name"] for strategy in strategies}
+    coupon_titles = {coupon["id"]: coupon["title"] for coupon in coupons}
+    
+    return {
+        "users": {"total": totals.get("users", 0), "by_role": totals.get("users_by_role", {})},
+        "signups": [{"date": date, "count": signup_counts.get(date, 0)} for date in dates],
+        "aum": {
+            "total": totals.get("aum", 0.0),
+            "strategies": [
+                {"strategy_id": strategy_id, "name": strategy_names.get(strategy_id), "aum": values.get("aum", 0.0), "positions": values.get("positions", 0)}
+                for strategy_id, values in sorted(strategy_totals.items(), key=lambda item: -item[1].get("aum", 0.0))
+                if values.get("positions")
+            ]
+        },
+        "redemptions": {
+            "total": totals.get("redemptions", 0),
+            "points": totals.get("redemption_points", 0.0),
+            "coupons": [
+                {"coupon_id": coupon_id, "title": coupon_titles.get(coupon_id), "redemptions": values.get("redemptions", 0), "points": values.get("points", 0.0)}
+                for coupon_id, values in sorted(coupon_totals.items(), key=lambda item: -item[1].get("redemptions", 0))
+                if values.get("redemptions")
+            ]
+        },
+        "rewards": {"total": totals.get("reward_volume", 0.0), "by_type": totals.get("rewards", {})},
+        "recomputed_at": recompute.get("finished_at") if recompute else None
+    }
+
+# Maximum items per section of the aggregated home payload
+HOME_SECTION_LIMITS = {"strategies": 20, "user_strategies": 50, "transactions": 10}
+HOME_STRATEGY_FIELDS = {"_id": 0, "id": 1, "name": 1, "description": 1, "strategy_type": 1, "monthly_returns": 1, "capital_required": 1}
+HOME_TRANSACTION_FIELDS = {"_id": 0, "id": 1, "strategy_id": 1, "transaction_type": 1, "amount": 1, "description": 1, "created_at": 1}
+
+def home_section(items: List[Dict[str, Any]], limit: int) -> Dict[str, Any]:
+    # Sections are queried with limit + 1 so truncation can be reported without a count
+    return {"items": items[:limit], "has_more": len(items) > limit}
+
+@api_router.get("/home")
+async def get_home(current_user: User = Depends(get_current_user)):
+    """Everything the home screen needs in one round trip"""
+    strategies, user_strategies, transactions = await asyncio.gather(
+        active_catalog("strategies", HOME_STRATEGY_FIELDS, HOME_SECTION_LIMITS["strategies"] + 1),
+        load_user_strategies(current_user.id, HOME_SECTION_LIMITS["user_strategies"] + 1),
+        reader("history").transactions.find(
+            {"user_id": current_user.id},
+            HOME_TRANSACTION_FIELDS
+        ).sort("created_at", -1).to_list(HOME_SECTION_LIMITS["transactions"] + 1)
+    )
+    
     return {
-        "virtual_balance": current_user.virtual_balance,
-        "earnings_balance": current_user.earnings_balance,
-        "task_balance": current_user.task_balance,
-        "total_investment": current_user.total_investment,
-        "available_for_investment": current_user.virtual_balance + current_user.earnings_balance,
-        "available_for_coupons": current_user.earnings_balance,
-        "total_balance": current_user.virtual_balance + current_user.earnings_balance + current_user.task_balance
+        "wallet": wallet_view(current_user.balances()),
+        "strategies": home_section(strategies, HOME_SECTION_LIMITS["strategies"]),
+        "user_strategies": home_section(user_strategies, HOME_SECTION_LIMITS["user_strategies"]),
+        "transactions": home_section(transactions, HOME_SECTION_LIMITS["transactions"])
     }
 
 @api_router.get("/transactions")
-async def get_transactions(current_user: User = Depends(get_current_user)):
-    transactions = await db.transactions.find(
+async def get_transactions(request: Request, response: Response, current_user: User = Depends(get_current_user)):
+    newest = await reader("history").transactions.find_one(
+        {"user_id": current_user.id, "seq": {"$exists": True}},
+        {"_id": 0, "seq": 1},
+        sort=[("seq", -1)]
+    )
+    response.headers["Vary"] = "Authorization, Cookie"
+    # Until the newest entry is readable the list is incomplete; leave it untagged
+    if (newest["seq"] if newest else 0) == current_user.ledger_seq:
+        cached = not_modified(
+            request, response,
+            user_etag("transactions", current_user.id, current_user.ledger_seq),
+            vary="Authorization, Cookie"
+        )
+        if cached:
+            return cached
+    transactions = await reader("history").transactions.find(
         {"user_id": current_user.id},
         {"_id": 0}
     ).sort("created_at", -1).to_list(1000)
@@ -829,13 +4149,19 @@ async def get_transactions(current_user: User = Depends(get_current_user)):
 
 # Coupon Routes with OTP verification
 @api_router.get("/coupons", response_model=List[Coupon])
-async def get_coupons(current_user: User = Depends(get_current_user)):
-    coupons = await db.coupons.find({"is_active": True}, {"_id": 0}).to_list(1000)
+async def get_coupons(request: Request, response: Response, current_user: User = Depends(get_current_user)):
+    cached = not_modified(request, response, f'W/"coupons-{await catalog_version("coupons")}"')
+    if cached:
+        return cached
+    version, coupons = await catalog_snapshot("coupons")
+    response.headers["ETag"] = f'W/"coupons-{version}"'
     return [Coupon(**coupon) for coupon in coupons]
 
 @api_router.post("/coupons/send-redemption-otp")
-async def send_coupon_redemption_otp(coupon_id: str = Form(...), current_user: User = Depends(get_current_user)):
+async def send_coupon_redemption_otp(request: Request, coupon_id: str = Form(...), current_user: User = Depends(get_current_user)):
     """Send OTP for coupon redemption"""
+    await rate_limiter.check(("otp-ip", client_ip(request)), ("otp-email", current_user.email.lower()))
+    
     coupon = await db.coupons.find_one({"id": coupon_id, "is_active": True}, {"_id": 0})
     if not coupon:
         raise HTTPException(status_code=404, detail="Coupon not found")
@@ -875,8 +4201,14 @@ async def send_coupon_redemption_otp(coupon_id: str = Form(...), current_user: U
     return {"message": "OTP sent for coupon redemption", "expires_in": 600}
 
 @api_router.post("/coupons/redeem")
-async def redeem_coupon(redeem_request: CouponRedeemRequest, current_user: User = Depends(get_current_user)):
+async def redeem_coupon(redeem_request: CouponRedeemRequest, request: Request, response: Response, current_user: User = Depends(get_current_user)):
     """Redeem coupon with OTP verification"""
+    return await idempotency.run(
+        request, response, f"redeem:{current_user.id}",
+        lambda: process_coupon_redemption(redeem_request, current_user)
+    )
+
+async def process_coupon_redemption(redeem_request: CouponRedeemRequest, current_user: User):
     # Verify OTP
     otp_session = await db.otp_sessions.find_one({
         "email": redeem_request.email,
@@ -916,25 +4248,25 @@ async def redeem_coupon(redeem_request: CouponRedeemRequest, current_user: User
         points_used=coupon["points_required"]
     )
     
+    begin_side_effects()
     await db.coupon_redemptions.insert_one(redemption.dict())
+    await increment_admin_stats({
+        "redemptions": 1,
+        "redemption_points": coupon["points_required"],
+        f"coupons.{redeem_request.coupon_id}.redemptions": 1,
+        f"coupons.{redeem_request.coupon_id}.points": coupon["points_required"]
+    })
     
-    # Update user earnings balance
-    await db.users.update_one(
-        {"id": current_user.id},
-        {"$inc": {"earnings_balance": -coupon["points_required"]}}
-    )
-    
-    # Create transaction record
-    transaction = Transaction(
-        user_id=current_user.id,
+    # Debit the user's earnings balance
+    await post_ledger_entry(
+        current_user.id,
+        {"earnings_balance": -coupon["points_required"]},
         transaction_type=TransactionType.COUPON_REDEMPTION,
         amount=-coupon["points_required"],
         description=f"Redeemed coupon: {coupon['title']}",
         virtual_money_type=VirtualMoneyType.EARNED_TRADING
     )
     
-    await db.transactions.insert_one(transaction.dict())
-    
     # Mark OTP as verified and clean up
     await db.otp_sessions.update_one(
         {"id": otp_session["id"]},
@@ -960,26 +4292,109 @@ async def create_subscription_request(request_data: SubscriptionRequestCreate, c
     return {"message": "Subscription request submitted successfully", "request_id": subscription_request.id}
 
 # Admin Routes (keeping existing ones)
+# User listing pages with a keyset cursor over an indexed sort: newest first,
+# by the searched field when q is given, or by balance when only a balance range
+# is given. Searches are case-sensitive prefix matches on email, name or phone
+# number, inferred from q unless `field` is set.
+ADMIN_USERS_PAGE_SIZE = 50
+ADMIN_USERS_MAX_PAGE_SIZE = 200
+ADMIN_USER_SEARCH_FIELDS = {"email": "email", "name": "name", "phone": "phone_number"}
+ADMIN_USER_PROJECTION = {
+    "_id": 0, "id": 1, "email": 1, "name": 1, "phone_number": 1, "role": 1,
+    "email_verified": 1, "created_at": 1, **{field: 1 for field in BALANCE_FIELDS}
+}
+
+def encode_cursor(value: Any, last_id: str) -> str:
+    if isinstance(value, datetime):
+        value = {"$date": value.isoformat()}
+    return base64.urlsafe_b64encode(json.dumps([value, last_id]).encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if isinstance(value, dict):
+            value = datetime.fromisoformat(value["$date"])
+        return value, str(last_id)
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def search_field(q: str) -> str:
+    if "@" in q:
+        return "email"
+    if q.lstrip("+").isdigit():
+        return "phone_number"
+    return "name"
+
 @api_router.get("/admin/users")
-async def get_all_users(current_user: User = Depends(get_current_user)):
+async def get_all_users(
+    q: Optional[str] = None,
+    field: Optional[str] = None,
+    role: Optional[UserRole] = None,
+    balance_field: str = "earnings_balance",
+    min_balance: Optional[float] = None,
+    max_balance: Optional[float] = None,
+    limit: int = ADMIN_USERS_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """A page of users; pass next_cursor back as cursor for the following page"""
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
+    if field is not None and field not in ADMIN_USER_SEARCH_FIELDS:
+        raise HTTPException(status_code=400, detail=f"field must be one of {sorted(ADMIN_USER_SEARCH_FIELDS)}")
+    if field is not None and not q:
+        raise HTTPException(status_code=422, detail="field requires q")
+    if balance_field not in BALANCE_FIELDS:
+        raise HTTPException(status_code=400, detail=f"balance_field must be one of {list(BALANCE_FIELDS)}")
+    limit = max(1, min(limit, ADMIN_USERS_MAX_PAGE_SIZE))
+    
+    conditions = []
+    balance = {}
+    if min_balance is not None:
+        balance["$gte"] = min_balance
+    if max_balance is not None:
+        balance["$lte"] = max_balance
+    if q:
+        sort_field = ADMIN_USER_SEARCH_FIELDS[field] if field else search_field(q)
+        direction = ASCENDING
+        conditions.append({sort_field: {"$regex": f"^{re.escape(q)}"}})
+    elif balance:
+        sort_field, direction = balance_field, ASCENDING
+    else:
+        sort_field, direction = "created_at", DESCENDING
+    if role is not None:
+        conditions.append({"role": role.value})
+    if balance:
+        conditions.append({balance_field: balance})
+    if cursor:
+        value, last_id = decode_cursor(cursor)
+        after = "$gt" if direction == ASCENDING else "$lt"
+        conditions.append({"$or": [{sort_field: {after: value}}, {sort_field: value, "id": {after: last_id}}]})
     
-    users = await db.users.find({}, {"_id": 0}).to_list(1000)
-    return users
+    users = await reader("admin").users.find(
+        {"$and": conditions} if conditions else {},
+        ADMIN_USER_PROJECTION
+    ).sort([(sort_field, direction), ("id", direction)]).limit(limit + 1).to_list(None)
+    
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = encode_cursor(users[-1].get(sort_field), users[-1]["id"])
+    return {"users": users, "next_cursor": next_cursor}
 
 @api_router.get("/admin/subscription-requests")
 async def get_subscription_requests(current_user: User = Depends(get_current_user)):
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    requests = await db.subscription_requests.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    admin_db = reader("admin")
+    requests = await admin_db.subscription_requests.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
     
     # Populate user and strategy details
     result = []
     for req in requests:
-        user = await db.users.find_one({"id": req["user_id"]}, {"_id": 0})
-        strategy = await db.strategies.find_one({"id": req["strategy_id"]}, {"_id": 0})
+        user = await admin_db.users.find_one({"id": req["user_id"]}, {"_id": 0})
+        strategy = await admin_db.strategies.find_one({"id": req["strategy_id"]}, {"_id": 0})
         
         result.append({
             **req,
@@ -996,23 +4411,31 @@ async def create_coupon(coupon_data: CouponCreate, current_user: User = Depends(
     
     coupon = Coupon(**coupon_data.dict())
     await db.coupons.insert_one(coupon.dict())
+    await bump_catalog_version("coupons")
     return coupon
 
 @api_router.post("/admin/upload-trading-results")
-async def upload_trading_results(file: UploadFile = File(...), current_user: User = Depends(get_current_user)):
+async def upload_trading_results(request: Request, response: Response, file: UploadFile = File(...), current_user: User = Depends(get_current_user)):
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     
+    return await idempotency.run(
+        request, response, f"upload:{current_user.id}",
+        lambda: process_trading_results(file)
+    )
+
+async def process_trading_results(file: UploadFile):
     if not file.filename.endswith(('.csv', '.xlsx')):
         raise HTTPException(status_code=400, detail="Only CSV and Excel files are supported")
     
     try:
         content = await file.read()
         
-        if file.filename.endswith('.csv'):
-            df = pd.read_csv(io.StringIO(content.decode('utf-8')))
-        else:
-            df = pd.read_excel(io.BytesIO(content))
+        with trace_span("pandas.parse", **{"file.name": file.filename, "file.size": len(content)}):
+            if file.filename.endswith('.csv'):
+                df = pd.read_csv(io.StringIO(content.decode('utf-8')))
+            else:
+                df = pd.read_excel(io.BytesIO(content))
         
         # Expected columns: Date, TransactionType, StrategyName, TradeDetails, ProfitLossPercentage
         required_columns = ['Date', 'TransactionType', 'StrategyName', 'TradeDetails', 'ProfitLossPercentage']
@@ -1021,8 +4444,17 @@ async def upload_trading_results(file: UploadFile = File(...), current_user: Use
             raise HTTPException(status_code=400, detail=f"Missing required columns: {required_columns}")
         
         processed_count = 0
+        settled_at = datetime.now(timezone.utc)
+        upload_id = str(uuid.uuid4())
+        results = []
+        earnings: Dict[tuple, float] = {}
+        ledger_writes: List[asyncio.Future] = []
+        dates = pd.to_datetime(df['Date'], errors='coerce', utc=True)
+        begin_side_effects()
+        await leaderboard.begin_settlement(upload_id)
         
-        for _, row in df.iterrows():
+        # to_dict("records") yields native Python scalars and is far cheaper than iterrows()
+        for row, row_date in zip(df[required_columns].to_dict("records"), dates):
             # Find strategy
             strategy = await db.strategies.find_one({"name": row['StrategyName']}, {"_id": 0})
             if not strategy:
@@ -1034,30 +4466,37 @@ async def upload_trading_results(file: UploadFile = File(...), current_user: Use
                 "is_active": True
             }, {"_id": 0}).to_list(1000)
             
-            for user_strategy in user_strategies:
-                # Calculate profit/loss amount
-                profit_loss_amount = user_strategy["invested_amount"] * (row['ProfitLossPercentage'] / 100)
-                
-                # Update user strategy total
-                await db.user_strategies.update_one(
-                    {"id": user_strategy["id"]},
-                    {"$inc": {"total_profit_loss": profit_loss_amount}}
-                )
-                
-                # Update user earnings balance (only earnings can be used for coupons)
-                await db.users.update_one(
-                    {"id": user_strategy["user_id"]},
-                    {"$inc": {"earnings_balance": profit_loss_amount}}
-                )
+            results.append(strategy_result_document(
+                strategy["id"], row, settled_at if pd.isna(row_date) else row_date.to_pydatetime(),
+                upload_id, len(user_strategies), settled_at
+            ))
+            
+            # Calculate profit/loss amounts and update the position totals in one round trip
+            amounts = [
+                user_strategy["invested_amount"] * (row['ProfitLossPercentage'] / 100)
+                for user_strategy in user_strategies
+            ]
+            if user_strategies:
+                await db.user_strategies.bulk_write([
+                    UpdateOne({"id": user_strategy["id"]}, {"$inc": {"total_profit_loss": profit_loss_amount}})
+                    for user_strategy, profit_loss_amount in zip(user_strategies, amounts)
+                ], ordered=False)
+            
+            for user_strategy, profit_loss_amount in zip(user_strategies, amounts):
+                position = (user_strategy["user_id"], strategy["id"])
+                earnings[position] = earnings.get(position, 0.0) + profit_loss_amount
                 
-                # Create transaction record
-                transaction = Transaction(
-                    user_id=user_strategy["user_id"],
+                # Credit user earnings balance (only earnings can be used for coupons)
+                posted = await post_ledger_entry(
+                    user_strategy["user_id"],
+                    {"earnings_balance": profit_loss_amount},
                     strategy_id=strategy["id"],
                     transaction_type=TransactionType.PROFIT if profit_loss_amount >= 0 else TransactionType.LOSS,
                     amount=profit_loss_amount,
                     description=f"Trading result: {row['TradeDetails']}",
                     virtual_money_type=VirtualMoneyType.EARNED_TRADING,
+                    created_at=settled_at,
+                    durable=False,
                     trade_details={
                         "date": row['Date'],
                         "transaction_type": row['TransactionType'],
@@ -1065,18 +4504,241 @@ async def upload_trading_results(file: UploadFile = File(...), current_user: Use
                         "trade_details": row['TradeDetails']
                     }
                 )
-                
-                await db.transactions.insert_one(transaction.dict())
+                if posted:
+                    ledger_writes.append(posted["written"])
                 processed_count += 1
         
+        if results:
+            await db.strategy_results.insert_many(results, ordered=False)
+        await leaderboard.record(earnings, upload_id)
+        await ledger_buffer.drain()
+        # Fails the upload if any settlement row could not be written
+        await asyncio.gather(*ledger_writes)
+        await bump_catalog_version("results")
+        
         return {"message": f"Trading results processed successfully. {processed_count} records updated."}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
 
+async def audit_user_ledger(user_id: str) -> Dict[str, Any]:
+    user = await db.users.find_one(
+        {"id": user_id},
+        {"_id": 0, "ledger_seq": 1, "ledger_updated_at": 1, "last_accrual.date": 1, **{field: 1 for field in BALANCE_FIELDS}}
+    )
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    seq = user.get("ledger_seq", 0)
+    stored = {field: user.get(field, 0.0) for field in BALANCE_FIELDS}
+    ledger = await ledger_balances_at(user_id, seq=seq)
+    if ledger is None:
+        # No ledger history yet: the stored balances are the opening balances
+        return {"user_id": user_id, "seq": seq, "stored": stored, "ledger": stored, "drift": {}, "missing_entries": 0}
+    # ledger_seq and the balances move before the row is inserted (and buffered rows
+    # land later), so a gap in the tail up to seq is only pending while the last
+    # change is recent or its accrual run is unfinished. Older gaps are rows that
+    # were never written: their deltas show up as drift.
+    missing_entries = seq - ledger["snapshot_seq"] - ledger["tail_entries"]
+    if missing_entries:
+        updated_at = user.get("ledger_updated_at")
+        if updated_at is not None and updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        pending = updated_at is not None and datetime.now(timezone.utc) - updated_at < timedelta(seconds=LEDGER_MAX_LAG_SECONDS)
+        accrual_date = (user.get("last_accrual") or {}).get("date")
+        if not pending and accrual_date:
+            pending = await db.accrual_runs.find_one({"_id": accrual_date, "status": {"$ne": "completed"}}, {"_id": 1}) is not None
+        if pending:
+            raise HTTPException(status_code=409, detail=f"Ledger entries up to seq {seq} are still being written, retry")
+    
+    drift = {
+        field: ledger[field] - stored[field]
+        for field in BALANCE_FIELDS
+        if abs(ledger[field] - stored[field]) > 1e-6
+    }
+    return {
+        "user_id": user_id,
+        "seq": seq,
+        "snapshot_seq": ledger["snapshot_seq"],
+        "tail_entries": ledger["tail_entries"],
+        "missing_entries": missing_entries,
+        "stored": stored,
+        "ledger": {field: ledger[field] for field in BALANCE_FIELDS},
+        "drift": drift
+    }
+
+@api_router.get("/admin/ledger/{user_id}/balances")
+async def get_ledger_balances(user_id: str, seq: Optional[int] = None, at: Optional[datetime] = None, current_user: User = Depends(get_current_user)):
+    """Reconstruct a user's balances at a ledger seq or point in time"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    if at is not None and at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    balances = await ledger_balances_at(user_id, seq=seq, at=at)
+    if balances is None:
+        raise HTTPException(status_code=404, detail="No ledger history for user")
+    return {"user_id": user_id, **balances}
+
+@api_router.get("/admin/ledger/{user_id}/audit")
+async def audit_ledger(user_id: str, current_user: User = Depends(get_current_user)):
+    """Compare stored balances with the ledger"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return await audit_user_ledger(user_id)
+
+@api_router.post("/admin/ledger/{user_id}/repair")
+async def repair_ledger_balances(user_id: str, current_user: User = Depends(get_current_user)):
+    """Reset stored balances to what the ledger says they should be"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    audit = await audit_user_ledger(user_id)
+    if not audit["drift"]:
+        return {"message": "Balances match the ledger", **audit}
+    
+    # Only apply the correction if no ledger entry landed since the audit
+    result = await db.users.update_one(
+        {"id": user_id, "ledger_seq": audit["seq"]},
+        {"$inc": audit["drift"]}
+    )
+    if result.modified_count == 0:
+        raise HTTPException(status_code=409, detail="Balances changed during repair, retry")
+    
+    return {"message": "Balances repaired", **audit}
+
+DB_HEALTH_TIMEOUT_SECONDS = 5
+
+@api_router.get("/health/db")
+async def get_db_health(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Database reachability; admins also get connection pool usage and server round-trip times"""
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=DB_HEALTH_TIMEOUT_SECONDS)
+        ping_ms = round((time.perf_counter() - started) * 1000, 3)
+        healthy = True
+    except Exception:
+        ping_ms = None
+        healthy = False
+    
+    status_code = 200 if healthy else 503
+    body = {"status": "ok" if healthy else "unavailable"}
+    try:
+        current_user = await resolve_user(request.cookies.get("session_token"), credentials.credentials if credentials else None)
+    except HTTPException:
+        current_user = None
+    if current_user is None or current_user.role != UserRole.ADMIN:
+        return JSONResponse(status_code=status_code, content=body)
+    
+    pool_options = client.options.pool_options
+    servers = pool_monitor.snapshot(pool_options.max_pool_size)
+    for description in client.topology_description.server_descriptions().values():
+        key = f"{description.address[0]}:{description.address[1]}"
+        rtt = description.round_trip_time
+        servers.setdefault(key, {})
+        servers[key]["type"] = description.server_type_name
+        servers[key]["round_trip_ms"] = round(rtt * 1000, 3) if rtt is not None else None
+    
+    body.update({
+        "ping_ms": ping_ms,
+        "pool": {
+            "max_pool_size": pool_options.max_pool_size,
+            "min_pool_size": pool_options.min_pool_size,
+            "max_idle_time_seconds": pool_options.max_idle_time_seconds,
+            "wait_queue_timeout_seconds": pool_options.wait_queue_timeout,
+            "max_connecting": pool_options.max_connecting,
+            "compressors": mongo_pool_options().get("compressors")
+        },
+        "servers": servers
+    })
+    return JSONResponse(status_code=status_code, content=body)
+
+@api_router.post("/admin/accruals/run")
+async def trigger_accrual(date: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    """Run or resume the daily accrual for a date (default: yesterday, UTC)"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    date = date or (datetime.now(timezone.utc).date() - timedelta(days=1)).isoformat()
+    try:
+        datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="date must be YYYY-MM-DD")
+    
+    try:
+        run = await run_accrual(date)
+    except AccrualOrderError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if run is None:
+        existing = await db.accrual_runs.find_one({"_id": date}, {"status": 1})
+        if existing and existing["status"] == "completed":
+            raise HTTPException(status_code=409, detail=f"Accrual for {date} is already completed")
+        raise HTTPException(status_code=409, detail="Another accrual run is in progress")
+    return run
+
+@api_router.get("/admin/accruals")
+async def list_accrual_runs(current_user: User = Depends(get_current_user)):
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return await db.accrual_runs.find({}, {"rates": 0}).sort("_id", -1).to_list(60)
+
+@api_router.get("/admin/profiles")
+async def list_request_profiles(current_user: User = Depends(get_current_user)):
+    """Most recent request profiles, without their stacks"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return await db.request_profiles.find(
+        {},
+        {"_id": 0, "folded": 0}
+    ).sort("created_at", -1).to_list(50)
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_request_profile(profile_id: str, format: str = "json", current_user: User = Depends(get_current_user)):
+    """A stored request profile; format=folded returns the stacks for flamegraph tools"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    profile = await db.request_profiles.find_one({"id": profile_id}, {"_id": 0})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "folded":
+        return PlainTextResponse(profile["folded"] + "\n")
+    return profile
+
+@api_router.get("/admin/metrics")
+async def get_metrics(current_user: User = Depends(get_current_user)):
+    """In-process metrics of this worker"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {
+        "pid": os.getpid(),
+        "read_routing": READ_ROUTING,
+        "ledger_buffer": ledger_buffer.metrics(),
+        "wallet_stream": wallet_broker.metrics(),
+        "idempotency": idempotency.metrics(),
+        "singleflight": singleflight.metrics(),
+        "load_shedding": {name: limiter.metrics() for name, limiter in route_limiters.items()},
+        "rate_limits": rate_limiter.metrics(),
+        "tracing": tracer.metrics(),
+        "traffic_capture": traffic_recorder.metrics() if traffic_recorder else None,
+        "portfolio_metrics_cache": portfolio_metrics_cache.metrics(),
+        "simulation_cache": simulation_cache.metrics(),
+        "leaderboard": leaderboard.metrics()
+    }
+
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(LoadSheddingMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(TracingMiddleware)
+app.add_middleware(TrafficCaptureMiddleware)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -1093,6 +4755,70 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def ensure_indexes():
+    try:
+        await db.users.create_index("id", unique=True)
+        await db.transactions.create_index([("user_id", ASCENDING), ("created_at", DESCENDING)])
+        await db.transactions.create_index(
+            [("user_id", ASCENDING), ("seq", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"seq": {"$exists": True}}
+        )
+        await db.balance_snapshots.create_index([("user_id", ASCENDING), ("seq", DESCENDING)], unique=True)
+        await db.portfolio_summaries.create_index("user_id", unique=True)
+        await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+        await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
+        await db.request_profiles.create_index("id", unique=True)
+        await db.request_profiles.create_index("created_at", expireAfterSeconds=PROFILE_TTL_SECONDS)
+        await db.user_strategies.create_index("id", unique=True)
+        await db.user_strategies.create_index([("strategy_id", ASCENDING), ("is_active", ASCENDING)])
+        await db.users.create_index("last_accrual.date", sparse=True)
+        await db.accruals.create_index([("date", ASCENDING), ("strategy_id", ASCENDING)])
+        await db.accruals.create_index("created_at", expireAfterSeconds=ACCRUAL_RETENTION_DAYS * 24 * 60 * 60)
+        await db.accrual_credits.create_index("date")
+        await db.accrual_credits.create_index("created_at", expireAfterSeconds=ACCRUAL_RETENTION_DAYS * 24 * 60 * 60)
+        await ensure_strategy_results_collection()
+        await db.strategy_results.create_index([("strategy_id", ASCENDING), ("date", ASCENDING)])
+        await db.leaderboard_scores.create_index("updated_at")
+        await db.leaderboard_uploads.create_index("status")
+        await db.leaderboard_uploads.create_index("started_at", expireAfterSeconds=LEADERBOARD_UPLOAD_RETENTION_DAYS * 24 * 60 * 60)
+        await db.users.create_index([("created_at", DESCENDING), ("id", DESCENDING)])
+        await db.users.create_index([("role", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)])
+        for search_key in (*ADMIN_USER_SEARCH_FIELDS.values(), *BALANCE_FIELDS):
+            await db.users.create_index([(search_key, ASCENDING), ("id", ASCENDING)])
+    except Exception as e:
+        logger.error(f"Failed to create indexes: {e}")
+
+background_tasks: List[asyncio.Task] = []
+
+@app.on_event("startup")
+async def start_background_tasks():
+    if WALLET_CHANGE_STREAM:
+        background_tasks.append(asyncio.create_task(wallet_change_stream_bridge()))
+    if tracer.enabled:
+        background_tasks.append(asyncio.create_task(tracer.run()))
+    if traffic_recorder:
+        background_tasks.append(asyncio.create_task(traffic_recorder.run()))
+    if ACCRUAL_SCHEDULER:
+        background_tasks.append(asyncio.create_task(accrual_scheduler()))
+    background_tasks.append(asyncio.create_task(leaderboard_loop()))
+    background_tasks.append(asyncio.create_task(admin_stats_scheduler()))
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await ledger_buffer.close()
+    if tracer.enabled:
+        await tracer.flush()
+    if traffic_recorder:
+        await traffic_recorder.flush()
+    if simulation_pool:
+        simulation_pool.shutdown(cancel_futures=True)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
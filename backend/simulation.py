@@ -0,0 +1,19 @@
+"""
+Bootstrap Monte Carlo for strategy simulation.
+
+Kept apart from server.py and limited to numpy: the simulation pool spawns its
+workers, and each worker imports the module of the function it runs.
+"""
+import numpy as np
+
+SIMULATION_PERCENTILES = (5, 25, 50, 75, 95)
+
+def simulate_paths(percentages: np.ndarray, trades: int, paths: int, checkpoints: np.ndarray) -> np.ndarray:
+    """Percentile bands of cumulative return (percent) at each checkpoint trade.
+
+    Runs in a worker process; returns an array of shape (percentiles, checkpoints).
+    """
+    rng = np.random.default_rng()
+    draws = rng.choice(percentages, size=(paths, trades))
+    cumulative = np.cumsum(draws, axis=1)[:, checkpoints - 1]
+    return np.percentile(cumulative, SIMULATION_PERCENTILES, axis=0)
@@ -444,10 +444,10 @@ def test_admin_get_users(result):
         response = make_request("GET", "/admin/users", token=admin_token)
         if response and response.status_code == 200:
             data = response.json()
-            if isinstance(data, list):
+            if isinstance(data.get("users"), list) and "next_cursor" in data:
                 result.success("Admin get all users")
             else:
-                result.failure("Admin get all users", "Response is not a list")
+                result.failure("Admin get all users", "Response is not a page of users")
         else:
             result.failure("Admin get all users", f"Status: {response.status_code if response else 'No response'}")
     else:
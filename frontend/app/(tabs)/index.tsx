@@ -28,29 +28,28 @@ interface UserStrategy {
 }
 
 export default function Home() {
-  const { user, refreshUser } = useAuth();
+  const { user, applyWallet } = useAuth();
   const [userStrategies, setUserStrategies] = useState<UserStrategy[]>([]);
   const [refreshing, setRefreshing] = useState(false);
 
   useEffect(() => {
-    fetchUserStrategies();
+    fetchHome();
   }, []);
 
-  const fetchUserStrategies = async () => {
+  // One round trip for the wallet and positions instead of separate /wallet and /user-strategies calls
+  const fetchHome = async () => {
     try {
-      const response = await axios.get(`${API_URL}/api/user-strategies`);
-      setUserStrategies(response.data);
+      const response = await axios.get(`${API_URL}/api/home`);
+      setUserStrategies(response.data.user_strategies.items);
+      await applyWallet(response.data.wallet);
     } catch (error) {
-      console.error('Error fetching user strategies:', error);
+      console.error('Error fetching home data:', error);
     }
   };
 
   const onRefresh = async () => {
     setRefreshing(true);
-    await Promise.all([
-      refreshUser(),
-      fetchUserStrategies(),
-    ]);
+    await fetchHome();
     setRefreshing(false);
   };
 
@@ -40,6 +40,17 @@ interface Strategy {
   is_active: boolean;
 }
 
+interface AdminStats {
+  users: { total: number; by_role: Record<string, number> };
+  signups: { date: string; count: number }[];
+  aum: {
+    total: number;
+    strategies: { strategy_id: string; name: string | null; aum: number; positions: number }[];
+  };
+  redemptions: { total: number; points: number };
+  rewards: { total: number };
+}
+
 export default function AdminDashboard() {
   const [adminToken, setAdminToken] = useState('');
   const [email, setEmail] = useState('');
@@ -47,6 +58,9 @@ export default function AdminDashboard() {
   const [isAuthenticated, setIsAuthenticated] = useState(false);
   const [users, setUsers] = useState<User[]>([]);
   const [strategies, setStrategies] = useState<Strategy[]>([]);
+  const [stats, setStats] = useState<AdminStats | null>(null);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [userSearch, setUserSearch] = useState('');
   const [activeTab, setActiveTab] = useState<'users' | 'strategies'>('users');
   const [loading, setLoading] = useState(false);
 
@@ -85,18 +99,37 @@ export default function AdminDashboard() {
 
   const fetchData = async () => {
     try {
-      const [usersResponse, strategiesResponse] = await Promise.all([
+      const [usersResponse, strategiesResponse, statsResponse] = await Promise.all([
         axios.get(`${API_URL}/api/admin/users`),
-        axios.get(`${API_URL}/api/strategies`)
+        axios.get(`${API_URL}/api/strategies`),
+        axios.get(`${API_URL}/api/admin/stats`)
       ]);
       
-      setUsers(usersResponse.data);
+      setUsers(usersResponse.data.users);
+      setNextCursor(usersResponse.data.next_cursor);
       setStrategies(strategiesResponse.data);
+      setStats(statsResponse.data);
     } catch (error) {
       console.error('Error fetching data:', error);
     }
   };
 
+  const fetchUsers = async (cursor: string | null = null) => {
+    try {
+      const response = await axios.get(`${API_URL}/api/admin/users`, {
+        params: {
+          q: userSearch.trim() || undefined,
+          cursor: cursor || undefined,
+        },
+      });
+
+      setUsers((current) => (cursor ? [...current, ...response.data.users] : response.data.users));
+      setNextCursor(response.data.next_cursor);
+    } catch (error) {
+      console.error('Error fetching users:', error);
+    }
+  };
+
   const formatCurrency = (amount: number) => {
     return new Intl.NumberFormat('en-US', {
       style: 'currency',
@@ -203,7 +236,7 @@ export default function AdminDashboard() {
           onPress={() => setActiveTab('users')}
         >
           <Text style={[styles.tabText, activeTab === 'users' && styles.activeTabText]}>
-            Users ({users.length})
+            Users ({stats?.users.total ?? users.length})
           </Text>
         </TouchableOpacity>
         <TouchableOpacity
@@ -221,6 +254,37 @@ export default function AdminDashboard() {
         {activeTab === 'users' ? (
           <View style={styles.section}>
             <Text style={styles.sectionTitle}>User Management</Text>
+            {stats && (
+              <View style={styles.userCard}>
+                <View style={styles.userBalances}>
+                  <View style={styles.balanceItem}>
+                    <Text style={styles.balanceLabel}>Users</Text>
+                    <Text style={styles.balanceValue}>{stats.users.total}</Text>
+                  </View>
+                  <View style={styles.balanceItem}>
+                    <Text style={styles.balanceLabel}>AUM</Text>
+                    <Text style={styles.balanceValue}>{formatCurrency(stats.aum.total)}</Text>
+                  </View>
+                  <View style={styles.balanceItem}>
+                    <Text style={styles.balanceLabel}>Redemptions</Text>
+                    <Text style={styles.balanceValue}>{stats.redemptions.total}</Text>
+                  </View>
+                  <View style={styles.balanceItem}>
+                    <Text style={styles.balanceLabel}>Rewards</Text>
+                    <Text style={styles.balanceValue}>{formatCurrency(stats.rewards.total)}</Text>
+                  </View>
+                </View>
+              </View>
+            )}
+            <TextInput
+              style={styles.input}
+              placeholder="Search by email, name or phone prefix"
+              value={userSearch}
+              onChangeText={setUserSearch}
+              onSubmitEditing={() => fetchUsers()}
+              autoCapitalize="none"
+              returnKeyType="search"
+            />
             {users.map((user) => (
               <View key={user.id} style={styles.userCard}>
                 <View style={styles.userHeader}>
@@ -261,6 +325,11 @@ export default function AdminDashboard() {
                 </View>
               </View>
             ))}
+            {nextCursor && (
+              <TouchableOpacity style={styles.loginButton} onPress={() => fetchUsers(nextCursor)}>
+                <Text style={styles.loginButtonText}>Load more</Text>
+              </TouchableOpacity>
+            )}
           </View>
         ) : (
           <View style={styles.section}>
@@ -293,6 +362,12 @@ export default function AdminDashboard() {
                       {formatCurrency(strategy.capital_required)}
                     </Text>
                   </View>
+                  <View style={styles.strategyDetail}>
+                    <Text style={styles.detailLabel}>AUM:</Text>
+                    <Text style={styles.detailValue}>
+                      {formatCurrency(stats?.aum.strategies.find((item) => item.strategy_id === strategy.id)?.aum ?? 0)}
+                    </Text>
+                  </View>
                 </View>
               </View>
             ))}
@@ -1,4 +1,4 @@
-import React, { createContext, useContext, useEffect, useState, ReactNode } from 'react';
+import React, { createContext, useContext, useEffect, useRef, useState, ReactNode } from 'react';
 import AsyncStorage from '@react-native-async-storage/async-storage';
 import { useRouter, useSegments } from 'expo-router';
 import axios from 'axios';
@@ -30,6 +30,7 @@ interface AuthContextType {
   logout: () => Promise<void>;
   loading: boolean;
   refreshUser: () => Promise<void>;
+  applyWallet: (wallet: Partial<User>) => Promise<void>;
   sendOTP: (email: string, phone?: string) => Promise<void>;
   verifyOTP: (email: string, otp: string) => Promise<string>;
   updatePhoneNumber: (phoneNumber: string) => Promise<void>;
@@ -44,6 +45,7 @@ const AuthContext = createContext<AuthContextType>({
   logout: async () => {},
   loading: true,
   refreshUser: async () => {},
+  applyWallet: async () => {},
   sendOTP: async () => {},
   verifyOTP: async () => '',
   updatePhoneNumber: async () => {},
@@ -59,6 +61,9 @@ interface AuthProviderProps {
 
 export function AuthProvider({ children }: AuthProviderProps) {
   const [user, setUser] = useState<User | null>(null);
+  // Latest user for handlers created in earlier renders (the wallet socket)
+  const userRef = useRef<User | null>(null);
+  userRef.current = user;
   const [token, setToken] = useState<string | null>(null);
   const [loading, setLoading] = useState(true);
   const router = useRouter();
@@ -73,6 +78,37 @@ export function AuthProvider({ children }: AuthProviderProps) {
     }
   }, [token]);
 
+  // Wallet updates pushed by the backend when ledger entries land
+  useEffect(() => {
+    if (!token || !API_URL) return;
+
+    let socket: WebSocket | null = null;
+    let retryTimer: ReturnType<typeof setTimeout> | null = null;
+    let closed = false;
+
+    const connect = () => {
+      socket = new WebSocket(`${API_URL.replace(/^http/, 'ws')}/api/stream?token=${encodeURIComponent(token)}`);
+      socket.onmessage = (message) => {
+        const event = JSON.parse(message.data);
+        if (event.wallet) {
+          applyWallet(event.wallet).catch((error) => console.error('Error applying wallet update:', error));
+        }
+      };
+      socket.onclose = () => {
+        if (!closed) {
+          retryTimer = setTimeout(connect, 5000);
+        }
+      };
+    };
+
+    connect();
+    return () => {
+      closed = true;
+      if (retryTimer) clearTimeout(retryTimer);
+      socket?.close();
+    };
+  }, [token]);
+
   // Navigation logic
   useEffect(() => {
     const inAuthGroup = segments[0] === '(auth)';
@@ -147,6 +183,19 @@ export function AuthProvider({ children }: AuthProviderProps) {
     }
   };
 
+  const applyWallet = async (wallet: Partial<User>) => {
+    if (!userRef.current) return;
+
+    const updatedUser = {
+      ...userRef.current,
+      ...wallet,
+    };
+
+    userRef.current = updatedUser;
+    setUser(updatedUser);
+    await AsyncStorage.setItem('user_data', JSON.stringify(updatedUser));
+  };
+
   const sendOTP = async (email: string, phone?: string) => {
     try {
       const response = await axios.post(`${API_URL}/api/auth/send-otp`, {
@@ -298,6 +347,7 @@ export function AuthProvider({ children }: AuthProviderProps) {
         logout,
         loading,
         refreshUser,
+        applyWallet,
         sendOTP,
         verifyOTP,
         updatePhoneNumber,